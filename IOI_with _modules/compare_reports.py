@@ -1,9 +1,28 @@
 """
-对比三种模式的计时报告生成汇总表格
+对比计时报告生成汇总表格，并基于运行历史库做趋势统计与性能回归检测
+
+用法：
+    python compare_reports.py timing_local_all.json timing_remote_all.json timing_hybrid.json [更多报告...]
+    python compare_reports.py history [--db ioi_history.db] [--mode hybrid] [--last 20]
+    python compare_reports.py gate --baseline-rev <rev> [--candidate-rev <rev>] [--mode hybrid]
 """
+import os
 import json
 import sys
-from typing import Dict, List
+import argparse
+from typing import Dict, List, Optional
+
+from ioi_history import (DEFAULT_DB, STAGES, detect_regressions, list_runs, percentile,
+                         report_total, stage_series)
+
+# 三种标准模式报告的中文标签
+MODE_LABELS = {
+    "timing_local_all.json": "全本地",
+    "timing_remote_all.json": "全云端",
+    "timing_hybrid.json": "混合",
+}
+DEFAULT_REPORTS = list(MODE_LABELS)
+SUBCOMMANDS = ("history", "gate")
 
 
 def load_timing(path: str) -> Dict:
@@ -15,7 +34,9 @@ def load_timing(path: str) -> Dict:
         return {}
 
 
-def format_time(t: float) -> str:
+def format_time(t: Optional[float]) -> str:
+    if t is None:
+        return "-"
     if t < 1:
         return f"{t*1000:.1f}ms"
     elif t < 60:
@@ -26,155 +47,181 @@ def format_time(t: float) -> str:
         return f"{m}m{s:.1f}s"
 
 
-def compare_reports(local_all: str = "timing_local_all.json",
-                   remote_all: str = "timing_remote_all.json",
-                   hybrid: str = "timing_hybrid.json"):
-    
-    local_data = load_timing(local_all)
-    remote_data = load_timing(remote_all)
-    hybrid_data = load_timing(hybrid)
-    
-    if not any([local_data, remote_data, hybrid_data]):
+def report_label(path: str) -> str:
+    name = os.path.basename(path)
+    return MODE_LABELS.get(name, os.path.splitext(name)[0].replace("timing_", ""))
+
+
+def compare_reports(paths: List[str] = None):
+    paths = paths or DEFAULT_REPORTS
+    reports = [(report_label(p), load_timing(p)) for p in paths]
+    reports = [(label, data) for label, data in reports if data]
+
+    if not reports:
         print("错误: 未找到任何计时报告文件")
         print("请先运行三种模式生成报告：")
         print("  python ioi_orchestrator.py --config configs/local_all.json")
         print("  python ioi_orchestrator.py --config configs/remote_all.json")
         print("  python ioi_orchestrator.py --config configs/hybrid.json")
         return
-    
-    # 定义要对比的关键指标（与IOI.ipynb一致）
-    metrics = [
-        ("filter_gpt2_time", "GPT-2样本筛选"),
-        ("collect_activations_time", "缓存激活值"),
-        ("patch_activations_time", "修补激活值"),
-        ("plot_heatmap_time", "绘制热力图"),
-    ]
-    
-    comm_metrics = [
-        ("filter_gpt2_upload_time", "筛选-上传"),
-        ("filter_gpt2_download_time", "筛选-下载"),
-        ("collect_activations_upload_time", "缓存-上传"),
-        ("collect_activations_download_time", "缓存-下载"),
-        ("patch_activations_upload_time", "修补-上传"),
-        ("patch_activations_download_time", "修补-下载"),
-        ("plot_heatmap_upload_time", "绘图-上传"),
-        ("plot_heatmap_download_time", "绘图-下载"),
-    ]
-    
-    print("=" * 100)
-    print("IOI 项目本地/云端/混合模式计时对比")
-    print("=" * 100)
+
+    width = 20 + 15 * len(reports) + 10
+    labels = [label for label, _ in reports]
+
+    print("=" * width)
+    print("IOI 项目计时对比：" + " / ".join(labels))
+    print("=" * width)
     print()
-    
-    # 1. 主要环节对比
+
+    # 1. 主要环节对比（_time：模块内部纯计算时间，与IOI.ipynb一致）
     print("【计算环节耗时对比】")
-    print("-" * 100)
-    print(f"{'环节':<20} {'全本地':>15} {'全云端':>15} {'混合模式':>15} {'最优':>10}")
-    print("-" * 100)
-    
-    for key, name in metrics:
-        local_val = local_data.get(key, None)
-        remote_val = remote_data.get(key, None)
-        hybrid_val = hybrid_data.get(key, None)
-        
-        vals = {}
-        if local_val is not None:
-            vals['全本地'] = local_val
-        if remote_val is not None:
-            vals['全云端'] = remote_val
-        if hybrid_val is not None:
-            vals['混合'] = hybrid_val
-        
-        best = min(vals.items(), key=lambda x: x[1])[0] if vals else "-"
-        
-        local_str = format_time(local_val) if local_val else "-"
-        remote_str = format_time(remote_val) if remote_val else "-"
-        hybrid_str = format_time(hybrid_val) if hybrid_val else "-"
-        
-        print(f"{name:<20} {local_str:>15} {remote_str:>15} {hybrid_str:>15} {best:>10}")
-    
-    print("-" * 100)
+    print("-" * width)
+    print(f"{'环节':<20}" + "".join(f"{label:>15}" for label in labels) + f"{'最优':>10}")
+    print("-" * width)
+    for stage, name in STAGES:
+        vals = {label: data.get(f"{stage}_time") for label, data in reports}
+        present = {k: v for k, v in vals.items() if v is not None}
+        best = min(present.items(), key=lambda x: x[1])[0] if len(present) > 1 else "-"
+        print(f"{name:<20}" + "".join(f"{format_time(vals[label]):>15}" for label in labels) + f"{best:>10}")
+    print("-" * width)
     print()
-    
-    # 2. 通信开销对比（仅远端和混合模式有）
-    print("【通信开销对比】(仅远端和混合模式)")
-    print("-" * 100)
-    print(f"{'通信环节':<30} {'全云端':>15} {'混合模式':>15}")
-    print("-" * 100)
-    
-    for key, name in comm_metrics:
-        remote_val = remote_data.get(key, None)
-        hybrid_val = hybrid_data.get(key, None)
-        
-        remote_str = format_time(remote_val) if remote_val else "-"
-        hybrid_str = format_time(hybrid_val) if hybrid_val else "-"
-        
-        if remote_val or hybrid_val:
-            print(f"{name:<30} {remote_str:>15} {hybrid_str:>15}")
-    
-    print("-" * 100)
+
+    # 2. 通信开销对比（仅含远端环节的报告有）
+    print("【通信开销对比】")
+    print("-" * width)
+    print(f"{'通信环节':<20}" + "".join(f"{label:>15}" for label in labels))
+    print("-" * width)
+    for stage, name in STAGES:
+        for suffix, kind in (("upload_time", "上传"), ("download_time", "下载")):
+            vals = [data.get(f"{stage}_{suffix}") for _, data in reports]
+            if any(v is not None for v in vals):
+                print(f"{name + '-' + kind:<20}" + "".join(f"{format_time(v):>15}" for v in vals))
+    print("-" * width)
     print()
-    
-    # 3. 总耗时对比
-    print("【总耗时对比】")
-    print("-" * 100)
-    
-    def calc_total(data: Dict) -> float:
-        total = data.get("local_prepare_time", 0)
-        for key, _ in metrics:
-            total_key = key.replace("_time", "_total_time")
-            if total_key in data:
-                total += data[total_key]
-            elif key in data:
-                total += data[key]
-        return total
-    
-    local_total = calc_total(local_data) if local_data else None
-    remote_total = calc_total(remote_data) if remote_data else None
-    hybrid_total = calc_total(hybrid_data) if hybrid_data else None
-    
-    print(f"{'全本地总耗时:':<20} {format_time(local_total) if local_total else '-'}")
-    print(f"{'全云端总耗时:':<20} {format_time(remote_total) if remote_total else '-'}")
-    print(f"{'混合模式总耗时:':<20} {format_time(hybrid_total) if hybrid_total else '-'}")
-    
-    totals = {}
-    if local_total: totals['全本地'] = local_total
-    if remote_total: totals['全云端'] = remote_total
-    if hybrid_total: totals['混合'] = hybrid_total
-    
-    if totals:
-        best_mode = min(totals.items(), key=lambda x: x[1])
+
+    # 3. 总耗时对比（各环节墙上时间之和，本地/远端口径一致）
+    print("【总耗时对比】(各环节墙上时间之和)")
+    print("-" * width)
+    totals = {label: report_total(data) for label, data in reports}
+    for label in labels:
+        print(f"{label + '总耗时:':<20} {format_time(totals[label])}")
+
+    present = {k: v for k, v in totals.items() if v is not None}
+    if present:
+        best_mode = min(present.items(), key=lambda x: x[1])
         print(f"\n最优模式: {best_mode[0]} ({format_time(best_mode[1])})")
-        
-        if '全本地' in totals and '混合' in totals:
-            speedup = (totals['全本地'] - totals['混合']) / totals['全本地'] * 100
+
+        if '全本地' in present and '混合' in present:
+            speedup = (present['全本地'] - present['混合']) / present['全本地'] * 100
             print(f"混合模式相比全本地加速: {speedup:+.1f}%")
-    
-    print("-" * 100)
+
+    print("-" * width)
     print()
-    
+
     # 4. 执行位置汇总
     print("【各环节执行位置】")
-    print("-" * 100)
-    for data, mode_name in [(local_data, "全本地"), (remote_data, "全云端"), (hybrid_data, "混合模式")]:
-        if not data:
-            continue
-        print(f"\n{mode_name}:")
-        for key, name in metrics:
-            loc_key = key.replace("_time", "_location")
-            loc = data.get(loc_key, "local" if mode_name == "全本地" else "remote" if mode_name == "全云端" else "-")
+    print("-" * width)
+    for label, data in reports:
+        print(f"\n{label}:")
+        for stage, name in STAGES:
+            loc = data.get(f"{stage}_location", "-")
             loc_cn = "本地" if loc == "local" else "云端" if loc == "remote" else "-"
             print(f"  {name:<20} -> {loc_cn}")
-    
+
+    print("=" * width)
+
+
+def show_history(db_path: str, mode: Optional[str] = None, last: int = 20, metric: str = "stage_total"):
+    """各环节的趋势（最近 last 次）与分位数"""
+    runs = list_runs(db_path, mode=mode, limit=last)
+    if not runs:
+        print(f"历史库 {db_path} 中没有{'模式 ' + mode + ' 的' if mode else ''}运行记录")
+        return
+    run_ids = [r["id"] for r in runs]
+    print("=" * 100)
+    print(f"运行历史（{len(runs)} 次，{runs[0]['timestamp']} ~ {runs[-1]['timestamp']}，指标 {metric}）")
+    print("=" * 100)
+    print(f"{'环节':<20}{'次数':>6}{'最新':>12}{'p50':>12}{'p90':>12}{'p95':>12}{'最小':>12}{'最大':>12}")
+    print("-" * 100)
+    for stage, name in STAGES:
+        series = stage_series(db_path, stage, metric, run_ids)
+        if not series:
+            continue
+        vals = [r["value"] for r in series]
+        print(f"{name:<20}{len(vals):>6}{format_time(vals[-1]):>12}"
+              + "".join(f"{format_time(percentile(vals, q)):>12}" for q in (50, 90, 95))
+              + f"{format_time(min(vals)):>12}{format_time(max(vals)):>12}")
+    print("-" * 100)
+    print("\n【趋势】(按运行顺序)")
+    for stage, name in STAGES:
+        series = stage_series(db_path, stage, metric, run_ids)
+        if not series:
+            continue
+        trend = "  ".join(f"{r['git_revision']}:{format_time(r['value'])}" for r in series[-8:])
+        print(f"  {name:<20} {trend}")
     print("=" * 100)
 
 
-if __name__ == "__main__":
-    if len(sys.argv) > 1:
-        local_path = sys.argv[1] if len(sys.argv) > 1 else "timing_local_all.json"
-        remote_path = sys.argv[2] if len(sys.argv) > 2 else "timing_remote_all.json"
-        hybrid_path = sys.argv[3] if len(sys.argv) > 3 else "timing_hybrid.json"
-        compare_reports(local_path, remote_path, hybrid_path)
+def run_gate(db_path: str, baseline_rev: str, candidate_rev: Optional[str] = None, mode: Optional[str] = None,
+             metric: str = "stage_total", alpha: float = 0.05, min_slowdown: float = 0.05) -> bool:
+    """性能门禁：任一环节显著变慢则返回 False"""
+    runs = list_runs(db_path, mode=mode)
+    if not runs:
+        print(f"历史库 {db_path} 中没有运行记录")
+        return False
+    candidate_rev = candidate_rev or runs[-1]["git_revision"]
+    baseline_ids = [r["id"] for r in runs if r["git_revision"] == baseline_rev]
+    candidate_ids = [r["id"] for r in runs if r["git_revision"] == candidate_rev]
+    if not baseline_ids or not candidate_ids:
+        print(f"错误: 基线 {baseline_rev} 有 {len(baseline_ids)} 次运行，候选 {candidate_rev} 有 {len(candidate_ids)} 次运行")
+        return False
+    findings = detect_regressions(db_path, baseline_ids, candidate_ids, metric, alpha, min_slowdown)
+    print("=" * 100)
+    print(f"性能门禁: 基线 {baseline_rev} ({len(baseline_ids)} 次) vs 候选 {candidate_rev} ({len(candidate_ids)} 次)"
+          f"，alpha={alpha}，最小变慢 {min_slowdown:.0%}")
+    print("=" * 100)
+    print(f"{'环节':<20}{'基线中位数':>12}{'候选中位数':>12}{'变化':>10}{'p值':>10}{'结论':>10}")
+    print("-" * 100)
+    for f in findings:
+        verdict = "回归" if f["regression"] else "通过"
+        print(f"{f['name']:<20}{format_time(f['baseline_median']):>12}{format_time(f['candidate_median']):>12}"
+              f"{f['change']:>+10.1%}{f['p_value']:>10.4f}{verdict:>10}")
+    print("-" * 100)
+    failed = [f for f in findings if f["regression"]]
+    if failed:
+        print(f"[FAIL] {len(failed)} 个环节显著变慢: {', '.join(f['name'] for f in failed)}")
     else:
-        compare_reports()
+        print("[OK] 未检测到显著的性能回归")
+        if min(len(baseline_ids), len(candidate_ids)) < 4:
+            print("[提示] 每组少于 4 次运行时，alpha=0.05 下检验几乎不可能显著，建议多跑几次")
+    return not failed
 
+
+def main():
+    if len(sys.argv) < 2 or sys.argv[1] not in SUBCOMMANDS:
+        # 兼容旧用法：直接传入若干计时报告
+        compare_reports(sys.argv[1:] or None)
+        return
+    parser = argparse.ArgumentParser(description="运行历史统计与性能门禁")
+    sub = parser.add_subparsers(dest="command", required=True)
+    p_hist = sub.add_parser("history", help="各环节趋势与分位数")
+    p_gate = sub.add_parser("gate", help="与基线比较，显著变慢时以非零码退出")
+    for p in (p_hist, p_gate):
+        p.add_argument("--db", default=DEFAULT_DB)
+        p.add_argument("--mode", default=None, help="只看某个配置（如 hybrid、local_all）")
+        p.add_argument("--metric", default="stage_total", help="stage_total / time / wall_time / upload_time / download_time")
+    p_hist.add_argument("--last", type=int, default=20)
+    p_gate.add_argument("--baseline-rev", required=True)
+    p_gate.add_argument("--candidate-rev", default=None, help="默认为最近一次运行的版本")
+    p_gate.add_argument("--alpha", type=float, default=0.05)
+    p_gate.add_argument("--min-slowdown", type=float, default=0.05, help="中位数至少变慢的比例")
+    args = parser.parse_args()
+    if args.command == "history":
+        show_history(args.db, args.mode, args.last, args.metric)
+    else:
+        ok = run_gate(args.db, args.baseline_rev, args.candidate_rev, args.mode, args.metric, args.alpha, args.min_slowdown)
+        sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,187 @@
+"""
+IOI 流水线扩展性基准测试
+在单机 CPU 上对 filter / collect / patch / plot 按数据规模 × batch size × 线程数做网格测试，
+每个配置先预热再重复多次，输出中位数/p95 吞吐与峰值内存，结果写成 JSON 便于跨 commit 对比
+
+用法：
+    python ioi_benchmark.py --sizes 50,500,5000 --batch-sizes 1,8,32 --threads 1,4 --output bench_results.json
+    python ioi_benchmark.py --compare bench_old.json bench_new.json
+"""
+import os
+# 只测 CPU：必须在 import torch 之前屏蔽 GPU
+os.environ["CUDA_VISIBLE_DEVICES"] = ""
+os.environ.setdefault("TQDM_DISABLE", "1")
+
+import json
+import time
+import platform
+import argparse
+from typing import Dict, List
+
+import torch
+
+import ioi_modules
+from ioi_history import git_revision, percentile
+from ioi_memory import peak_rss_mb, reset_peak_rss
+from ioi_local_pre import generate_data, check_sentence_structure
+
+
+STAGES = ["filter", "collect", "patch", "plot"]
+# 各环节吞吐的计量单位
+UNITS = {"filter": "prompts/s", "collect": "prompts/s", "patch": "patches/s", "plot": "plots/s"}
+
+
+def prepare_inputs(size: int, workdir: str, model, batch_size: int, patch_samples: int) -> Dict[str, str]:
+    """为某个数据规模准备各环节的输入文件（上游产物只生成一次）"""
+    files = {
+        "data": os.path.join(workdir, f"data_{size}.json"),
+        "filter": os.path.join(workdir, f"data_check1_{size}.json"),
+        "collect": os.path.join(workdir, f"data_check2_{size}.json"),
+        "patch": os.path.join(workdir, f"saved_data_{size}.pt"),
+        "plot": os.path.join(workdir, f"results_{size}.pt"),
+    }
+    data, _ = generate_data(num_samples=size, output_file=files["data"])
+    check_sentence_structure(data, output_file=files["filter"])
+    ioi_modules.filter_with_gpt2(files["filter"], files["collect"], model=model, batch_size=batch_size)
+    ioi_modules.get_clean_activations(files["collect"], files["patch"], model=model, batch_size=batch_size)
+    ioi_modules.activation_patching(files["patch"], files["plot"], model=model, batch_size=batch_size, num_samples=patch_samples)
+    return files
+
+
+def run_stage(stage: str, files: Dict[str, str], workdir: str, model, batch_size: int, patch_samples: int) -> dict:
+    """执行一次环节，返回其结果字典（用于计算处理量）"""
+    out = os.path.join(workdir, f"bench_out_{stage}")
+    if stage == "filter":
+        return ioi_modules.filter_with_gpt2(files["filter"], out + ".json", model=model, batch_size=batch_size)
+    if stage == "collect":
+        return ioi_modules.get_clean_activations(files["collect"], out + ".pt", model=model, batch_size=batch_size)
+    if stage == "patch":
+        return ioi_modules.activation_patching(files["patch"], out + ".pt", model=model, batch_size=batch_size, num_samples=patch_samples)
+    return ioi_modules.plot_heatmap(files["plot"], out + ".png")
+
+
+def work_items(stage: str, result: dict) -> int:
+    if stage == "filter":
+        return result["total_count"]
+    if stage == "collect":
+        return result["valid_samples"]
+    if stage == "patch":
+        return result["total_patches"]
+    return 1
+
+
+def bench_config(stage, files, workdir, model, batch_size, patch_samples, warmup, trials) -> dict:
+    for _ in range(warmup):
+        run_stage(stage, files, workdir, model, batch_size, patch_samples)
+    times, peaks, items = [], [], 0
+    for _ in range(trials):
+        reset_peak_rss()
+        t0 = time.perf_counter()
+        result = run_stage(stage, files, workdir, model, batch_size, patch_samples)
+        times.append(time.perf_counter() - t0)
+        peaks.append(peak_rss_mb())
+        items = work_items(stage, result)
+    median_s, p95_s = percentile(times, 50), percentile(times, 95)
+    return {
+        "trials_s": times,
+        "items": items,
+        "unit": UNITS[stage],
+        "median_s": median_s,
+        "p95_s": p95_s,
+        # p95 吞吐按 p95 耗时（慢尾）计算
+        "median_throughput": items / median_s if median_s > 0 else None,
+        "p95_throughput": items / p95_s if p95_s > 0 else None,
+        "peak_rss_mb": max(peaks),
+    }
+
+
+def run_benchmark(sizes, batch_sizes, threads, stages, warmup, trials, patch_samples, workdir, output):
+    os.makedirs(workdir, exist_ok=True)
+    report = {
+        "meta": {
+            "git_revision": git_revision(),
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "platform": platform.platform(),
+            "python": platform.python_version(),
+            "torch": torch.__version__,
+            "cpu_count": os.cpu_count(),
+            "warmup": warmup, "trials": trials, "patch_samples": patch_samples,
+        },
+        "results": [],
+    }
+    model = ioi_modules.load_model_safely(device="cpu")
+    for size in sizes:
+        print(f"[日志] 准备数据规模 {size} ...")
+        torch.set_num_threads(max(threads))
+        files = prepare_inputs(size, workdir, model, max(batch_sizes), patch_samples)
+        for n_threads in threads:
+            torch.set_num_threads(n_threads)
+            for stage in stages:
+                # 绘图与 batch size 无关，只测一次
+                for batch_size in (batch_sizes if stage != "plot" else [1]):
+                    print(f"[日志] {stage:<8} size={size} batch={batch_size} threads={n_threads}")
+                    stats = bench_config(stage, files, workdir, model, batch_size, patch_samples, warmup, trials)
+                    stats.update({"stage": stage, "size": size, "batch_size": batch_size, "threads": n_threads})
+                    report["results"].append(stats)
+                    print(f"    中位数 {stats['median_s']:.3f}s  吞吐 {stats['median_throughput']:.2f} {stats['unit']}"
+                          f"  p95 {stats['p95_throughput']:.2f}  峰值内存 {stats['peak_rss_mb']:.0f}MB")
+                    # 每个配置完成后落盘，长时间运行中断也不丢结果
+                    with open(output, "w", encoding="utf-8") as f:
+                        json.dump(report, f, indent=2)
+    print(f"[OK] 基准测试完成，共 {len(report['results'])} 个配置 -> {output}")
+    return report
+
+
+def compare_benchmarks(old_path: str, new_path: str):
+    """按 (stage, size, batch_size, threads) 对齐两次结果，打印中位数吞吐变化"""
+    with open(old_path, "r", encoding="utf-8") as f:
+        old = json.load(f)
+    with open(new_path, "r", encoding="utf-8") as f:
+        new = json.load(f)
+    key = lambda r: (r["stage"], r["size"], r["batch_size"], r["threads"])
+    old_map = {key(r): r for r in old["results"]}
+    print(f"基线: {old['meta'].get('git_revision')}  对比: {new['meta'].get('git_revision')}")
+    print("-" * 96)
+    print(f"{'环节':<10}{'规模':>8}{'batch':>7}{'线程':>6}{'基线吞吐':>14}{'新吞吐':>14}{'变化':>10}{'峰值内存(MB)':>16}")
+    print("-" * 96)
+    for r in new["results"]:
+        o = old_map.get(key(r))
+        if o is None or not o.get("median_throughput"):
+            continue
+        change = (r["median_throughput"] / o["median_throughput"] - 1) * 100
+        print(f"{r['stage']:<10}{r['size']:>8}{r['batch_size']:>7}{r['threads']:>6}"
+              f"{o['median_throughput']:>14.2f}{r['median_throughput']:>14.2f}{change:>+9.1f}%"
+              f"{o['peak_rss_mb']:>8.0f}->{r['peak_rss_mb']:<7.0f}")
+    print("-" * 96)
+
+
+def _int_list(s: str) -> List[int]:
+    return [int(x) for x in s.split(",") if x]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="IOI 流水线 CPU 基准测试")
+    parser.add_argument("--sizes", type=_int_list, default=[50, 500, 5000], help="生成的 prompt 数，逗号分隔")
+    parser.add_argument("--batch-sizes", type=_int_list, default=[1, 8, 32])
+    parser.add_argument("--threads", type=_int_list, default=sorted({1, os.cpu_count() or 1}))
+    parser.add_argument("--stages", default=",".join(STAGES))
+    parser.add_argument("--warmup", type=int, default=1)
+    parser.add_argument("--trials", type=int, default=3)
+    parser.add_argument("--patch-samples", type=int, default=10, help="patch 环节抽样的样本数")
+    parser.add_argument("--workdir", default="bench_work")
+    parser.add_argument("--output", default="bench_results.json")
+    parser.add_argument("--compare", nargs=2, metavar=("OLD", "NEW"), help="对比两个结果文件")
+    args = parser.parse_args()
+    if args.compare:
+        compare_benchmarks(*args.compare)
+        return
+    stages = [s for s in args.stages.split(",") if s]
+    unknown = set(stages) - set(STAGES)
+    if unknown:
+        parser.error(f"未知环节: {sorted(unknown)}")
+    run_benchmark(args.sizes, args.batch_sizes, args.threads, stages, args.warmup, args.trials,
+                  args.patch_samples, args.workdir, args.output)
+
+
+if __name__ == "__main__":
+    main()
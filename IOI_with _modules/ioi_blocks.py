@@ -0,0 +1,48 @@
+"""
+按块流式处理 JSONL 的公共部分（ioi_stream_pre.py 的结构校验与 data_generator/validate_data.py 的流式验证共用）
+- 文本按约 block_bytes 切成整行的块，每块带块首行号，交给进程池逐块处理
+- bounded_imap 限制在途的块数，读入速度不会超过处理速度，内存不随文件大小增长
+只依赖标准库
+"""
+import json
+from collections import deque
+from typing import Iterable, Iterator, List, Tuple
+
+
+def iter_text_blocks(files: List[str], block_bytes: int = 4 << 20, line_no: int = 1) -> Iterator[Tuple[int, str]]:
+    """依次读取 JSONL 文件，按约 block_bytes 切成整行的文本块，返回 (块首行号, 文本)；行号跨文件连续"""
+    for file in files:
+        with open(file, 'r', encoding='utf-8') as f:
+            while True:
+                text = f.read(block_bytes)
+                if not text:
+                    break
+                if not text.endswith("\n"):
+                    text += f.readline()
+                yield line_no, text
+                line_no += text.count("\n")
+
+
+def iter_record_blocks(records: Iterable, block_bytes: int = 4 << 20, line_no: int = 1) -> Iterator[Tuple[int, str]]:
+    """逐条转成 JSONL 行，攒到约 block_bytes 输出一块（用于 .json 列表或二进制分片等非 JSONL 输入）"""
+    lines, size = [], 0
+    for rec in records:
+        lines.append(json.dumps(rec, ensure_ascii=False))
+        size += len(lines[-1])
+        if size >= block_bytes:
+            yield line_no, "\n".join(lines) + "\n"
+            line_no += len(lines)
+            lines, size = [], 0
+    if lines:
+        yield line_no, "\n".join(lines) + "\n"
+
+
+def bounded_imap(pool, func, items: Iterable, window: int) -> Iterator:
+    """同 pool.imap，但最多只有 window 个任务在途：取走一个结果后才读入下一块"""
+    pending = deque()
+    for item in items:
+        pending.append(pool.apply_async(func, (item,)))
+        if len(pending) >= window:
+            yield pending.popleft().get()
+    while pending:
+        yield pending.popleft().get()
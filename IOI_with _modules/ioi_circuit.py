@@ -0,0 +1,196 @@
+"""
+自动电路发现：从完整的头图出发，按接收节点逐轮剪边（ACDC 式）
+- 节点：各注意力头与 logits；边 (发送头 → 接收节点) 仅当发送头所在层早于接收节点。MLP 与嵌入不作为节点，始终使用当前前向的值
+- 剪掉一条边 = 在 clean 前向中，接收节点的输入里该发送头的输出换成 corrupted 的输出：
+  接收头的 hook_attn_in（每头独立的输入）或最后一层 resid_post 的最后位置，减去 (当前输出 - corrupted 输出)
+- 按拓扑逆序（logits、第 11 层 … 第 1 层）处理接收节点，每轮把该节点的全部现存入边各剪一条作为候选，
+  与不剪的基线一起放进同一批前向；指标变化 |Δ| < 阈值的边在本轮一并剪掉
+- corrupted 各头的输出（z @ W_O）对所选样本只前向一次，各轮复用；每轮结束写入检查点，中断后可续跑
+
+指标为 (x - corrupted) / (clean - corrupted)，x 为所选样本 logits diff 的均值；完整图即 clean 前向，指标为 1
+最终电路的指标即忠实度（faithfulness）
+"""
+import os
+import time
+from typing import Dict, List, Optional
+
+import torch
+
+
+class HeadGraph:
+    """kept[r, s]：接收节点 r（0..n-1 为头，n 为 logits）的来自发送头 s 的入边是否保留"""
+
+    def __init__(self, n_layers: int, n_heads: int):
+        self.n_layers, self.n_heads = n_layers, n_heads
+        self.n = n_layers * n_heads
+        self.logits = self.n
+        sender_layer = torch.arange(self.n) // n_heads
+        receiver_layer = torch.cat([sender_layer, torch.tensor([n_layers])])
+        self.valid = receiver_layer[:, None] > sender_layer[None, :]
+        self.kept = self.valid.clone()
+
+    def receivers(self) -> List[int]:
+        """拓扑逆序：logits 在前，之后从最后一层到第 1 层（第 0 层的头没有入边）"""
+        return [self.logits] + list(range(self.n - 1, self.n_heads - 1, -1))
+
+    def senders(self, r: int) -> List[int]:
+        return self.kept[r].nonzero()[:, 0].tolist()
+
+    def pruned(self) -> torch.Tensor:
+        return (self.valid & ~self.kept).float()
+
+    def label(self, node: int) -> str:
+        return "logits" if node == self.logits else f"L{node // self.n_heads}H{node % self.n_heads}"
+
+    def edges(self) -> List[List[str]]:
+        return [[self.label(s), self.label(r)] for r, s in self.kept.nonzero().tolist()]
+
+    def out_degree(self) -> torch.Tensor:
+        """各头保留的出边数 [layers, heads]（含到 logits 的边），作为热力图的值"""
+        return self.kept.sum(dim=0).view(self.n_layers, self.n_heads).float()
+
+
+class EdgePatcher:
+    """
+    clean_tokens / corrupted_tokens: [N, pos]（同一长度），ans_a / ans_b: [N]
+    logit_diff(model, resid, ans_a, ans_b)：由最后一层残差算答案的 logits diff（ioi_modules.answer_logit_diff）
+    run(pruned, cand_r, cand_s, samples) 中每一行是一个样本在「当前图再额外剪掉一条边 (cand_s → cand_r)」下的前向，
+    cand_r = -1 表示不额外剪边；返回每行的 logits diff
+    clean_mean / corrupted_mean：clean 与 corrupted 前向 logits diff 的样本均值，用于归一化指标
+    """
+
+    def __init__(self, model, clean_tokens, corrupted_tokens, ans_a, ans_b, logit_diff):
+        from transformer_lens import utils
+        self.model = model
+        self.utils = utils
+        self.logit_diff = logit_diff
+        self.clean_tokens, self.ans_a, self.ans_b = clean_tokens, ans_a, ans_b
+        self.n_layers, self.n_heads = model.cfg.n_layers, model.cfg.n_heads
+        rows = torch.arange(len(clean_tokens), device=clean_tokens.device)
+        corrupted_logits, cache = model.run_with_cache(corrupted_tokens, names_filter=lambda n: n.endswith("hook_z"))
+        clean_logits = model(clean_tokens)[:, -1]
+        self.clean_mean = float((clean_logits[rows, ans_a] - clean_logits[rows, ans_b]).mean())
+        self.corrupted_mean = float((corrupted_logits[rows, -1, ans_a] - corrupted_logits[rows, -1, ans_b]).mean())
+        # [N, pos, layers * heads, d_model]
+        self.corr_out = torch.einsum("lnphd,lhdm->nplhm", cache.stack_activation("z"), model.W_O).flatten(2, 3)
+        del cache
+
+    def run(self, pruned: torch.Tensor, cand_r: torch.Tensor, cand_s: torch.Tensor, samples: torch.Tensor) -> torch.Tensor:
+        model, H = self.model, self.n_heads
+        rows, pos = len(samples), self.clean_tokens.shape[1]
+        # 当前前向各头输出与 corrupted 输出之差，按层依次填入
+        diff = torch.zeros(rows, pos, self.n_layers * H, model.cfg.d_model, device=self.corr_out.device, dtype=self.corr_out.dtype)
+
+        def store_out(z, hook, layer):
+            block = slice(layer * H, (layer + 1) * H)
+            diff[:, :, block] = torch.einsum("bphd,hdm->bphm", z, model.W_O[layer]) - self.corr_out[samples, :, block]
+
+        def extra(r0: int, r1: int, prev, position=None):
+            """候选边落在 [r0, r1) 内的行：(行号, 接收节点, 被剪发送头在 prev 中的值)"""
+            hit = ((cand_r >= r0) & (cand_r < r1)).nonzero()[:, 0]
+            src = prev[hit, :, cand_s[hit]] if position is None else prev[hit, position, cand_s[hit]]
+            return hit, cand_r[hit] - r0, src
+
+        def patch_in(x, hook, layer):
+            # x: [batch, pos, n_heads, d_model]，每个头各自的输入
+            prev = diff[:, :, :layer * H]
+            delta = torch.einsum("rs,bpsm->bprm", pruned[layer * H:(layer + 1) * H, :layer * H], prev)
+            hit, r, src = extra(layer * H, (layer + 1) * H, prev)
+            if len(hit):
+                delta[hit, :, r] += src
+            return x - delta
+
+        def patch_out(x, hook):
+            # 到 logits 的边只影响最后位置
+            n = self.n_layers * H
+            x[:, -1] -= torch.einsum("s,bsm->bm", pruned[n], diff[:, -1])
+            hit, _, src = extra(n, n + 1, diff, position=-1)
+            if len(hit):
+                x[hit, -1] -= src
+            return x
+
+        hooks = [(self.utils.get_act_name("z", layer), _bind(store_out, layer)) for layer in range(self.n_layers)]
+        hooks += [(f"blocks.{layer}.hook_attn_in", _bind(patch_in, layer)) for layer in range(1, self.n_layers)]
+        hooks.append((f"blocks.{self.n_layers - 1}.hook_resid_post", patch_out))
+        resid = model.run_with_hooks(self.clean_tokens[samples], fwd_hooks=hooks, stop_at_layer=self.n_layers)
+        return self.logit_diff(model, resid, self.ans_a[samples], self.ans_b[samples])
+
+
+def _bind(fn, layer):
+    return lambda x, hook: fn(x, hook, layer)
+
+
+def evaluate(patcher: EdgePatcher, graph: HeadGraph, candidates: List, batch_size: int) -> List[float]:
+    """candidates 为 (接收, 发送) 或 None（当前图本身）；每个候选在全部样本上的指标，按 batch_size 行分块前向"""
+    n = len(patcher.clean_tokens)
+    device = patcher.clean_tokens.device
+    cand = torch.tensor([c if c is not None else (-1, -1) for c in candidates], device=device).repeat_interleave(n, dim=0)
+    samples = torch.arange(n, device=device).repeat(len(candidates))
+    pruned = graph.pruned().to(device)
+    diffs = torch.cat([patcher.run(pruned, cand[i:i + batch_size, 0], cand[i:i + batch_size, 1], samples[i:i + batch_size])
+                       for i in range(0, len(samples), batch_size)])
+    x = diffs.view(len(candidates), n).float().mean(dim=1)
+    return ((x - patcher.corrupted_mean) / (patcher.clean_mean - patcher.corrupted_mean)).tolist()
+
+
+def load_checkpoint(path: Optional[str], config: Dict) -> Optional[Dict]:
+    if not path or not os.path.exists(path):
+        return None
+    state = torch.load(path, map_location="cpu")
+    if state.get("config") != config:
+        print(f"[WARN] 检查点 {path} 的配置与本次不同，重新开始")
+        return None
+    return state
+
+
+def save_checkpoint(path: Optional[str], state: Dict):
+    """先写临时文件再替换，中断时不会留下半个检查点"""
+    if not path:
+        return
+    torch.save(state, path + ".tmp")
+    os.replace(path + ".tmp", path)
+
+
+def discover_circuit(model, clean_tokens, corrupted_tokens, ans_a, ans_b, logit_diff,
+                     threshold: float = 0.01, batch_size: int = 32, checkpoint: Optional[str] = None,
+                     config: Optional[Dict] = None) -> Dict:
+    """
+    返回 {"graph": HeadGraph, "faithfulness", "history", "forwards", "rows", "resumed"}
+    config 写入检查点，只有配置相同（输入、样本、阈值）的检查点才会被续用
+    """
+    graph = HeadGraph(model.cfg.n_layers, model.cfg.n_heads)
+    config = dict(config or {}, threshold=threshold)
+    state = load_checkpoint(checkpoint, config)
+    if state is not None:
+        graph.kept = state["kept"]
+        print(f"[日志] 从检查点续跑：已完成 {state['done']}/{len(graph.receivers())} 个接收节点")
+    else:
+        state = {"config": config, "done": 0, "history": [], "forwards": 0, "rows": 0}
+    resumed = state["done"]
+    model.set_use_attn_in(True)
+    try:
+        patcher = EdgePatcher(model, clean_tokens, corrupted_tokens, ans_a, ans_b, logit_diff)
+        n = len(clean_tokens)
+        receivers = graph.receivers()
+        for step in range(state["done"], len(receivers)):
+            r = receivers[step]
+            t0 = time.time()
+            senders = graph.senders(r)
+            candidates = [None] + [(r, s) for s in senders]
+            metrics = evaluate(patcher, graph, candidates, batch_size)
+            base = metrics[0]
+            drop = [s for s, m in zip(senders, metrics[1:]) if abs(m - base) < threshold]
+            graph.kept[r, drop] = False
+            state["forwards"] += -(-len(candidates) * n // batch_size)
+            state["rows"] += len(candidates) * n
+            state["history"].append({"receiver": graph.label(r), "candidates": len(senders), "pruned": len(drop),
+                                     "metric": round(base, 4), "time": round(time.time() - t0, 3)})
+            state.update(done=step + 1, kept=graph.kept)
+            save_checkpoint(checkpoint, state)
+            print(f"[日志] {graph.label(r)}: 剪掉 {len(drop)}/{len(senders)} 条入边，当前指标 {base:.4f}，"
+                  f"保留 {int(graph.kept.sum())} 条边")
+        faithfulness = evaluate(patcher, graph, [None], batch_size)[0]
+    finally:
+        model.set_use_attn_in(False)
+    return {"graph": graph, "faithfulness": faithfulness, "history": state["history"],
+            "forwards": state["forwards"], "rows": state["rows"], "resumed": resumed}
@@ -0,0 +1,179 @@
+"""
+patch 的编译执行路径
+逐头 patch 的每次前向都要经过 HookedTransformer 的 Python hook 分发。这里把 GPT-2 的前向（LNPre、注意力、gelu_new MLP，
+与 load_model_safely 处理后的权重一致）写成一个纯张量函数，patch 直接内联为 torch.where(mask, replacement, z)，
+再用 torch.compile（或 torch.jit.trace）编译：
+- 每个形状桶（prompt 长度）编译一次并缓存；最后一批不足 rows 行时补齐到 rows 行，避免重新编译
+  每个桶编译的是一个新的函数对象（各有自己的 code object），不受 dynamo 按 code object 计的重编译上限影响；
+  仍退回 eager 的桶（图中断或重编译）在报告中标为 fallback，不计入编译后的耗时
+- 每个桶第一次调用时另跑一次 eager 前向作对照，报告编译耗时、每次前向的 eager/编译耗时与回本所需的前向次数
+- 对照的 eager 结果同时用于校验：编译结果与之不在 TOLERANCE 内一致（手写前向与模型不符）时报错提示，
+  该桶标为 fallback，之后一律走 eager
+只支持单 token 目标、answers 反嵌入、不复用前缀的逐头 patch
+"""
+import time
+import math
+import types
+from functools import partial
+from typing import Callable, Dict, Optional
+
+import torch
+
+BACKENDS = ("compile", "trace")
+# 编译结果与 eager 的 logits diff 允许的误差 (atol, rtol)；低精度 autocast 下两条路径的累加顺序不同，放宽
+TOLERANCE = {torch.float32: (1e-3, 1e-3), torch.bfloat16: (1e-1, 5e-2), torch.float16: (5e-2, 1e-2)}
+
+
+def unsupported_reason(cfg) -> Optional[str]:
+    """编译路径手写了 GPT-2 的前向，其他结构不支持"""
+    if cfg.normalization_type != "LNPre":
+        return f"normalization_type={cfg.normalization_type}（需要 fold_ln 后的 LNPre）"
+    if cfg.act_fn != "gelu_new":
+        return f"act_fn={cfg.act_fn}"
+    if cfg.positional_embedding_type != "standard":
+        return f"positional_embedding_type={cfg.positional_embedding_type}"
+    return None
+
+
+def _ln_pre(x, eps: float):
+    x = x - x.mean(dim=-1, keepdim=True)
+    return x / (x.pow(2).mean(dim=-1, keepdim=True) + eps).sqrt()
+
+
+def patched_forward(w: Dict[str, torch.Tensor], tokens, head_mask, replacement, ans_a, ans_b,
+                    n_layers: int, eps: float, attn_scale: float):
+    """
+    tokens: [rows, seq]，head_mask: [rows, n_layers, n_heads]，replacement: [n_layers, seq, n_heads, d_head]
+    返回每行的 logits[ans_a] - logits[ans_b]（只对最后位置做 ln_final 与两列反嵌入）
+    """
+    seq = tokens.shape[1]
+    resid = w["W_E"][tokens] + w["W_pos"][:seq]
+    causal = torch.ones(seq, seq, dtype=torch.bool, device=tokens.device).tril()
+    for layer in range(n_layers):
+        x = _ln_pre(resid, eps)
+        q = torch.einsum("bpm,hmd->bphd", x, w["W_Q"][layer]) + w["b_Q"][layer]
+        k = torch.einsum("bpm,hmd->bphd", x, w["W_K"][layer]) + w["b_K"][layer]
+        v = torch.einsum("bpm,hmd->bphd", x, w["W_V"][layer]) + w["b_V"][layer]
+        scores = torch.einsum("bqhd,bkhd->bhqk", q, k) / attn_scale
+        pattern = scores.masked_fill(~causal, float("-inf")).softmax(dim=-1)
+        z = torch.einsum("bhqk,bkhd->bqhd", pattern, v)
+        z = torch.where(head_mask[:, layer, None, :, None], replacement[layer].to(z.dtype), z)
+        resid = resid + torch.einsum("bqhd,hdm->bqm", z, w["W_O"][layer]) + w["b_O"][layer]
+        x = _ln_pre(resid, eps)
+        pre = torch.einsum("bpm,mn->bpn", x, w["W_in"][layer]) + w["b_in"][layer]
+        act = 0.5 * pre * (1.0 + torch.tanh(math.sqrt(2.0 / math.pi) * (pre + 0.044715 * pre.pow(3))))
+        resid = resid + torch.einsum("bpn,nm->bpm", act, w["W_out"][layer]) + w["b_out"][layer]
+    x = _ln_pre(resid[:, -1], eps)
+    return x @ (w["W_U"][:, ans_a] - w["W_U"][:, ans_b]) + (w["b_U"][ans_a] - w["b_U"][ans_b])
+
+
+class CompiledPatcher:
+    """
+    __call__(tokens [1, seq], replacement_z, patches, ans_a, ans_b) 与 run_head_patches 的结果相同
+    rows 为每次前向的行数（不足时补齐）；eager(tokens, replacement_z, patches, ans_a, ans_b) 用于首次调用时的对照
+    """
+
+    def __init__(self, model, rows: int, backend: str = "compile", eager: Optional[Callable] = None):
+        if backend not in BACKENDS:
+            raise ValueError(f"未知的编译方式: {backend}（可选 {', '.join(BACKENDS)}）")
+        if backend == "compile" and not hasattr(torch, "compile"):
+            print("[WARN] 当前 torch 没有 torch.compile，改用 torch.jit.trace")
+            backend = "trace"
+        cfg = model.cfg
+        self.model, self.rows, self.backend, self.eager = model, rows, backend, eager
+        self.n_layers, self.n_heads = cfg.n_layers, cfg.n_heads
+        self.weights = {name: getattr(model, name) for name in
+                        ("W_E", "W_pos", "W_Q", "W_K", "W_V", "b_Q", "b_K", "b_V", "W_O", "b_O",
+                         "W_in", "b_in", "W_out", "b_out", "W_U", "b_U")}
+        self.fn = partial(patched_forward, n_layers=cfg.n_layers, eps=cfg.eps,
+                          attn_scale=math.sqrt(cfg.d_head) if cfg.use_attn_scale else 1.0)
+        self.buckets: Dict[int, Callable] = {}
+        self.fallback = set()
+        self.mismatch: Dict[int, float] = {}
+        self.stats: Dict[int, Dict] = {}
+
+    def _compile(self, example):
+        if self.backend == "compile":
+            # 每个桶一个独立的 code object，重编译计数互不累加
+            fresh = types.FunctionType(patched_forward.__code__.replace(), patched_forward.__globals__, patched_forward.__name__)
+            return torch.compile(partial(fresh, **self.fn.keywords), dynamic=False)
+        # trace 需要位置参数：权重按固定顺序展开
+        names = list(self.weights)
+
+        def flat(*args):
+            return self.fn(dict(zip(names, args[:len(names)])), *args[len(names):])
+        return torch.jit.trace(flat, tuple(self.weights[n] for n in names) + example, check_trace=False)
+
+    def _call(self, fn, args):
+        if self.backend == "compile":
+            return fn(self.weights, *args)
+        return fn(*self.weights.values(), *args)
+
+    def __call__(self, tokens, replacement_z, patches, ans_a, ans_b):
+        seq = tokens.shape[-1]
+        mask = torch.zeros(self.rows, self.n_layers, self.n_heads, dtype=torch.bool, device=tokens.device)
+        for r, (layer, head) in enumerate(patches):
+            mask[r, layer, head] = True
+        args = (tokens.reshape(1, -1).expand(self.rows, -1), mask, replacement_z, ans_a, ans_b)
+        st = self.stats.get(seq)
+        if st is None:
+            # 新的形状桶：编译并计时（含首次前向），另跑一次 eager 作对照
+            t0 = time.time()
+            fn = self.buckets[seq] = self._compile(args)
+            frames = _compiled_frames()
+            out = self._call(fn, args)
+            st = self.stats[seq] = {"compile_s": time.time() - t0, "calls": 0, "run_s": 0.0, "eager_s": None}
+            if frames is not None and _compiled_frames() == frames:
+                print(f"[WARN] seq={seq} 的前向没有生成编译图（已退回 eager），报告中标为 fallback")
+                self.fallback.add(seq)
+            out = out[:len(patches)]
+            if self.eager is not None:
+                t0 = time.time()
+                ref = self.eager(tokens, replacement_z, patches, ans_a, ans_b)
+                st["eager_s"] = time.time() - t0
+                atol, rtol = TOLERANCE.get(ref.dtype, TOLERANCE[torch.float32])
+                if not torch.allclose(out.to(ref.dtype), ref, atol=atol, rtol=rtol):
+                    diff = self.mismatch[seq] = float((out.to(ref.dtype) - ref).abs().max())
+                    print(f"[WARN] 编译路径 seq={seq} 的 logits diff 与模型不一致（最大误差 {diff:.4g}，atol={atol}, rtol={rtol}），"
+                          f"手写前向可能与模型结构不符；该长度改用 eager")
+                    self.fallback.add(seq)
+                    return ref
+            return out
+        t0 = time.time()
+        if seq in self.mismatch:
+            out = self.eager(tokens, replacement_z, patches, ans_a, ans_b)
+            st["calls"] += 1
+            st["run_s"] += time.time() - t0
+            return out
+        out = self._call(self.buckets[seq], args)
+        st["calls"] += 1
+        st["run_s"] += time.time() - t0
+        return out[:len(patches)]
+
+    def report(self) -> Dict:
+        """每个桶：编译耗时（扣除一次前向）、eager 与编译后每次前向的耗时、加速比、回本所需前向次数"""
+        buckets = {}
+        for seq, st in sorted(self.stats.items()):
+            per_fwd = st["run_s"] / st["calls"] if st["calls"] else None
+            compile_s = st["compile_s"] - (per_fwd or 0.0)
+            entry = {"compile_s": round(compile_s, 3), "forwards": st["calls"] + 1, "fallback": seq in self.fallback,
+                     "max_abs_diff": self.mismatch.get(seq),
+                     "compiled_forward_ms": round(per_fwd * 1000, 3) if per_fwd is not None else None,
+                     "eager_forward_ms": round(st["eager_s"] * 1000, 3) if st["eager_s"] is not None else None}
+            if per_fwd is not None and st["eager_s"] is not None and seq not in self.fallback:
+                gain = st["eager_s"] - per_fwd
+                entry["speedup"] = round(st["eager_s"] / per_fwd, 3) if per_fwd > 0 else None
+                entry["breakeven_forwards"] = math.ceil(compile_s / gain) if gain > 0 else None
+            buckets[str(seq)] = entry
+        total_compile = sum(b["compile_s"] for b in buckets.values())
+        return {"backend": self.backend, "rows": self.rows, "buckets": buckets, "compile_s": round(total_compile, 3),
+                "fallback": sorted(self.fallback), "mismatch": sorted(self.mismatch)}
+
+
+def _compiled_frames() -> Optional[int]:
+    """dynamo 已编译的帧数；取不到（trace 后端或旧版 torch）时为 None"""
+    try:
+        from torch._dynamo.utils import counters
+    except ImportError:
+        return None
+    return counters["stats"]["unique_graphs"]
@@ -0,0 +1,224 @@
+"""
+IOI 运行历史库（SQLite）
+每次编排器运行追加一条记录：配置、git 版本、数据规模与各环节计时，
+供 compare_reports.py 做趋势/分位数统计与性能回归检测
+"""
+import os
+import json
+import math
+import sqlite3
+import subprocess
+import time
+from itertools import combinations
+from typing import Dict, List, Optional
+
+DEFAULT_DB = "ioi_history.db"
+
+# 编排器中的环节（与 timing_report 的键前缀一致）
+STAGES = [
+    ("generate_data", "生成数据"),
+    ("check_structure", "结构校验"),
+    ("filter_gpt2", "GPT-2样本筛选"),
+    ("collect_activations", "缓存激活值"),
+    ("patch_activations", "修补激活值"),
+    ("plot_heatmap", "绘制热力图"),
+]
+METRICS = ["time", "wall_time", "upload_time", "download_time", "total_time"]
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    timestamp TEXT NOT NULL,
+    config_path TEXT,
+    mode TEXT,
+    git_revision TEXT,
+    dataset_size INTEGER,
+    config_json TEXT,
+    report_json TEXT
+);
+CREATE TABLE IF NOT EXISTS stage_timings (
+    run_id INTEGER NOT NULL REFERENCES runs(id),
+    stage TEXT NOT NULL,
+    metric TEXT NOT NULL,
+    value REAL NOT NULL,
+    location TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_stage_timings ON stage_timings(stage, metric);
+"""
+
+
+def git_revision() -> str:
+    try:
+        out = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True)
+        dirty = subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"], capture_output=True, text=True).stdout.strip()
+        return out.stdout.strip() + ("-dirty" if dirty else "")
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def connect(db_path: str = DEFAULT_DB) -> sqlite3.Connection:
+    conn = sqlite3.connect(db_path)
+    conn.row_factory = sqlite3.Row
+    conn.executescript(SCHEMA)
+    return conn
+
+
+def stage_total(report: Dict, stage: str) -> Optional[float]:
+    """
+    单个环节的总耗时：优先墙上时间（本地/远端口径一致，含进程启动与通信），
+    旧报告没有墙上时间时退化为 _total_time（远端计算+通信），再退化为 _time
+    """
+    for suffix in ("_wall_time", "_total_time", "_time"):
+        v = report.get(stage + suffix)
+        if isinstance(v, (int, float)):
+            return float(v)
+    return None
+
+
+def report_total(report: Dict) -> Optional[float]:
+    vals = [stage_total(report, stage) for stage, _ in STAGES]
+    vals = [v for v in vals if v is not None]
+    return sum(vals) if vals else None
+
+
+def record_run(db_path: str, config_path: str, cfg: Dict, report: Dict,
+               dataset_size: Optional[int] = None) -> int:
+    """追加一次运行，返回 run id"""
+    mode = os.path.splitext(os.path.basename(config_path))[0]
+    conn = connect(db_path)
+    try:
+        # 配置中的密码不入库
+        safe_cfg = json.loads(json.dumps(cfg))
+        if isinstance(safe_cfg.get("ssh"), dict) and safe_cfg["ssh"].get("password"):
+            safe_cfg["ssh"]["password"] = "***"
+        cur = conn.execute(
+            "INSERT INTO runs (timestamp, config_path, mode, git_revision, dataset_size, config_json, report_json) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (time.strftime("%Y-%m-%dT%H:%M:%S"), config_path, mode, git_revision(), dataset_size,
+             json.dumps(safe_cfg, ensure_ascii=False), json.dumps(report, ensure_ascii=False)),
+        )
+        run_id = cur.lastrowid
+        rows = []
+        for stage, _ in STAGES:
+            location = report.get(f"{stage}_location")
+            for metric in METRICS:
+                v = report.get(f"{stage}_{metric}")
+                if isinstance(v, (int, float)):
+                    rows.append((run_id, stage, metric, float(v), location))
+            total = stage_total(report, stage)
+            if total is not None:
+                rows.append((run_id, stage, "stage_total", total, location))
+        conn.executemany("INSERT INTO stage_timings VALUES (?, ?, ?, ?, ?)", rows)
+        conn.commit()
+        return run_id
+    finally:
+        conn.close()
+
+
+def list_runs(db_path: str, mode: Optional[str] = None, limit: Optional[int] = None) -> List[dict]:
+    """按时间顺序返回运行记录（最新的 limit 条）"""
+    conn = connect(db_path)
+    try:
+        sql = "SELECT id, timestamp, mode, git_revision, dataset_size FROM runs"
+        args: list = []
+        if mode:
+            sql += " WHERE mode = ?"
+            args.append(mode)
+        sql += " ORDER BY id DESC"
+        if limit:
+            sql += " LIMIT ?"
+            args.append(limit)
+        return [dict(r) for r in conn.execute(sql, args)][::-1]
+    finally:
+        conn.close()
+
+
+def stage_series(db_path: str, stage: str, metric: str = "stage_total",
+                 run_ids: Optional[List[int]] = None) -> List[dict]:
+    """某环节某指标的时间序列：[{run_id, git_revision, value}]"""
+    conn = connect(db_path)
+    try:
+        sql = ("SELECT r.id AS run_id, r.git_revision, r.dataset_size, s.value FROM stage_timings s "
+               "JOIN runs r ON r.id = s.run_id WHERE s.stage = ? AND s.metric = ?")
+        args: list = [stage, metric]
+        if run_ids is not None:
+            if not run_ids:
+                return []
+            sql += f" AND r.id IN ({','.join('?' * len(run_ids))})"
+            args += list(run_ids)
+        sql += " ORDER BY r.id"
+        return [dict(r) for r in conn.execute(sql, args)]
+    finally:
+        conn.close()
+
+
+def percentile(values: List[float], q: float) -> float:
+    """线性插值分位数（q ∈ [0, 100]）"""
+    xs = sorted(values)
+    if not xs:
+        return float("nan")
+    pos = (len(xs) - 1) * q / 100
+    lo = int(pos)
+    hi = min(lo + 1, len(xs) - 1)
+    return xs[lo] + (xs[hi] - xs[lo]) * (pos - lo)
+
+
+def mann_whitney_greater(candidate: List[float], baseline: List[float]) -> float:
+    """
+    单侧 Mann-Whitney U 检验 p 值，H1: candidate 的耗时整体大于 baseline
+    组合数不超过 20000 时用精确置换分布，否则用带 tie 修正的正态近似
+    """
+    n1, n2 = len(candidate), len(baseline)
+    if n1 == 0 or n2 == 0:
+        return 1.0
+
+    def u_stat(c, b):
+        return sum(1.0 if x > y else 0.5 if x == y else 0.0 for x in c for y in b)
+
+    u = u_stat(candidate, baseline)
+    pooled = list(candidate) + list(baseline)
+    n = n1 + n2
+    if math.comb(n, n1) <= 20000:
+        ge = total = 0
+        for idx in combinations(range(n), n1):
+            chosen = set(idx)
+            c = [pooled[i] for i in idx]
+            b = [pooled[i] for i in range(n) if i not in chosen]
+            total += 1
+            if u_stat(c, b) >= u - 1e-12:
+                ge += 1
+        return ge / total
+    counts: Dict[float, int] = {}
+    for v in pooled:
+        counts[v] = counts.get(v, 0) + 1
+    tie = sum(t ** 3 - t for t in counts.values())
+    sigma = math.sqrt(n1 * n2 / 12 * ((n + 1) - tie / (n * (n - 1))))
+    if sigma == 0:
+        return 1.0
+    z = (u - n1 * n2 / 2 - 0.5) / sigma
+    return 0.5 * math.erfc(z / math.sqrt(2))
+
+
+def detect_regressions(db_path: str, baseline_ids: List[int], candidate_ids: List[int],
+                       metric: str = "stage_total", alpha: float = 0.05, min_slowdown: float = 0.05) -> List[dict]:
+    """
+    逐环节比较 candidate 与 baseline 两组运行
+    同时满足 p < alpha 且中位数变慢超过 min_slowdown 才判定为回归
+    """
+    findings = []
+    for stage, name in STAGES:
+        base = [r["value"] for r in stage_series(db_path, stage, metric, baseline_ids)]
+        cand = [r["value"] for r in stage_series(db_path, stage, metric, candidate_ids)]
+        if not base or not cand:
+            continue
+        base_med, cand_med = percentile(base, 50), percentile(cand, 50)
+        change = cand_med / base_med - 1 if base_med > 0 else 0.0
+        p = mann_whitney_greater(cand, base)
+        findings.append({
+            "stage": stage, "name": name,
+            "baseline_n": len(base), "candidate_n": len(cand),
+            "baseline_median": base_med, "candidate_median": cand_med,
+            "change": change, "p_value": p,
+            "regression": p < alpha and change > min_slowdown,
+        })
+    return findings
@@ -7,16 +7,16 @@ import random
 import argparse
 
 
-def generate_data() -> Tuple[List[Dict], float]:
+def generate_data(num_samples: int = 50, output_file: str = 'data.json', seed: int = 42) -> Tuple[List[Dict], float]:
     t0 = time.time()
-    random.seed(42)
+    random.seed(seed)
     with open('names.json', 'r', encoding='utf-8') as f:
         names = json.load(f)
     with open('sentences.json', 'r', encoding='utf-8') as f:
         sentences = json.load(f)
 
     results = []
-    for _ in range(50):
+    for _ in range(num_samples):
         name_pair = random.choice(names)
         sp = random.choice(sentences)
         clean = sp["clean"].replace("A ", name_pair["A"] + " ").replace("B ", name_pair["B"] + " ")
@@ -29,14 +29,14 @@ def generate_data() -> Tuple[List[Dict], float]:
             "clean_answer": clean_answer,
             "corrupted_answer": corrupted_answer
         })
-    with open('data.json', 'w', encoding='utf-8') as f:
+    with open(output_file, 'w', encoding='utf-8') as f:
         json.dump(results, f, indent=2)
     duration = time.time() - t0
-    print(f"[OK] 生成数据 data.json 共 {len(results)} 条，用时 {duration:.3f}s")
+    print(f"[OK] 生成数据 {output_file} 共 {len(results)} 条，用时 {duration:.3f}s")
     return results, duration
 
 
-def check_sentence_structure(data: List[Dict]) -> Tuple[List[Dict], float]:
+def check_sentence_structure(data: List[Dict], output_file: str = 'data_check1.json') -> Tuple[List[Dict], float]:
     t0 = time.time()
     checked = []
     clean_pattern = r"After (.+?) and (.+?) (.+?), \1 (.+?) to"
@@ -57,10 +57,10 @@ def check_sentence_structure(data: List[Dict]) -> Tuple[List[Dict], float]:
         if " " + a1 != item["corrupted_answer"] or " " + b1 != item["clean_answer"]:
             continue
         checked.append(item)
-    with open('data_check1.json', 'w', encoding='utf-8') as f:
+    with open(output_file, 'w', encoding='utf-8') as f:
         json.dump(checked, f, indent=2)
     duration = time.time() - t0
-    print(f"[OK] 结构校验 data_check1.json 保留 {len(checked)}/{len(data)} 条，用时 {duration:.3f}s")
+    print(f"[OK] 结构校验 {output_file} 保留 {len(checked)}/{len(data)} 条，用时 {duration:.3f}s")
     return checked, duration
 
 
@@ -0,0 +1,132 @@
+"""
+IOI 前向结果的跨环节备忘（SQLite，LRU 淘汰）
+以 (模型与处理方式标识, 结果类型, token 序列等) 的哈希为键，保存：
+- last_logits：prompt 最后位置的 logits（filter 写入，filter/collect 读取）
+- clean_z：clean prompt 的 hook_z 与最后位置的最终 LayerNorm 缩放（collect，可选）
+- patch：单个样本逐头 patch 后的 logits diff（patch）
+重复 prompt 只需一次查询而不是一次前向；库文件跨环节、跨运行保留，总大小超过上限时淘汰最久未用的条目
+只依赖标准库，张量的序列化在用到时才导入 torch；随 ioi_modules.py 一同上传到远端
+"""
+import io
+import time
+import sqlite3
+import hashlib
+from array import array
+from typing import Dict
+
+DEFAULT_DB = "ioi_memo.db"
+MB = 1024 * 1024
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS memo (
+    key TEXT PRIMARY KEY,
+    kind TEXT NOT NULL,
+    value BLOB NOT NULL,
+    size INTEGER NOT NULL,
+    last_used REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_memo_lru ON memo(last_used);
+"""
+
+
+def model_identity(model) -> str:
+    """模型与权重处理方式的标识：不同模型、精度或 LayerNorm 折叠方式的结果互不命中"""
+    cfg = model.cfg
+    return "|".join(str(x) for x in (cfg.model_name, cfg.dtype, cfg.normalization_type, cfg.n_layers, cfg.d_model, cfg.d_vocab))
+
+
+def memo_key(identity: str, kind: str, *parts) -> str:
+    """parts 可以是张量（按 token id 序列）、字符串或数字"""
+    h = hashlib.sha1(f"{identity}\x00{kind}".encode("utf-8"))
+    for part in parts:
+        if hasattr(part, "reshape"):
+            h.update(b"\x01" + array("q", part.reshape(-1).tolist()).tobytes())
+        else:
+            h.update(b"\x02" + str(part).encode("utf-8"))
+    return h.hexdigest()
+
+
+def dumps(obj) -> bytes:
+    import torch
+    buf = io.BytesIO()
+    torch.save(obj, buf)
+    return buf.getvalue()
+
+
+def loads(data: bytes):
+    import torch
+    return torch.load(io.BytesIO(data), map_location="cpu")
+
+
+class ForwardMemo:
+    """
+    get/put 以 memo_key 生成的键存取张量；按类型统计命中率
+    max_mb 为库中结果的总大小上限，超出时按 last_used 从旧到新淘汰
+    """
+
+    def __init__(self, db_path: str = DEFAULT_DB, max_mb: float = 1024, identity: str = ""):
+        self.db_path = db_path
+        self.max_bytes = int(max_mb * MB)
+        self.identity = identity
+        self.conn = sqlite3.connect(db_path)
+        self.conn.executescript(SCHEMA)
+        self.total_bytes = self.conn.execute("SELECT COALESCE(SUM(size), 0) FROM memo").fetchone()[0]
+        self.counts: Dict[str, Dict[str, int]] = {}
+        self.evictions = 0
+
+    def key(self, kind: str, *parts) -> str:
+        return memo_key(self.identity, kind, *parts)
+
+    def _count(self, kind: str, field: str, n: int = 1):
+        c = self.counts.setdefault(kind, {"hits": 0, "misses": 0, "puts": 0})
+        c[field] += n
+
+    def get(self, kind: str, *parts):
+        key = self.key(kind, *parts)
+        row = self.conn.execute("SELECT value FROM memo WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            self._count(kind, "misses")
+            return None
+        self.conn.execute("UPDATE memo SET last_used = ? WHERE key = ?", (time.time(), key))
+        self._count(kind, "hits")
+        return loads(row[0])
+
+    def record_hits(self, kind: str, n: int):
+        """同一次运行内重复的 prompt 直接复用首次的结果，也计为命中"""
+        if n:
+            self._count(kind, "hits", n)
+
+    def put(self, kind: str, value, *parts):
+        key = self.key(kind, *parts)
+        data = dumps(value)
+        old = self.conn.execute("SELECT size FROM memo WHERE key = ?", (key,)).fetchone()
+        if old is not None:
+            self.total_bytes -= old[0]
+        self.conn.execute("INSERT OR REPLACE INTO memo VALUES (?, ?, ?, ?, ?)", (key, kind, data, len(data), time.time()))
+        self.total_bytes += len(data)
+        self._count(kind, "puts")
+        if self.total_bytes > self.max_bytes:
+            self._evict()
+
+    def _evict(self):
+        """淘汰最久未用的条目，直到总大小回到上限的 90% 以下（避免每次 put 都触发淘汰）"""
+        target = int(self.max_bytes * 0.9)
+        victims = []
+        for key, size in self.conn.execute("SELECT key, size FROM memo ORDER BY last_used"):
+            if self.total_bytes <= target:
+                break
+            victims.append((key,))
+            self.total_bytes -= size
+        self.conn.executemany("DELETE FROM memo WHERE key = ?", victims)
+        self.evictions += len(victims)
+
+    def stats(self) -> dict:
+        hits = sum(c["hits"] for c in self.counts.values())
+        lookups = hits + sum(c["misses"] for c in self.counts.values())
+        entries = self.conn.execute("SELECT COUNT(*) FROM memo").fetchone()[0]
+        return {"path": self.db_path, "hits": hits, "lookups": lookups, "hit_rate": hits / lookups if lookups else 0.0,
+                "by_kind": self.counts, "entries": entries, "size_mb": self.total_bytes / MB, "evictions": self.evictions}
+
+    def close(self):
+        self.conn.commit()
+        self.conn.close()
@@ -0,0 +1,127 @@
+"""
+IOI 项目的内存统计与按内存预算选择 batch size
+- 峰值 RSS：Linux 下通过 /proc/self/clear_refs 重置 VmHWM，可按环节统计
+- 张量内存：CUDA 上取 max_memory_allocated；CPU 上 PyTorch 不提供分配器峰值，记录环节保留的张量字节数
+只依赖标准库，torch 已被导入时才读取其统计；随 ioi_modules.py 一同上传到远端
+"""
+import sys
+import time
+from typing import Optional
+
+MB = 1024 * 1024
+
+
+def reset_peak_rss() -> bool:
+    """重置进程的峰值 RSS（Linux: 向 /proc/self/clear_refs 写 5 会清零 VmHWM）"""
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+
+def _proc_status_mb(field: str) -> Optional[float]:
+    try:
+        with open("/proc/self/status", "r") as f:
+            for line in f:
+                if line.startswith(field + ":"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return None
+
+
+def current_rss_mb() -> float:
+    rss = _proc_status_mb("VmRSS")
+    if rss is not None:
+        return rss
+    return peak_rss_mb()
+
+
+def peak_rss_mb() -> float:
+    """峰值 RSS（MB）；无 /proc 时退化为 ru_maxrss（进程生命周期内的峰值）"""
+    hwm = _proc_status_mb("VmHWM")
+    if hwm is not None:
+        return hwm
+    import resource
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / MB if sys.platform == "darwin" else rss / 1024
+
+
+def _torch():
+    return sys.modules.get("torch")
+
+
+def tensor_mb(obj) -> float:
+    """递归统计 list/tuple/dict 中张量占用的字节数（MB）"""
+    torch = _torch()
+    if torch is None:
+        return 0.0
+    if isinstance(obj, torch.Tensor):
+        return obj.numel() * obj.element_size() / MB
+    if isinstance(obj, dict):
+        return sum(tensor_mb(v) for v in obj.values())
+    if isinstance(obj, (list, tuple)):
+        return sum(tensor_mb(v) for v in obj)
+    return 0.0
+
+
+class MemoryTracker:
+    """统计一个环节内的峰值 RSS 与 CUDA 峰值显存"""
+
+    def __enter__(self):
+        self.peak_reset = reset_peak_rss()
+        self.rss_start_mb = current_rss_mb()
+        torch = _torch()
+        self.cuda = torch is not None and torch.cuda.is_available()
+        if self.cuda:
+            torch.cuda.reset_peak_memory_stats()
+        self.t0 = time.time()
+        return self
+
+    def __exit__(self, *exc):
+        self.peak_mb = peak_rss_mb()
+        self.rss_end_mb = current_rss_mb()
+        torch = _torch()
+        self.cuda_peak_mb = torch.cuda.max_memory_allocated() / MB if self.cuda else None
+        return False
+
+    def report(self) -> dict:
+        rep = {
+            "peak_rss_mb": self.peak_mb,
+            "rss_start_mb": self.rss_start_mb,
+            "rss_end_mb": self.rss_end_mb,
+            # 无法重置 VmHWM 时峰值覆盖整个进程生命周期
+            "peak_rss_scope": "stage" if self.peak_reset else "process",
+        }
+        if self.cuda_peak_mb is not None:
+            rep["cuda_peak_mb"] = self.cuda_peak_mb
+        return rep
+
+
+def forward_row_bytes(cfg, seq_len: int, logit_positions: Optional[int] = None, cached_z: bool = False) -> int:
+    """
+    估算一行（一条序列）无梯度前向的峰值工作集（字节，fp32）
+    logit_positions: 需要完整词表 logits 的位置数（默认每个位置都算）
+    cached_z: 是否通过 run_with_cache 保留所有层的 hook_z
+    """
+    logit_positions = seq_len if logit_positions is None else logit_positions
+    d_mlp = cfg.d_mlp or 4 * cfg.d_model
+    per_layer = seq_len * (6 * cfg.d_model + 2 * d_mlp) + 3 * cfg.n_heads * seq_len * seq_len
+    total = per_layer + logit_positions * cfg.d_vocab
+    if cached_z:
+        total += cfg.n_layers * seq_len * cfg.n_heads * cfg.d_head
+    return total * 4
+
+
+def pick_batch_size(budget_mb: float, row_bytes: int, reserved_mb: float, max_batch: int,
+                    safety: float = 1.5) -> int:
+    """
+    在内存预算内可容纳的最大 batch
+    reserved_mb: 已占用（模型、输入数据）与环节需保留输出的内存
+    """
+    available = (budget_mb - reserved_mb) * MB
+    if available <= 0:
+        return 1
+    return int(max(1, min(max_batch, available // (row_bytes * safety))))
@@ -1,200 +1,1348 @@
 """
 IOI 项目的独立模块：每个GPU密集环节可单独调用并返回计时
 与 IOI.ipynb 逻辑完全一致
+重量级依赖按环节在函数内导入：plot 不加载 transformer_lens，模型环节不加载 seaborn
 """
 import os
 # 强制使用本地缓存，不联网下载
 os.environ["HF_HUB_OFFLINE"] = "1"
 os.environ["TRANSFORMERS_OFFLINE"] = "1"
 
+import sys
 import json
 import time
-import torch
+_IMPORT_T0 = time.time()
 import gc
 import random
+import hashlib
+import importlib
 from functools import partial
-from tqdm import tqdm
-from transformer_lens import HookedTransformer, utils
-from jaxtyping import Float
-from torch import Tensor
-import matplotlib.pyplot as plt
-import seaborn as sns
 import argparse
+from ioi_memo import ForwardMemo, model_identity
+from ioi_memory import MB, MemoryTracker, current_rss_mb, forward_row_bytes, pick_batch_size, tensor_mb
+from ioi_trace import enable_tracing, now_us, span
 
+# 各环节实际用到的重量级模块（按导入顺序，后者的耗时不含前者已导入的部分）
+STAGE_DEPS = {
+    "filter": ["torch", "tqdm", "transformer_lens"],
+    "collect": ["torch", "tqdm", "transformer_lens"],
+    "patch": ["torch", "tqdm", "transformer_lens"],
+    "plot": ["torch", "matplotlib.pyplot", "seaborn"],
+    "stats": ["torch"],
+    "dla": ["torch", "transformer_lens"],
+    "circuit": ["torch", "transformer_lens"],
+}
+# 本进程中各模块的导入耗时（秒）
+IMPORT_COSTS = {}
 
-def load_model_safely(device="cpu"):
+
+def import_stage_deps(task: str) -> dict:
+    """按环节导入依赖并记录耗时；已导入的模块不重复计时"""
+    for name in STAGE_DEPS[task]:
+        if name in sys.modules:
+            continue
+        t0 = time.time()
+        with span(f"import:{name}"):
+            importlib.import_module(name)
+        IMPORT_COSTS[name] = time.time() - t0
+    return {name: IMPORT_COSTS.get(name, 0.0) for name in STAGE_DEPS[task]}
+
+
+def load_model_safely(device="cpu", model_name: str = None):
     """
     安全加载模型，优先使用本地缓存
+    model_name 默认取环境变量 IOI_MODEL（--model 设置），未设置时为 gpt2-small
     """
-    print(f"[日志] 加载 GPT-2 模型（离线模式）...")
+    import torch
+    from transformer_lens import HookedTransformer
+    model_name = model_name or os.environ.get("IOI_MODEL", "gpt2-small")
+    print(f"[日志] 加载 {model_name} 模型（离线模式）...")
     torch.set_grad_enabled(False)
     
     # 设置离线模式后，会自动从 ~/.cache/huggingface 查找
-    model = HookedTransformer.from_pretrained(
-        "gpt2-small",
-        center_unembed=True,
-        center_writing_weights=True,
-        fold_ln=True,
-        refactor_factored_attn_matrices=True,
-    )
-    model.to(device)
-    model.eval()
+    with span("load_model", device=device):
+        model = HookedTransformer.from_pretrained(
+            model_name,
+            center_unembed=True,
+            center_writing_weights=True,
+            fold_ln=True,
+            refactor_factored_attn_matrices=True,
+        )
+        model.to(device)
+        model.eval()
     print(f"[日志] 模型加载成功，设备: {device}")
     return model
 
 
-def filter_with_gpt2(input_file: str, output_file: str) -> dict:
+def length_batches(lengths, batch_size: int):
+    """
+    按 token 长度分桶后切成批次：批内序列等长，无需 padding，
+    结果与逐条前向完全一致。返回原始下标列表的生成器
+    """
+    buckets = {}
+    for idx, n in enumerate(lengths):
+        buckets.setdefault(n, []).append(idx)
+    for n in sorted(buckets):
+        idxs = buckets[n]
+        for s in range(0, len(idxs), batch_size):
+            yield idxs[s:s + batch_size]
+
+
+def open_memo(path: str, max_mb: float, model):
+    """path 为空时不启用备忘"""
+    if not path:
+        return None
+    return ForwardMemo(path, max_mb=max_mb, identity=model_identity(model))
+
+
+def close_memo(memo, result: dict) -> dict:
+    if memo is not None:
+        result["memo"] = memo.stats()
+        print(f"[日志] 前向备忘命中 {result['memo']['hits']}/{result['memo']['lookups']}（{result['memo']['hit_rate']:.1%}）")
+        memo.close()
+    return result
+
+
+def dedup_indices(keys):
+    """返回 (首次出现的下标, {重复下标: 首次出现的下标})"""
+    first, alias = {}, {}
+    for i, key in enumerate(keys):
+        if key in first:
+            alias[i] = first[key]
+        else:
+            first[key] = i
+    return list(first.values()), alias
+
+
+def greedy_next_tokens(model, token_list, batch_size: int = 1, desc: str = "Filter with GPT-2", memo=None):
+    """
+    对每条 prompt 取最后位置 logits 的 argmax，
+    等价于 generate(max_new_tokens=1, temperature=0, do_sample=False)
+    指定 memo 时最后位置的 logits 按 token 序列备忘，重复 prompt 不再前向
+    """
+    import torch
+    from tqdm import tqdm
+    out = [None] * len(token_list)
+    todo, alias = list(range(len(token_list))), {}
+    if memo is not None:
+        unique, alias = dedup_indices([memo.key("last_logits", t) for t in token_list])
+        memo.record_hits("last_logits", len(alias))
+        todo = []
+        for i in unique:
+            cached = memo.get("last_logits", token_list[i])
+            if cached is None:
+                todo.append(i)
+            else:
+                out[i] = model.to_string(cached.argmax())
+    with tqdm(total=len(token_list), desc=desc) as pbar:
+        pbar.update(len(token_list) - len(todo))
+        for batch in length_batches([token_list[i].shape[-1] for i in todo], batch_size):
+            idxs = [todo[b] for b in batch]
+            with span("forward", batch=len(idxs)), torch.no_grad():
+                tokens = torch.cat([token_list[i] for i in idxs], dim=0).to(model.cfg.device)
+                last_logits = model(tokens, return_type="logits")[:, -1]
+                next_tokens = last_logits.argmax(dim=-1)
+            for b, (i, tok) in enumerate(zip(idxs, next_tokens)):
+                out[i] = model.to_string(tok)
+                if memo is not None:
+                    memo.put("last_logits", last_logits[b].cpu(), token_list[i])
+            pbar.update(len(idxs))
+    for i, j in alias.items():
+        out[i] = out[j]
+    return out
+
+
+def load_records(path: str) -> list:
+    """读取样本：JSON 列表，或 ioi_stream_pre.py 输出的 JSONL（每行一条）"""
+    with open(path, 'r', encoding='utf-8') as f:
+        if path.endswith(".jsonl"):
+            return [json.loads(line) for line in f if line.strip()]
+        return json.load(f)
+
+
+def normalize_record(item: dict) -> dict:
+    """data_generator 的自由形式样本（normal/corrupted/normal_target/corrupted_target）转为流水线字段"""
+    if "normal" not in item:
+        return item
+    return {**item, "clean": item["normal"], "clean_answer": " " + item["normal_target"].strip(),
+            "corrupted_answer": " " + item["corrupted_target"].strip()}
+
+
+def target_tokens(model, text: str):
+    """目标短语的 token（不加 BOS），一维 LongTensor"""
+    return model.to_tokens(text, prepend_bos=False)[0].cpu()
+
+
+def append_targets(model, prompts, targets):
+    """
+    把每行的 prompt 与 target 拼接并在右侧补齐到同一长度
+    因果注意力下右侧补齐不影响前面的位置，teacher forcing 的结果与逐条前向一致
+    返回 tokens [rows, max_len] 与每行 prompt 长度
+    """
+    import torch
+    pad = model.tokenizer.eos_token_id if model.tokenizer is not None else 0
+    rows = [torch.cat([p.reshape(-1), t]) for p, t in zip(prompts, targets)]
+    tokens = torch.full((len(rows), max(r.shape[0] for r in rows)), pad, dtype=torch.long)
+    for r, row in enumerate(rows):
+        tokens[r, :row.shape[0]] = row
+    return tokens, [p.reshape(-1).shape[0] for p in prompts]
+
+
+def target_logprobs(logits, prompt_lens, targets):
+    """teacher forcing：每行 target 各 token 在前一位置的 log 概率之和"""
+    import torch
+    out = []
+    for r, (plen, tgt) in enumerate(zip(prompt_lens, targets)):
+        lp = logits[r, plen - 1:plen - 1 + tgt.shape[0]].log_softmax(dim=-1)
+        out.append(lp.gather(-1, tgt.to(lp.device)[:, None]).sum())
+    return torch.stack(out)
+
+
+def target_logprobs_resid(model, resid, prompt_lens, targets):
+    """同 target_logprobs，但输入为最终残差流，只在目标所在位置做 ln_final 与反嵌入"""
+    import torch
+    device = resid.device
+    rows = torch.cat([torch.full((t.shape[0],), r, dtype=torch.long) for r, t in enumerate(targets)]).to(device)
+    pos = torch.cat([torch.arange(p - 1, p - 1 + t.shape[0]) for p, t in zip(prompt_lens, targets)]).to(device)
+    x = model.ln_final(resid[rows, pos][:, None])
+    lp = model.unembed(x)[:, 0].log_softmax(dim=-1)
+    per_token = lp.gather(-1, torch.cat(targets).to(device)[:, None])[:, 0]
+    return torch.zeros(len(targets), dtype=per_token.dtype, device=device).index_add_(0, rows, per_token)
+
+
+def answer_logit_diff(model, resid, ans_a, ans_b):
+    """
+    只对最后位置做 ln_final，并只用两个答案列反嵌入：
+    logits[a] - logits[b] = ln(x) · (W_U[:, a] - W_U[:, b]) + (b_U[a] - b_U[b])
+    """
+    x = model.ln_final(resid[:, -1:])[:, 0]
+    return x @ (model.W_U[:, ans_a] - model.W_U[:, ans_b]) + (model.b_U[ans_a] - model.b_U[ans_b])
+
+
+def shared_prefix_len(a, b) -> int:
+    """两条 token 序列开头相同部分的长度；至少留一个 token 给后缀前向"""
+    a, b = a.reshape(-1), b.reshape(-1)
+    n = min(a.shape[0], b.shape[0])
+    diff = (a[:n] != b[:n]).nonzero()
+    return min(int(diff[0]) if len(diff) else n, n - 1)
+
+
+def known_positions(items) -> dict:
+    """数据自带 token 位置（ioi_stream_pre.py --tokenizer-aware）时返回各位置字段的张量，否则为 None"""
+    import torch
+    if not items or not all("s2_pos" in item for item in items):
+        return None
+    return {k: torch.tensor([item[k] for item in items]) for k in ("s1_pos", "io_pos", "s2_pos", "end_pos")}
+
+
+def prefix_kv_cache(model, prefix, keep_z: bool = False):
+    """
+    对共享前缀 [rows, p] 前向一次，返回冻结的 KV cache（后缀前向只读不追加），
+    keep_z=True 时同时返回前缀的 z [n_layers, rows, p, n_heads, d_head]
+    """
+    from transformer_lens.past_key_value_caching import HookedTransformerKeyValueCache
+    kv = HookedTransformerKeyValueCache.init_cache(model.cfg, model.cfg.device, prefix.shape[0])
+    z = None
+    with span("prefix_forward", rows=prefix.shape[0], pos=prefix.shape[1]):
+        if keep_z:
+            _, cache = model.run_with_cache(prefix, past_kv_cache=kv, return_type=None, names_filter=lambda n: n.endswith("hook_z"))
+            z = cache.stack_activation("z")
+        else:
+            model(prefix, past_kv_cache=kv, return_type=None)
+    kv.freeze()
+    return kv, z
+
+
+def tile_kv_cache(kv, repeats: int, interleave: bool = False):
+    """
+    把前缀 KV cache 扩展到 repeats 倍行数：单行前缀用 expand（不复制内存），
+    多行前缀按 [前缀0..B-1, 前缀0..B-1, ...] 或 interleave 时按 [前缀0 × repeats, 前缀1 × repeats, ...] 排列
+    """
+    from dataclasses import replace
+    def tile(t):
+        if t.shape[0] == 1:
+            return t.expand(repeats, *t.shape[1:])
+        return t.repeat_interleave(repeats, dim=0) if interleave else t.repeat(repeats, *[1] * (t.dim() - 1))
+    entries = [replace(e, past_keys=tile(e.past_keys), past_values=tile(e.past_values)) for e in kv.entries]
+    return replace(kv, entries=entries, previous_attention_mask=tile(kv.previous_attention_mask))
+
+
+def prefix_reuse_report(positions_computed: int, positions_full: int, prefix_lens) -> dict:
+    """前缀复用的统计：实际前向的 token 位置数与不复用时的对比"""
+    saved = positions_full - positions_computed
+    print(f"[日志] 前缀复用：前向 {positions_computed}/{positions_full} 个 token 位置，节省 {saved / max(positions_full, 1):.1%}")
+    return {"positions_computed": positions_computed, "positions_full": positions_full,
+            "saved_frac": saved / positions_full if positions_full else 0.0,
+            "mean_prefix_len": sum(prefix_lens) / len(prefix_lens) if prefix_lens else 0.0}
+
+
+def filter_decision(item: dict, ct: str, kt: str) -> bool:
+    """clean/corrupted 生成的 token 都与各自的答案吻合时保留"""
+    return (ct in item["clean_answer"] or item["clean_answer"] in ct) and \
+           (kt in item["corrupted_answer"] or item["corrupted_answer"] in kt)
+
+
+def filter_with_gpt2(input_file: str, output_file: str, model=None, batch_size: int = 1,
+                     memo_path: str = None, memo_max_mb: float = 1024, precision: str = "fp32", calib: int = 32) -> dict:
     """
     使用GPT-2筛选样本
+    batch_size > 1 时把等长 prompt 拼成一批前向
+    指定 memo_path 时最后位置的 logits 写入前向备忘（ioi_memo.py），供重复 prompt 与 collect 复用
+    precision="bf16" 时先在前 calib 条样本上对比 fp32 的保留判定，一致才以 bf16 前向（ioi_precision.py）；
+    低精度的 logits 不写入备忘
     """
+    import torch
+    from ioi_precision import autocast, precision_guard, same_decisions
     t0 = time.time()
     torch.set_grad_enabled(False)
     
-    model = load_model_safely(device="cpu")
+    if model is None:
+        model = load_model_safely(device="cpu")
     
-    with open(input_file, 'r', encoding='utf-8') as f:
-        data = json.load(f)
+    with span("read_input", path=input_file):
+        data = load_records(input_file)
+    
+    with span("tokenize"):
+        prompts = [model.to_tokens(item["clean"]) for item in data] + [model.to_tokens(item["corrupted"]) for item in data]
+    def calib_decisions(p):
+        n = min(calib, len(data))
+        with autocast(p, model.cfg.device):
+            out = greedy_next_tokens(model, prompts[:n] + prompts[len(data):len(data) + n], batch_size, desc=f"Calibrate {p}")
+        return [filter_decision(item, out[i], out[n + i]) for i, item in enumerate(data[:n])]
+    with span("precision_guard", precision=precision):
+        guard = precision_guard(calib_decisions, same_decisions, precision, "filter")
+    memo = open_memo(memo_path if guard["used"] == "fp32" else None, memo_max_mb, model)
+    with autocast(guard["used"], model.cfg.device):
+        generated = greedy_next_tokens(model, prompts, batch_size=batch_size, memo=memo)
     
     filtered = []
-    for item in tqdm(data, desc="Filter with GPT-2"):
-        with torch.no_grad():
-            cg = model.generate(item["clean"], max_new_tokens=1, temperature=0, do_sample=False, return_type="tokens")
-            kg = model.generate(item["corrupted"], max_new_tokens=1, temperature=0, do_sample=False, return_type="tokens")
-            ct = model.to_string(cg[0, -1])
-            kt = model.to_string(kg[0, -1])
-        
-        if (ct in item["clean_answer"] or item["clean_answer"] in ct) and \
-           (kt in item["corrupted_answer"] or item["corrupted_answer"] in kt):
+    for i, item in enumerate(data):
+        ct, kt = generated[i], generated[len(data) + i]
+        if filter_decision(item, ct, kt):
             item["clean_generated"] = ct
             item["corrupted_generated"] = kt
             filtered.append(item)
     
-    with open(output_file, 'w', encoding='utf-8') as f:
-        json.dump(filtered, f, indent=2)
+    with span("write_output", path=output_file):
+        with open(output_file, 'w', encoding='utf-8') as f:
+            json.dump(filtered, f, indent=2)
     
     elapsed = time.time() - t0
     print(f"[OK] GPT-2样本筛选完成，保留 {len(filtered)}/{len(data)} 条，用时 {elapsed:.3f}s -> {output_file}")
     
-    return { "time": elapsed, "filtered_count": len(filtered), "total_count": len(data) }
+    return close_memo(memo, { "time": elapsed, "filtered_count": len(filtered), "total_count": len(data), "precision": guard })
+
+
+def collect_hook_names(name: str) -> bool:
+    """collect 缓存的激活：各层 hook_z，以及 DLA 需要的最终 LayerNorm 缩放"""
+    return name.endswith("hook_z") or name == "ln_final.hook_scale"
+
+
+def pattern_names_filter(heads):
+    """在 collect_hook_names 之外再缓存选定头所在层的 hook_pattern"""
+    names = {f"blocks.{layer}.attn.hook_pattern" for layer, _ in heads}
+    return lambda name: collect_hook_names(name) or name in names
+
 
+def batch_patterns(cache, heads, rows=slice(None), seq=None):
+    """选定头的注意力模式 [batch, n_heads_selected, q, k]；rows/seq 选取批内的行与 prompt 范围"""
+    import torch
+    return torch.stack([cache[f"blocks.{layer}.attn.hook_pattern"][rows, head, :seq, :seq] for layer, head in heads], dim=1)
 
-def get_clean_activations(input_file: str, output_file: str) -> dict:
-    # ... (函数内容不变) ...
+
+def collect_meta(kept) -> dict:
+    """每个保留样本的模板与名字对（列式），patch 写入逐样本结果存储时使用"""
+    from ioi_results import record_meta
+    rows = [record_meta(item) for item in kept]
+    return {k: [r[k] for r in rows] for k in ("template", "name_a", "name_b")}
+
+
+def load_saved_data(path: str):
+    """读取 collect 产物；torch 支持时以 mmap 方式加载，激活值按需换入而不是整体读进内存"""
+    import torch
+    try:
+        return torch.load(path, map_location="cpu", mmap=True)
+    except (TypeError, RuntimeError):
+        return torch.load(path, map_location="cpu")
+
+
+def get_clean_activations(input_file: str, output_file: str, model=None, batch_size: int = 1,
+                          memory_budget_mb: float = None, target_mode: str = "first", prefix_reuse: bool = False,
+                          memo_path: str = None, memo_max_mb: float = 1024, memo_z: bool = False,
+                          pattern_file: str = None, pattern_heads=None, pattern_format: str = "fp16", pattern_k: int = 8) -> dict:
+    """
+    缓存 clean 前向的 hook_z 与 clean/corrupted 的 logits diff
+    指定 memory_budget_mb 时按预算选择 batch_size（需为全部样本的 clean_z 预留内存）
+    target_mode="multi" 时目标可以是多 token 短语：每个样本的 clean/corrupted prompt 各拼上两个目标，
+    在同一次批量前向中 teacher forcing 计算 log 概率之和，指标为两目标的 log 概率差
+    （单 token 目标时与 logits diff 相等）；自由形式数据（normal/normal_target）自动使用该模式
+    prefix_reuse=True 时 clean/corrupted 开头相同的部分（S2 之前）每个样本只前向一次，
+    后缀通过冻结的 KV cache 读取前缀的 key/value，前缀的 z 直接拼到后缀的 z 前面
+    指定 memo_path 时重复样本只前向一次；memo_z=True 时 clean_z 也写入备忘，
+    此时 clean/corrupted 的最后位置 logits（filter 已写入）与 clean_z 都命中的样本无需前向；多 token 目标不使用备忘
+    指定 pattern_file 时另存 pattern_heads（[(layer, head)]）在 clean prompt 上的注意力模式（ioi_patterns.py），
+    按 pattern_format 压缩（fp16 下三角 / 每行 top-k）；需要 clean 前向，因此不使用 clean_z 的备忘，也不复用前缀
+    """
+    import torch
+    from tqdm import tqdm
     t0 = time.time()
-    device = "cuda" if torch.cuda.is_available() else "cpu"
     torch.set_grad_enabled(False)
-    model = load_model_safely(device=device)
-    with open(input_file, 'r', encoding='utf-8') as f:
-        data = json.load(f)
+    if model is None:
+        model = load_model_safely(device="cuda" if torch.cuda.is_available() else "cpu")
+    device = model.cfg.device
+    with span("read_input", path=input_file):
+        data = [normalize_record(item) for item in load_records(input_file)]
+    if target_mode == "first" and data and "clean_generated" not in data[0]:
+        print("[日志] 数据没有 filter 生成的答案（自由形式数据），使用多 token 目标打分")
+        target_mode = "multi"
+    writer = None
+    if pattern_file and pattern_heads:
+        from ioi_patterns import PatternWriter
+        writer = PatternWriter(pattern_file, pattern_heads, pattern_format, pattern_k)
+        if prefix_reuse:
+            # 前缀位置的注意力模式在共享前缀的前向里，不在后缀的缓存中
+            print("[WARN] 保存注意力模式时不支持前缀复用，已忽略 --prefix-reuse")
+            prefix_reuse = False
+    if target_mode == "multi":
+        if memo_path:
+            # 备忘的 logits 是 filter 写入的最后位置 logits，多 token 目标的 teacher forcing 分数用不上
+            print("[WARN] 多 token 目标不支持前向备忘，已忽略 --memo/--memo-z")
+        return collect_multi_token(data, output_file, model, batch_size, t0, prefix_reuse, writer)
     def get_logits_diff(logits, token1, token2): return logits[token1] - logits[token2]
-    clean_z, clean_logits_diffs, corrupted_logits_diffs = [], [], []
-    clean_sentences, corrupted_sentences, clean_answers, corrupted_answers = [], [], [], []
-    for item in tqdm(data, desc="Collect activations"):
-        clean_tokens = model.to_tokens(item["clean"]).to(device)
-        corrupted_tokens = model.to_tokens(item["corrupted"]).to(device)
-        if clean_tokens.shape != corrupted_tokens.shape: continue
-        clean_ans = model.to_tokens(item["clean_generated"])[0][1].to(device)
-        corrupt_ans = model.to_tokens(item["corrupted_generated"])[0][1].to(device)
-        with torch.no_grad():
-            corrupted_logits, corrupted_cache = model.run_with_cache(corrupted_tokens, names_filter=lambda n: n.endswith("hook_z"), remove_batch_dim=True)
-            clean_logits, clean_cache = model.run_with_cache(clean_tokens, names_filter=lambda n: n.endswith("hook_z"), remove_batch_dim=True)
-        cld = get_logits_diff(clean_logits[0][-1], clean_ans, corrupt_ans)
-        cod = get_logits_diff(corrupted_logits[0][-1], clean_ans, corrupt_ans)
-        clean_logits_diffs.append(cld); corrupted_logits_diffs.append(cod)
-        clean_z.append(clean_cache.stack_activation("z").cpu())
-        clean_sentences.append(clean_tokens.cpu()); corrupted_sentences.append(corrupted_tokens.cpu())
-        clean_answers.append(clean_ans.cpu()); corrupted_answers.append(corrupt_ans.cpu())
-        del clean_cache, corrupted_cache, clean_logits, corrupted_logits
-        torch.cuda.empty_cache()
+    # 先分词并剔除 clean/corrupted 长度不一致的样本，再按长度分批
+    # （ioi_stream_pre.py --tokenizer-aware 生成的数据在生成时已保证等长，这里不会再剔除）
+    pairs, kept = [], []
+    with span("tokenize"):
+        for item in data:
+            clean_tokens = model.to_tokens(item["clean"]).cpu()
+            corrupted_tokens = model.to_tokens(item["corrupted"]).cpu()
+            if clean_tokens.shape != corrupted_tokens.shape: continue
+            clean_ans = model.to_tokens(item["clean_generated"])[0][1].cpu()
+            corrupt_ans = model.to_tokens(item["corrupted_generated"])[0][1].cpu()
+            pairs.append((clean_tokens, corrupted_tokens, clean_ans, corrupt_ans))
+            kept.append(item)
+    cfg = model.cfg
+    retained_mb = sum(cfg.n_layers * p[0].shape[-1] * cfg.n_heads * cfg.d_head * 4 for p in pairs) / MB
+    if memory_budget_mb and pairs:
+        max_len = max(p[0].shape[-1] for p in pairs)
+        # clean 与 corrupted 两次前向的 logits 与 z 缓存在同一批内同时存活
+        row_bytes = 2 * forward_row_bytes(cfg, max_len, cached_z=True)
+        reserved_mb = current_rss_mb() + retained_mb
+        batch_size = pick_batch_size(memory_budget_mb, row_bytes, reserved_mb, max_batch=len(pairs))
+        if reserved_mb > memory_budget_mb:
+            print(f"[WARN] 模型与 {len(pairs)} 个样本的 clean_z（约 {retained_mb:.0f}MB）已超出内存预算 {memory_budget_mb:.0f}MB")
+        print(f"[日志] 内存预算 {memory_budget_mb:.0f}MB -> collect batch_size={batch_size}")
+    collected = [None] * len(pairs)
+    memo = open_memo(memo_path, memo_max_mb, model)
+    todo, alias = list(range(len(pairs))), {}
+    if memo is not None:
+        unique, alias = dedup_indices([memo.key("pair", *p) for p in pairs])
+        memo.record_hits("pair", len(alias))
+        todo = []
+        for i in unique:
+            clean_tokens, corrupted_tokens, clean_ans, corrupt_ans = pairs[i]
+            entry = memo.get("clean_z", clean_tokens) if memo_z and writer is None else None
+            cl = memo.get("last_logits", clean_tokens) if entry is not None else None
+            kl = memo.get("last_logits", corrupted_tokens) if cl is not None else None
+            if kl is None:
+                todo.append(i)
+            else:
+                collected[i] = (entry["z"], get_logits_diff(cl, clean_ans, corrupt_ans), get_logits_diff(kl, clean_ans, corrupt_ans),
+                                entry["scale"])
+    # 复用前缀时按 (长度, 共享前缀长度) 分批，批内前缀等长
+    # clean/corrupted 从 S2 开始不同：数据自带位置时共享前缀长度即 s2_pos，不必逐个比较 token
+    positions = known_positions(kept)
+    prefix_lens = [(int(positions["s2_pos"][i]) if positions is not None else shared_prefix_len(p[0], p[1])) if prefix_reuse else 0
+                   for i, p in enumerate(pairs)]
+    positions_computed = positions_full = 0
+    with tqdm(total=len(pairs), desc="Collect activations") as pbar:
+        pbar.update(len(pairs) - len(todo))
+        for batch in length_batches([(pairs[i][0].shape[-1], prefix_lens[i]) for i in todo], batch_size):
+            idxs = [todo[b] for b in batch]
+            clean_tokens = torch.cat([pairs[i][0] for i in idxs], dim=0).to(device)
+            corrupted_tokens = torch.cat([pairs[i][1] for i in idxs], dim=0).to(device)
+            n_pre, seq = prefix_lens[idxs[0]], clean_tokens.shape[1]
+            positions_full += 2 * len(idxs) * seq
+            positions_computed += len(idxs) * n_pre + 2 * len(idxs) * (seq - n_pre)
+            if prefix_reuse:
+                with torch.no_grad():
+                    kv, prefix_z = prefix_kv_cache(model, clean_tokens[:, :n_pre], keep_z=True)
+                    # clean 与 corrupted 的后缀合成一批，共享同一份前缀 KV
+                    suffix = torch.cat([clean_tokens[:, n_pre:], corrupted_tokens[:, n_pre:]], dim=0)
+                    with span("forward", batch=len(idxs), prefix=n_pre):
+                        logits, cache = model.run_with_cache(suffix, past_kv_cache=tile_kv_cache(kv, 2), names_filter=collect_hook_names)
+                clean_logits, corrupted_logits = logits[:len(idxs)], logits[len(idxs):]
+                batch_z = torch.cat([prefix_z, cache.stack_activation("z")[:, :len(idxs)]], dim=2).cpu()
+                batch_scale = cache["ln_final.hook_scale"][:len(idxs), -1, 0].cpu()
+                clean_cache = corrupted_cache = cache
+                del kv, prefix_z, logits
+            else:
+                with span("forward", batch=len(idxs)), torch.no_grad():
+                    corrupted_logits, corrupted_cache = model.run_with_cache(corrupted_tokens, names_filter=lambda n: n.endswith("hook_z"))
+                    clean_logits, clean_cache = model.run_with_cache(
+                        clean_tokens, names_filter=collect_hook_names if writer is None else pattern_names_filter(pattern_heads))
+                # [n_layers, batch, seq, n_heads, d_head]
+                batch_z = clean_cache.stack_activation("z").cpu()
+                batch_scale = clean_cache["ln_final.hook_scale"][:, -1, 0].cpu()
+                if writer is not None:
+                    for i, pattern in zip(idxs, batch_patterns(clean_cache, pattern_heads)):
+                        writer.add(i, pattern)
+            for b, i in enumerate(idxs):
+                clean_ans, corrupt_ans = pairs[i][2].to(device), pairs[i][3].to(device)
+                cld = get_logits_diff(clean_logits[b][-1], clean_ans, corrupt_ans)
+                cod = get_logits_diff(corrupted_logits[b][-1], clean_ans, corrupt_ans)
+                collected[i] = (batch_z[:, b].clone(), cld, cod, batch_scale[b])
+                if memo is not None:
+                    memo.put("last_logits", clean_logits[b][-1].cpu(), pairs[i][0])
+                    memo.put("last_logits", corrupted_logits[b][-1].cpu(), pairs[i][1])
+                    if memo_z:
+                        memo.put("clean_z", {"z": collected[i][0], "scale": batch_scale[b]}, pairs[i][0])
+            del clean_cache, corrupted_cache, clean_logits, corrupted_logits, batch_z
+            pbar.update(len(idxs))
+    for i, j in alias.items():
+        collected[i] = collected[j]
+        if writer is not None:
+            writer.alias(i, j)
+    # 按输入顺序输出
+    save_data = {
+        "clean_z": [c[0] for c in collected],
+        "clean_sentences": [p[0] for p in pairs], "corrupted_sentences": [p[1] for p in pairs],
+        "clean_answers": [p[2] for p in pairs], "corrupted_answers": [p[3] for p in pairs],
+        "clean_logits_diff": [c[1] for c in collected], "corrupted_logits_diff": [c[2] for c in collected],
+        # clean 最后位置的最终 LayerNorm 缩放，供 DLA 使用
+        "clean_final_scale": torch.stack([c[3] for c in collected]) if collected else torch.zeros(0),
+    }
+    save_data["meta"] = collect_meta(kept)
+    # 数据自带 token 位置时一并保存，patch 的前缀复用直接按 s2_pos 切分
+    if positions is not None:
+        save_data["positions"] = positions
+    with span("write_output", path=output_file):
+        torch.save(save_data, output_file)
+    elapsed = time.time() - t0
+    print(f"[OK] 缓存激活值完成，保留 {len(pairs)} 个有效样本，用时 {elapsed:.3f}s -> {output_file}")
+    torch.cuda.empty_cache(); gc.collect()
+    result = { "time": elapsed, "valid_samples": len(pairs), "batch_size": batch_size, "output_tensor_mb": tensor_mb(save_data) }
+    if prefix_reuse:
+        result["prefix_reuse"] = prefix_reuse_report(positions_computed, positions_full, prefix_lens)
+    if writer is not None:
+        result["patterns"] = writer.close()
+        print(f"[OK] 注意力模式：{result['patterns']['heads']} 个头 × {result['patterns']['samples']} 个样本，"
+              f"{result['patterns']['size_mb']}MB（压缩比 {result['patterns']['compression']}）-> {pattern_file}")
+    return close_memo(memo, result)
+
+
+def collect_multi_token(data, output_file: str, model, batch_size: int, t0: float, prefix_reuse: bool = False,
+                        writer=None) -> dict:
+    """
+    get_clean_activations 的多 token 目标版本：一次前向同时得到 clean_z 与四个 teacher-forced 打分
+    prefix_reuse=True 时每个样本的共享前缀只前向一次，供 4 行后缀共用
+    writer 为 PatternWriter 时另存选定头在 clean prompt 范围内的注意力模式
+    """
+    import torch
+    from tqdm import tqdm
+    pairs, kept = [], []
+    with span("tokenize"):
+        for item in data:
+            clean_tokens = model.to_tokens(item["clean"]).cpu()
+            corrupted_tokens = model.to_tokens(item["corrupted"]).cpu()
+            if clean_tokens.shape != corrupted_tokens.shape: continue
+            pairs.append((clean_tokens, corrupted_tokens, target_tokens(model, item["clean_answer"]),
+                          target_tokens(model, item["corrupted_answer"])))
+            kept.append(item)
+    device = model.cfg.device
+    collected = [None] * len(pairs)
+    prefix_lens = [shared_prefix_len(p[0], p[1]) if prefix_reuse else 0 for p in pairs]
+    positions_computed = positions_full = 0
+    with tqdm(total=len(pairs), desc="Collect activations (multi-token)") as pbar:
+        for idxs in length_batches([(p[0].shape[-1], n) for p, n in zip(pairs, prefix_lens)], batch_size):
+            n_pre = prefix_lens[idxs[0]]
+            # 每个样本 4 行：clean+目标A、clean+目标B、corrupted+目标A、corrupted+目标B（复用前缀时只含后缀）
+            prompts, targets = [], []
+            for i in idxs:
+                clean_tokens, corrupted_tokens, ans_a, ans_b = pairs[i]
+                prompts += [clean_tokens[:, n_pre:], clean_tokens[:, n_pre:], corrupted_tokens[:, n_pre:], corrupted_tokens[:, n_pre:]]
+                targets += [ans_a, ans_b, ans_a, ans_b]
+            tokens, prompt_lens = append_targets(model, prompts, targets)
+            positions_full += tokens.numel() + tokens.shape[0] * n_pre
+            positions_computed += tokens.numel() + len(idxs) * n_pre
+            with torch.no_grad():
+                kv = prefix_z = None
+                if prefix_reuse:
+                    prefix = torch.cat([pairs[i][0][:, :n_pre] for i in idxs], dim=0).to(device)
+                    kv, prefix_z = prefix_kv_cache(model, prefix, keep_z=True)
+                    kv = tile_kv_cache(kv, 4, interleave=True)
+                with span("forward", batch=len(idxs), rows=tokens.shape[0]):
+                    logits, cache = model.run_with_cache(
+                        tokens.to(device), past_kv_cache=kv,
+                        names_filter=collect_hook_names if writer is None else pattern_names_filter(writer.heads))
+            scores = target_logprobs(logits, prompt_lens, targets).view(len(idxs), 4).cpu()
+            # 因果注意力：clean+目标A 行在 prompt 范围内的 z 就是 clean prompt 的 z
+            seq = prompt_lens[0]
+            batch_z = cache.stack_activation("z")[:, ::4, :seq]
+            if prefix_z is not None:
+                batch_z = torch.cat([prefix_z, batch_z], dim=2)
+            batch_z = batch_z.cpu()
+            batch_scale = cache["ln_final.hook_scale"][::4, seq - 1, 0].cpu()
+            if writer is not None:
+                for i, pattern in zip(idxs, batch_patterns(cache, writer.heads, slice(None, None, 4), seq)):
+                    writer.add(i, pattern)
+            for b, i in enumerate(idxs):
+                collected[i] = (batch_z[:, b].clone(), scores[b, 0] - scores[b, 1], scores[b, 2] - scores[b, 3], batch_scale[b])
+            del logits, cache, batch_z
+            pbar.update(len(idxs))
     save_data = {
-        "clean_z": clean_z, "clean_sentences": clean_sentences, "corrupted_sentences": corrupted_sentences,
-        "clean_answers": clean_answers, "corrupted_answers": corrupted_answers,
-        "clean_logits_diff": clean_logits_diffs, "corrupted_logits_diff": corrupted_logits_diffs
+        "clean_z": [c[0] for c in collected],
+        "clean_sentences": [p[0] for p in pairs], "corrupted_sentences": [p[1] for p in pairs],
+        "clean_answers": [p[2] for p in pairs], "corrupted_answers": [p[3] for p in pairs],
+        "clean_logits_diff": [c[1] for c in collected], "corrupted_logits_diff": [c[2] for c in collected],
+        "clean_final_scale": torch.stack([c[3] for c in collected]) if collected else torch.zeros(0),
+        "target_mode": "multi", "meta": collect_meta(kept),
     }
-    torch.save(save_data, output_file)
+    with span("write_output", path=output_file):
+        torch.save(save_data, output_file)
     elapsed = time.time() - t0
-    print(f"[OK] 缓存激活值完成，保留 {len(clean_answers)} 个有效样本，用时 {elapsed:.3f}s -> {output_file}")
+    print(f"[OK] 缓存激活值完成（多 token 目标），保留 {len(pairs)} 个有效样本，用时 {elapsed:.3f}s -> {output_file}")
     torch.cuda.empty_cache(); gc.collect()
-    return { "time": elapsed, "valid_samples": len(clean_answers) }
+    result = { "time": elapsed, "valid_samples": len(pairs), "batch_size": batch_size, "output_tensor_mb": tensor_mb(save_data),
+               "target_mode": "multi" }
+    if prefix_reuse:
+        result["prefix_reuse"] = prefix_reuse_report(positions_computed, positions_full, prefix_lens)
+    if writer is not None:
+        result["patterns"] = writer.close()
+    return result
+
+
+def patch_heads_batched(z, hook, head_mask, replacement):
+    """
+    批量 patch：第 b 行中 head_mask[b] 为 True 的头替换为 replacement 的对应值
+    z: [batch, pos, n_heads, d_head]，head_mask: [batch, n_heads]，replacement: [pos, n_heads, d_head]
+    z 比 replacement 长时（prompt 后拼了目标 token）只替换 prompt 部分
+    """
+    import torch
+    seq = replacement.shape[0]
+    if z.shape[1] == seq:
+        return torch.where(head_mask[:, None, :, None], replacement[None], z)
+    prefix = torch.where(head_mask[:, None, :, None], replacement[None], z[:, :seq])
+    return torch.cat([prefix, z[:, seq:]], dim=1)
+
+
+def run_head_patches(model, tokens, replacement_z, patches, ans_a, ans_b, unembed: str = "answers", kv=None):
+    """
+    一次前向完成一组 (layer, head) patch，每个 patch 占 batch 中的一行
+    tokens: [1, seq]，replacement_z: [n_layers, seq, n_heads, d_head]
+    返回每行最后位置的 logits[ans_a] - logits[ans_b]
+    ans_a/ans_b 为一维 token 序列（多 token 目标）时，每个 patch 占两行（prompt+目标A、prompt+目标B），返回 log 概率差
+    unembed="answers" 时前向停在最终残差流，只在需要的位置反嵌入（单 token 时只取两个答案列），
+    省去 [rows, seq, d_vocab] 的完整 logits；"full" 为原先的完整 logits 路径
+    kv 为共享前缀的冻结 KV cache（prefix_kv_cache）时，tokens 与 replacement_z 只含前缀之后的位置
+    """
+    return run_group_patches(model, tokens, replacement_z, [[p] for p in patches], ans_a, ans_b, unembed, kv)
+
+
+def run_group_patches(model, tokens, replacement_z, groups, ans_a, ans_b, unembed: str = "answers", kv=None):
+    """同 run_head_patches，但每行同时 patch 一组 (layer, head)（用于整层/整块 patch）"""
+    import torch
+    from transformer_lens import utils
+    # 单 token 模式下答案是标量 token，多 token 模式下是一维 token 序列
+    multi = ans_a.dim() == 1
+    n_rows = len(groups)
+    mask = torch.zeros(n_rows, model.cfg.n_layers, model.cfg.n_heads, dtype=torch.bool, device=tokens.device)
+    for r, group in enumerate(groups):
+        for layer, head in group:
+            mask[r, layer, head] = True
+    if multi:
+        mask = mask.repeat_interleave(2, dim=0)
+    fwd_hooks = [
+        (utils.get_act_name("z", layer), partial(patch_heads_batched, head_mask=mask[:, layer], replacement=replacement_z[layer]))
+        for layer in sorted({layer for group in groups for layer, _ in group})
+    ]
+    # 前缀对所有行相同且不受 patch 影响（因果注意力），只读共享的 KV
+    past_kv = {} if kv is None else {"past_kv_cache": tile_kv_cache(kv, mask.shape[0])}
+    if multi:
+        targets = [ans_a, ans_b] * n_rows
+        rows, prompt_lens = append_targets(model, [tokens[0].cpu()] * (2 * n_rows), [t.cpu() for t in targets])
+        rows = rows.to(tokens.device)
+        if unembed == "answers":
+            resid = model.run_with_hooks(rows, fwd_hooks=fwd_hooks, stop_at_layer=model.cfg.n_layers, **past_kv)
+            scores = target_logprobs_resid(model, resid, prompt_lens, targets)
+        else:
+            logits = model.run_with_hooks(rows, fwd_hooks=fwd_hooks, return_type="logits", **past_kv)
+            scores = target_logprobs(logits, prompt_lens, targets)
+        scores = scores.view(n_rows, 2)
+        return scores[:, 0] - scores[:, 1]
+    if unembed == "answers":
+        resid = model.run_with_hooks(tokens.expand(n_rows, -1), fwd_hooks=fwd_hooks, stop_at_layer=model.cfg.n_layers, **past_kv)
+        return answer_logit_diff(model, resid, ans_a, ans_b)
+    logits = model.run_with_hooks(tokens.expand(n_rows, -1), fwd_hooks=fwd_hooks, return_type="logits", **past_kv)
+    last = logits[:, -1]
+    return last[:, ans_a] - last[:, ans_b]
 
 
-def activation_patching(input_file: str, output_file: str) -> dict:
-    # ... (函数内容不变) ...
+def adaptive_head_patches(model, tokens, replacement_z, ans_a, ans_b, score, batch_size: int, block_sizes,
+                          threshold: float, unembed: str = "answers", kv=None):
+    """
+    分层自适应 patch：先以 block_sizes[0] 个头为一块整块 patch（= n_heads 时即整层），
+    |指标| ≥ threshold 的块按下一级块大小细分，最后一级细到单个头；低于阈值的块整体剪掉，其中的头不再单独 patch
+    score: 把一行的 logits diff 换算成指标
+    返回 ({(layer, head): 指标}, 剪掉的区域 [(layer, h0, h1, 指标)], 前向次数)
+    """
+    n_layers, n_heads = model.cfg.n_layers, model.cfg.n_heads
+    regions = [(layer, 0, n_heads) for layer in range(n_layers)]
+    pruned, forwards = [], 0
+    for size in list(block_sizes) + [1]:
+        regions = [(layer, h, min(h + size, h1)) for layer, h0, h1 in regions for h in range(h0, h1, size)]
+        effects = []
+        for start in range(0, len(regions), batch_size):
+            groups = [[(layer, h) for h in range(h0, h1)] for layer, h0, h1 in regions[start:start + batch_size]]
+            effects.extend(score(pld) for pld in run_group_patches(model, tokens, replacement_z, groups, ans_a, ans_b, unembed, kv))
+            forwards += 1
+        if size == 1:
+            return {(layer, h0): e for (layer, h0, _), e in zip(regions, effects)}, pruned, forwards
+        pruned.extend((*region, e) for region, e in zip(regions, effects) if abs(e) < threshold)
+        regions = [region for region, e in zip(regions, effects) if abs(e) >= threshold]
+
+
+def adaptive_block_sizes(block_sizes, n_heads: int) -> list:
+    """整理块大小：去重、截到 n_heads、降序，去掉 1（最后一级固定为单头）"""
+    return sorted({min(int(s), n_heads) for s in block_sizes if int(s) > 1}, reverse=True) or [n_heads]
+
+
+def dataset_mean_z(save_data: dict, input_file: str, cache_file: str = None):
+    """
+    每个头在数据集上（样本与位置平均）的 clean z [n_layers, n_heads, d_head]
+    clean_z 以 mmap 读入，逐个样本换入累加；结果缓存在 cache_file（默认 <input>_mean_z.pt），输入更新后重新计算
+    """
+    import torch
+    cache_file = cache_file or os.path.splitext(input_file)[0] + "_mean_z.pt"
+    if os.path.exists(cache_file) and os.path.getmtime(cache_file) >= os.path.getmtime(input_file):
+        print(f"[日志] 使用缓存的数据集平均 z: {cache_file}")
+        return torch.load(cache_file, map_location="cpu")
+    total, count = None, 0
+    with span("mean_z", samples=len(save_data["clean_z"])):
+        for z in save_data["clean_z"]:
+            # [n_layers, seq, n_heads, d_head] -> 按位置求和
+            part = z.float().sum(dim=1)
+            total = part if total is None else total + part
+            count += z.shape[1]
+    mean_z = total / count
+    torch.save(mean_z, cache_file)
+    print(f"[日志] 数据集平均 z 已缓存 -> {cache_file}")
+    return mean_z
+
+
+def activation_patching(input_file: str, output_file: str, model=None, batch_size: int = 1, num_samples: int = 10,
+                        memory_budget_mb: float = None, unembed: str = "answers", adaptive: bool = False,
+                        block_sizes=None, threshold: float = 0.05, prefix_reuse: bool = False,
+                        memo_path: str = None, memo_max_mb: float = 1024, store_file: str = None,
+                        mode: str = "patch", mean_z_cache: str = None, stream_dir: str = None,
+                        precision: str = "fp32", calib: int = 2, compiled: str = None) -> dict:
+    """
+    对随机抽取的 num_samples 个样本逐头 patch
+    batch_size 为每次前向包含的 patch 数（≤ n_heads 时在层内切分，否则按整层合并）
+    指定 memory_budget_mb 时按预算选择 batch_size
+    unembed 见 run_head_patches
+    adaptive=True 时按 adaptive_head_patches 分层 patch（block_sizes 默认整层），被剪掉的头记为 0
+    prefix_reuse=True 时每个样本 clean/corrupted 开头相同的部分只前向一次：
+    该部分的 z 在 clean/corrupted 间相同，patch 不改变它，也不影响其后各层的前缀 KV
+    指定 memo_path 时每个样本逐头 patch 的 logits diff 写入备忘，内容相同的样本（本次或以往运行）直接复用（自适应模式不备忘）
+    指定 store_file 时另存逐样本结果与元数据（ioi_results.py 查询），output_file 仍为平均矩阵
+    mode="zero"/"mean" 时改为在 clean 前向中逐头消融（z 置零 / 替换为数据集平均 z），沿用同一套批量 hook；
+    指标为 (clean - ablated) / (clean - corrupted)，与 patch 一样 0 表示无影响、越大越重要，结果格式相同
+    指定 stream_dir 时按层流式执行（ioi_streaming.py）：权重按层从 mmap 文件换入，一块样本的 patch 行逐层推进，
+    峰值内存取决于一层与一块样本的残差流而不是整个模型；样本块的大小由 memory_budget_mb 扣除已用内存、单层权重与
+    一批前向后得出（未指定时为 1024MB）；不存在导出时先加载完整模型导出一次
+    precision="bf16" 时先对前 calib 个样本分别以 fp32 与 bf16 逐头 patch，top-5 头的排名一致才以 bf16 执行，
+    否则退回 fp32（ioi_precision.py）；低精度结果不写入备忘；退回 fp32 时校准样本的 fp32 结果直接沿用，不再重算
+    compiled="compile"/"trace" 时逐头 patch 走编译后的前向（ioi_compiled.py），patch 内联在图中，按 prompt 长度缓存编译结果；
+    结果的 compiled 字段记录各长度的编译耗时、eager/编译后每次前向的耗时与回本所需的前向次数
+    """
+    import torch
+    from tqdm import tqdm
+    from ioi_precision import autocast, precision_guard, same_top_heads
     t0 = time.time()
-    device = "cuda" if torch.cuda.is_available() else "cpu"
     torch.set_grad_enabled(False)
-    model = load_model_safely(device=device)
-    save_data = torch.load(input_file, map_location="cpu")
+    stream = None
+    if stream_dir:
+        from ioi_streaming import LayerStream, export_weights, has_export, stream_head_patches
+        device = "cuda" if torch.cuda.is_available() else "cpu"
+        if not has_export(stream_dir):
+            print(f"[日志] {stream_dir} 中没有按层导出的权重，先导出一次")
+            full = load_model_safely(device="cpu")
+            export_weights(full, stream_dir)
+            del full
+            gc.collect()
+        with span("load_model", streamed=True):
+            stream = LayerStream(stream_dir, device)
+        model = stream.model
+    if model is None:
+        model = load_model_safely(device="cuda" if torch.cuda.is_available() else "cpu")
+    device = model.cfg.device
+    with span("read_input", path=input_file):
+        save_data = load_saved_data(input_file)
     clean_z = save_data["clean_z"]
     clean_logits_diffs = save_data["clean_logits_diff"]
     corrupted_logits_diffs = save_data["corrupted_logits_diff"]
-    clean_sentences = save_data["clean_sentences"]
     corrupted_sentences = save_data["corrupted_sentences"]
     clean_answers = save_data["clean_answers"]
     corrupted_answers = save_data["corrupted_answers"]
-    def get_logits_diff(logits, token1, token2): return logits[token1] - logits[token2]
-    def patch_head_vector(c_vec, hook, head_index, cl_vec):
-        c_vec[:, :, head_index] = cl_vec[:, head_index]
-        return c_vec
+    # 多 token 目标时每个 patch 占两行（两个目标各一行）
+    rows_per_patch = 2 if save_data.get("target_mode") == "multi" else 1
     def ioi_metric(clean, corrupted, patched): return (patched - corrupted) / (clean - corrupted)
+    def ablation_metric(clean, corrupted, ablated): return (clean - ablated) / (clean - corrupted)
+    metric = ioi_metric if mode == "patch" else ablation_metric
+    n_layers, n_heads = model.cfg.n_layers, model.cfg.n_heads
+    mean_z = dataset_mean_z(save_data, input_file, mean_z_cache).to(device) if mode == "mean" else None
+    # 平均消融的结果取决于数据集平均 z：备忘键带上它的摘要，别的数据集上同一 prompt 的结果不会命中
+    mean_z_digest = hashlib.sha1(mean_z.float().cpu().numpy().tobytes()).hexdigest() if mean_z is not None else None
+    if stream is not None:
+        # 流式执行按层推进全部 patch 行，不支持多 token 目标，也不支持逐样本的自适应剪枝、前缀复用与备忘
+        if rows_per_patch > 1:
+            raise ValueError("流式执行不支持多 token 目标")
+        ignored = [flag for flag, on in (("--adaptive", adaptive), ("--prefix-reuse", prefix_reuse), ("--memo", memo_path),
+                                         ("--unembed full", unembed != "answers")) if on]
+        if ignored:
+            print(f"[WARN] 流式执行只支持 answers 反嵌入的逐头 patch，已忽略 {'/'.join(ignored)}")
+        adaptive, prefix_reuse, memo_path, unembed = False, False, None, "answers"
+    if compiled and (stream is not None or adaptive or prefix_reuse or rows_per_patch > 1 or unembed != "answers"):
+        # 编译路径是手写的单 token 前向，不含 KV 前缀、分组 patch 与完整 logits
+        print("[WARN] 编译路径只支持单 token 目标的逐头 patch（answers 反嵌入，不与 --stream-weights/--adaptive/--prefix-reuse 同用），改用 eager")
+        compiled = None
+    if compiled:
+        from ioi_compiled import unsupported_reason
+        reason = unsupported_reason(model.cfg)
+        if reason:
+            print(f"[WARN] 编译路径不支持该模型（{reason}），改用 eager")
+            compiled = None
+    if mode != "patch" and prefix_reuse:
+        # 消融作用于所有位置，前缀的 z 也会改变，不能复用前缀
+        print(f"[WARN] {mode} 消融不支持前缀复用，已忽略 --prefix-reuse")
+        prefix_reuse = False
+    if memory_budget_mb and corrupted_sentences and stream is None:
+        max_len = max(t.shape[-1] for t in corrupted_sentences)
+        if rows_per_patch > 1:
+            max_len += max(max(a.shape[-1], b.shape[-1]) for a, b in zip(clean_answers, corrupted_answers))
+        # answers 模式下单 token 目标不再产生完整词表的 logits
+        logit_positions = 0 if unembed == "answers" and rows_per_patch == 1 else None
+        batch_size = pick_batch_size(memory_budget_mb, rows_per_patch * forward_row_bytes(model.cfg, max_len, logit_positions),
+                                     current_rss_mb(), max_batch=n_layers * n_heads)
+        print(f"[日志] 内存预算 {memory_budget_mb:.0f}MB -> patch batch_size={batch_size}")
+    rows_mb = 1024
+    if stream is not None and memory_budget_mb and corrupted_sentences:
+        # 保留到最后一层的 patch 行残差流占用预算的剩余部分
+        max_len = max(t.shape[-1] for t in corrupted_sentences)
+        working_mb = max(stream.manifest["layer_mb"]) + batch_size * forward_row_bytes(model.cfg, max_len, 0) / MB
+        rows_mb = max(64, memory_budget_mb - current_rss_mb() - working_mb)
+        print(f"[日志] 内存预算 {memory_budget_mb:.0f}MB -> 流式执行每块样本的 patch 行 ≤ {rows_mb:.0f}MB")
+    heads_per_fwd = min(batch_size, n_heads)
+    layers_per_fwd = max(1, batch_size // n_heads)
     case_n = len(clean_answers)
-    rdm = list(range(case_n)) if case_n < 10 else random.sample(range(case_n), 10)
-    results = torch.zeros(len(rdm), model.cfg.n_layers, model.cfg.n_heads, device=device, dtype=torch.float32)
-    total_patches = len(rdm) * model.cfg.n_layers * model.cfg.n_heads
-    with tqdm(total=total_patches, desc="Activation patching") as pbar:
+    rdm = list(range(case_n)) if case_n < num_samples else random.sample(range(case_n), num_samples)
+    results = torch.zeros(len(rdm), n_layers, n_heads, device=device, dtype=torch.float32)
+    total_patches = len(rdm) * n_layers * n_heads
+    full_forwards = len(rdm) * -(-n_layers // layers_per_fwd) * -(-n_heads // heads_per_fwd)
+    if adaptive:
+        block_sizes = adaptive_block_sizes(block_sizes or [n_heads], n_heads)
+        pruned_regions, forwards, head_patches = {}, 0, 0
+    clean_sentences = save_data["clean_sentences"]
+    positions = save_data.get("positions")
+    prefix_lens, positions_computed, positions_full = [], 0, 0
+
+    def sample_inputs(i):
+        """patch：corrupted 前向中换入 clean z；消融：clean 前向中换入零或数据集平均 z"""
+        clean_z_i = clean_z[i].to(device)
+        if mode == "patch":
+            return corrupted_sentences[i].to(device), clean_z_i
+        replacement = torch.zeros_like(clean_z_i) if mode == "zero" else mean_z[:, None].to(clean_z_i.dtype).expand_as(clean_z_i)
+        return clean_sentences[i].to(device), replacement
+
+    # 精度守卫中 fp32 跑过的校准样本的逐头 logits diff；守卫选定 fp32 时主循环直接复用，不再重算
+    calib_raw = {}
+
+    def calib_effects(p):
+        """精度守卫：前 calib 个样本逐头 patch 的平均指标 [n_layers, n_heads]"""
+        items = rdm[:calib]
+        with autocast(p, device):
+            if stream is not None:
+                raw_c = stream_head_patches(stream, [(*sample_inputs(i), clean_answers[i], corrupted_answers[i]) for i in items],
+                                            batch_size, answer_logit_diff, rows_mb)
+            else:
+                patches = [(layer, head) for layer in range(n_layers) for head in range(n_heads)]
+                raw_c = torch.zeros(len(items), n_layers, n_heads)
+                for j, i in enumerate(items):
+                    tokens_i, replacement_i = sample_inputs(i)
+                    for start in range(0, len(patches), batch_size):
+                        chunk = patches[start:start + batch_size]
+                        plds = run_head_patches(model, tokens_i, replacement_i, chunk, clean_answers[i].to(device),
+                                                corrupted_answers[i].to(device), unembed)
+                        for (layer, head), pld in zip(chunk, plds):
+                            raw_c[j, layer, head] = float(pld)
+        if p == "fp32":
+            calib_raw.update({i: raw_c[j] for j, i in enumerate(items)})
+        return torch.stack([metric(float(clean_logits_diffs[i]), float(corrupted_logits_diffs[i]), raw_c[j])
+                            for j, i in enumerate(items)]).mean(dim=0)
+    with span("precision_guard", precision=precision):
+        guard = precision_guard(calib_effects, same_top_heads(5), precision, "patch")
+    if guard["used"] != "fp32" or adaptive:
+        # 低精度的主循环与校准结果不同；自适应 patch 的结果含剪枝，也不能直接用逐头结果
+        calib_raw.clear()
+    memo = None if adaptive or guard["used"] != "fp32" else open_memo(memo_path, memo_max_mb, model)
+    patcher = None
+    if compiled:
+        from ioi_compiled import CompiledPatcher
+        patcher = CompiledPatcher(model, layers_per_fwd * heads_per_fwd, compiled,
+                                  eager=lambda *a: run_head_patches(model, *a, unembed))
+
+    if stream is not None:
+        with span("patch_streamed", samples=len(rdm)), autocast(guard["used"], device):
+            todo = [i for i in rdm if i not in calib_raw]
+            raw = stream_head_patches(stream, [(*sample_inputs(i), clean_answers[i], corrupted_answers[i]) for i in todo],
+                                      batch_size, answer_logit_diff, rows_mb) if todo else None
+        streamed = {i: raw[k] for k, i in enumerate(todo)}
         for idx, i in enumerate(rdm):
+            raw_i = calib_raw[i] if i in calib_raw else streamed[i]
+            results[idx] = metric(float(clean_logits_diffs[i]), float(corrupted_logits_diffs[i]), raw_i.to(device))
+        rdm_todo = []
+    else:
+        rdm_todo = rdm
+    with tqdm(total=total_patches, initial=total_patches - len(rdm_todo) * n_layers * n_heads,
+              desc="Activation patching" if mode == "patch" else f"{mode.capitalize()} ablation") as pbar, \
+            autocast(guard["used"], device):
+        for idx, i in enumerate(rdm_todo):
             model.reset_hooks()
-            corrupt_sent_i = corrupted_sentences[i].to(device)
             clean_ans_i = clean_answers[i].to(device)
             corrupt_ans_i = corrupted_answers[i].to(device)
-            for layer in range(model.cfg.n_layers):
-                for head in range(model.cfg.n_heads):
-                    with torch.no_grad():
-                        hook_fn = partial(patch_head_vector, head_index=head, cl_vec=clean_z[i][layer].to(device))
-                        pl = model.run_with_hooks(corrupt_sent_i, fwd_hooks=[(utils.get_act_name("z", layer), hook_fn)], return_type="logits")
-                        pld = get_logits_diff(pl[0][-1], clean_ans_i, corrupt_ans_i)
-                        results[idx, layer, head] = ioi_metric(clean_logits_diffs[i], corrupted_logits_diffs[i], pld)
-                        model.reset_hooks()
-                        del pl
-                    pbar.update(1)
+            score = partial(metric, float(clean_logits_diffs[i]), float(corrupted_logits_diffs[i]))
+            tokens_i, replacement_i = sample_inputs(i)
+            memo_parts = (mode, unembed, clean_sentences[i], corrupted_sentences[i], clean_answers[i], corrupted_answers[i])
+            if mean_z_digest is not None:
+                memo_parts += (mean_z_digest,)
+            raw = memo.get("patch", *memo_parts) if memo is not None else None
+            if raw is not None:
+                results[idx] = score(raw.to(device))
+                pbar.update(n_layers * n_heads)
+                continue
+            if i in calib_raw:
+                raw = calib_raw[i]
+                results[idx] = score(raw.to(device))
+                if memo is not None:
+                    memo.put("patch", raw, *memo_parts)
+                pbar.update(n_layers * n_heads)
+                continue
+            raw = torch.zeros(n_layers, n_heads)
+            kv = None
+            if prefix_reuse:
+                n_pre = (int(positions["s2_pos"][i]) if positions is not None
+                         else shared_prefix_len(clean_sentences[i], corrupted_sentences[i]))
+                with torch.no_grad():
+                    kv, _ = prefix_kv_cache(model, tokens_i[:, :n_pre])
+                tokens_i, replacement_i = tokens_i[:, n_pre:], replacement_i[:, n_pre:]
+                prefix_lens.append(n_pre)
+                # 以逐头扫描的 patch 行数计（每个头一行，多 token 目标的附加位置不计）
+                positions_full += n_layers * n_heads * (n_pre + tokens_i.shape[1])
+                positions_computed += n_pre + n_layers * n_heads * tokens_i.shape[1]
+            if adaptive:
+                with span("patch_adaptive", sample=i), torch.no_grad():
+                    head_effects, pruned, n_fwd = adaptive_head_patches(
+                        model, tokens_i, replacement_i, clean_ans_i, corrupt_ans_i, lambda pld: float(score(pld)),
+                        batch_size, block_sizes, threshold, unembed, kv)
+                for (layer, head), effect in head_effects.items():
+                    results[idx, layer, head] = effect
+                for layer, h0, h1, _ in pruned:
+                    pruned_regions[(layer, h0, h1)] = pruned_regions.get((layer, h0, h1), 0) + 1
+                forwards += n_fwd
+                head_patches += len(head_effects)
+                pbar.update(n_layers * n_heads)
+                torch.cuda.empty_cache(); gc.collect()
+                continue
+            for l0 in range(0, n_layers, layers_per_fwd):
+                layers = range(l0, min(l0 + layers_per_fwd, n_layers))
+                with span("patch_layer", sample=i, layer=l0, n_layers=len(layers)):
+                    for h0 in range(0, n_heads, heads_per_fwd):
+                        patches = [(layer, head) for layer in layers for head in range(h0, min(h0 + heads_per_fwd, n_heads))]
+                        with torch.no_grad():
+                            if patcher is not None:
+                                plds = patcher(tokens_i, replacement_i, patches, clean_ans_i, corrupt_ans_i)
+                            else:
+                                plds = run_head_patches(model, tokens_i, replacement_i, patches, clean_ans_i, corrupt_ans_i, unembed, kv)
+                        for (layer, head), pld in zip(patches, plds):
+                            results[idx, layer, head] = score(pld)
+                            raw[layer, head] = pld
+                        pbar.update(len(patches))
+            if memo is not None:
+                memo.put("patch", raw, *memo_parts)
             torch.cuda.empty_cache(); gc.collect()
     result_mean = results.mean(dim=0).cpu()
-    torch.save(result_mean, output_file)
+    with span("write_output", path=output_file):
+        torch.save(result_mean, output_file)
+    if store_file:
+        from ioi_results import ResultStore
+        store = ResultStore.from_patching(
+            results, rdm, save_data.get("meta"), [corrupted_sentences[i].shape[-1] for i in rdm],
+            [clean_logits_diffs[i] for i in rdm], [corrupted_logits_diffs[i] for i in rdm],
+            info={"mode": mode, "unembed": unembed, "adaptive": adaptive,
+                  "metric": "(patched - corrupted) / (clean - corrupted)" if mode == "patch" else "(clean - ablated) / (clean - corrupted)",
+                  "target_mode": save_data.get("target_mode", "first")})
+        with span("write_store", path=store_file):
+            store.save(store_file)
+        print(f"[OK] 逐样本结果 {tuple(store.effects.shape)} -> {store_file}")
     elapsed = time.time() - t0
-    print(f"[OK] 修补激活值完成，已聚合 {total_patches} 次patch为平均矩阵，用时 {elapsed:.3f}s -> {output_file}")
+    action = "修补激活值" if mode == "patch" else f"{mode} 消融"
+    print(f"[OK] {action}完成，已聚合 {total_patches} 次patch为平均矩阵，用时 {elapsed:.3f}s -> {output_file}")
     torch.cuda.empty_cache(); gc.collect()
-    return { "time": elapsed, "total_patches": total_patches }
+    result = { "time": elapsed, "total_patches": total_patches, "batch_size": batch_size, "unembed": unembed, "mode": mode,
+               "precision": guard }
+    if prefix_reuse:
+        result["prefix_reuse"] = prefix_reuse_report(positions_computed, positions_full, prefix_lens)
+    if stream is not None:
+        result["stream"] = stream.report()
+        print(f"[日志] 流式执行：{stream.manifest['model_name']} 样本分 {stream.chunks} 块，每块每层载入 1 次"
+              f"（共 {stream.loads} 次，{stream.load_s:.2f}s），单层权重 {result['stream']['max_layer_mb']}MB，"
+              f"patch 行残差流 {result['stream']['active_rows_mb']}MB，预计峰值 {result['stream']['expected_peak_mb']}MB")
+    if patcher is not None:
+        result["compiled"] = patcher.report()
+        for seq, b in result["compiled"]["buckets"].items():
+            if b["fallback"]:
+                print(f"[WARN] 编译路径 seq={seq}：已退回 eager，{b['forwards']} 次前向未计入加速比")
+                continue
+            print(f"[日志] 编译路径 seq={seq}：编译 {b['compile_s']}s，每次前向 eager {b['eager_forward_ms']}ms / "
+                  f"编译后 {b['compiled_forward_ms']}ms，{b['forwards']} 次前向，回本需 {b.get('breakeven_forwards')} 次")
+    close_memo(memo, result)
+    if adaptive:
+        print(f"[日志] 自适应 patch：前向 {forwards}/{full_forwards} 次（节省 {full_forwards - forwards}），"
+              f"单头 patch {head_patches}/{total_patches}，剪掉 {sum(pruned_regions.values())} 个区域")
+        result["adaptive"] = {
+            "block_sizes": block_sizes,
+            "threshold": threshold,
+            "forwards": forwards,
+            "full_forwards": full_forwards,
+            "forwards_saved": full_forwards - forwards,
+            "head_patches": head_patches,
+            # (layer, 起始头, 结束头) -> 被剪掉的样本数
+            "pruned_regions": [{"layer": l, "heads": [h0, h1], "samples": n} for (l, h0, h1), n in sorted(pruned_regions.items())],
+        }
+    return result
 
 
 def plot_heatmap(input_file: str, output_file: str) -> dict:
-    # ... (函数内容不变) ...
+    """
+    输入可以是 patch 的平均矩阵、ioi_results.py 的查询结果（单个矩阵或分组矩阵），
+    或逐样本结果存储（绘制平均值）
+    """
+    import torch
+    import matplotlib.pyplot as plt
+    import seaborn as sns
     t0 = time.time()
-    data = torch.load(input_file, map_location="cpu")
+    with span("read_input", path=input_file):
+        data = torch.load(input_file, map_location="cpu")
+    title = "Patching Attention Heads"
+    significant = data.get("significant") if isinstance(data, dict) else None
+    if isinstance(data, dict) and "effects" in data:
+        data = {"value": data["effects"].mean(dim=0), "title": f"mean over {data['effects'].shape[0]} samples"}
+    if isinstance(data, dict):
+        title = f"{title}: {data['title']}" if data.get("title") else title
+        if "groups" in data:
+            return plot_heatmap_groups(data["groups"], title, output_file, t0)
+        data = data["value"]
     if data.is_cuda: data = data.cpu()
     arr = data.numpy()
     plt.figure(figsize=(12, 8))
-    sns.heatmap(arr, cmap=plt.cm.RdBu_r, center=0, annot=True, fmt=".2f", cbar_kws={'label': 'Attention Value'})
-    plt.title("Patching Attention Heads", fontsize=16, fontweight='bold')
+    ax = sns.heatmap(arr, cmap=plt.cm.RdBu_r, center=0, annot=True, fmt=".2f", cbar_kws={'label': 'Attention Value'})
+    if significant is not None:
+        # ioi_stats.py 的显著性掩码：显著的头加黑框
+        for layer, head in significant.nonzero().tolist():
+            ax.add_patch(plt.Rectangle((head, layer), 1, 1, fill=False, edgecolor="black", linewidth=2))
+    plt.title(title, fontsize=16, fontweight='bold')
     plt.xlabel("Head", fontsize=12); plt.ylabel("Layer", fontsize=12)
-    plt.tight_layout(); plt.savefig(output_file, dpi=300, bbox_inches='tight'); plt.close()
+    with span("write_output", path=output_file):
+        plt.tight_layout(); plt.savefig(output_file, dpi=300, bbox_inches='tight'); plt.close()
     elapsed = time.time() - t0
     print(f"[OK] 绘制热力图完成，用时 {elapsed:.3f}s -> {output_file}")
     return { "time": elapsed }
 
 
+def direct_logit_attribution(input_file: str, output_file: str, model=None, store_file: str = None,
+                             chunk_size: int = 256) -> dict:
+    """
+    逐头直接 logit 归因（DLA），只用 collect 缓存的 clean_z，不做前向：
+    头 (l, h) 在最后位置写入残差流的 z[l, -1, h] @ W_O[l, h] 投影到答案方向 W_U[:, clean_ans] - W_U[:, corrupt_ans]，
+    再除以最终 LayerNorm 的缩放（center_writing_weights 下各头输出已去均值，LN 的中心化不改变它）
+    先把 W_O 折叠进答案方向，每块样本两次 einsum；输出与 patch 相同的 [layers, heads] 平均矩阵（单位为 logits）
+    多 token 目标取各自的首 token 作为答案方向；旧的 saved_data.pt 没有 LN 缩放时不做归一化
+    """
+    import torch
+    t0 = time.time()
+    torch.set_grad_enabled(False)
+    if model is None:
+        model = load_model_safely(device="cuda" if torch.cuda.is_available() else "cpu")
+    device = model.cfg.device
+    with span("read_input", path=input_file):
+        save_data = load_saved_data(input_file)
+    clean_z = save_data["clean_z"]
+    n = len(clean_z)
+    ans_a = torch.stack([a.reshape(-1)[0] for a in save_data["clean_answers"]]).to(device)
+    ans_b = torch.stack([b.reshape(-1)[0] for b in save_data["corrupted_answers"]]).to(device)
+    scales = save_data.get("clean_final_scale")
+    if scales is None:
+        print("[WARN] saved_data.pt 中没有最终 LayerNorm 缩放（旧版 collect 产物），DLA 不做归一化")
+    W_O, W_U = model.W_O, model.W_U
+    head_dla = torch.zeros(n, model.cfg.n_layers, model.cfg.n_heads)
+    layer_bias = torch.zeros(n, model.cfg.n_layers)
+    with span("dla", samples=n):
+        for start in range(0, n, chunk_size):
+            idx = range(start, min(start + chunk_size, n))
+            # 只取最后位置：[chunk, n_layers, n_heads, d_head]
+            z_last = torch.stack([clean_z[i][:, -1] for i in idx]).to(device, W_O.dtype)
+            direction = (W_U[:, ans_a[idx.start:idx.stop]] - W_U[:, ans_b[idx.start:idx.stop]]).T
+            head_dir = torch.einsum("lhdm,nm->nlhd", W_O, direction)
+            dla = torch.einsum("nlhd,nlhd->nlh", z_last, head_dir)
+            bias = torch.einsum("lm,nm->nl", model.b_O, direction)
+            if scales is not None:
+                s = scales[idx.start:idx.stop].to(device, dla.dtype)
+                dla, bias = dla / s[:, None, None], bias / s[:, None]
+            head_dla[idx.start:idx.stop] = dla.float().cpu()
+            layer_bias[idx.start:idx.stop] = bias.float().cpu()
+    result_mean = head_dla.mean(dim=0)
+    with span("write_output", path=output_file):
+        torch.save(result_mean, output_file)
+    if store_file:
+        from ioi_results import ResultStore
+        store = ResultStore.from_patching(
+            head_dla, list(range(n)), save_data.get("meta"), [t.shape[-1] for t in save_data["clean_sentences"]],
+            save_data["clean_logits_diff"], save_data["corrupted_logits_diff"],
+            info={"mode": "dla", "metric": "direct logit attribution (logits)", "normalized": scales is not None})
+        with span("write_store", path=store_file):
+            store.save(store_file)
+    # 每层注意力输出的 DLA = 各头之和 + b_O 的贡献
+    layer_dla = (head_dla.sum(dim=-1) + layer_bias).mean(dim=0)
+    elapsed = time.time() - t0
+    print(f"[OK] 直接 logit 归因完成，{n} 个样本，用时 {elapsed:.3f}s -> {output_file}")
+    return { "time": elapsed, "samples": n, "normalized": scales is not None,
+             "layer_dla": [round(float(v), 4) for v in layer_dla] }
+
+
+def circuit_discovery(input_file: str, output_file: str, model=None, num_samples: int = 10, batch_size: int = 32,
+                      threshold: float = 0.01, checkpoint: str = None) -> dict:
+    """
+    从完整的头图出发逐轮剪边，得到最小电路与忠实度（ioi_circuit.py）
+    取长度相同的最大一组样本的前 num_samples 个（确定性选取，便于续跑）；多 token 目标取首 token
+    每轮的候选边 × 样本放进 batch_size 行一批的前向；checkpoint 默认 <output>.ckpt，中断后以相同参数重跑即续跑
+    输出 {"value": 各头保留的出边数 [layers, heads], "edges", "faithfulness", ...}，plot 可直接绘制
+    """
+    import torch
+    from ioi_circuit import discover_circuit
+    t0 = time.time()
+    torch.set_grad_enabled(False)
+    if model is None:
+        model = load_model_safely(device="cuda" if torch.cuda.is_available() else "cpu")
+    device = model.cfg.device
+    with span("read_input", path=input_file):
+        save_data = load_saved_data(input_file)
+    clean_sentences, corrupted_sentences = save_data["clean_sentences"], save_data["corrupted_sentences"]
+    groups = {}
+    for i, (c, k) in enumerate(zip(clean_sentences, corrupted_sentences)):
+        if c.shape[-1] == k.shape[-1]:
+            groups.setdefault(c.shape[-1], []).append(i)
+    if not groups:
+        raise ValueError("没有 clean/corrupted 长度相同的样本")
+    seq_len, members = max(groups.items(), key=lambda kv: len(kv[1]))
+    samples = members[:num_samples]
+    print(f"[日志] 电路发现：长度 {seq_len} 的 {len(members)} 个样本中取 {len(samples)} 个，阈值 {threshold}")
+    clean_tokens = torch.cat([clean_sentences[i].reshape(1, -1) for i in samples]).to(device)
+    corrupted_tokens = torch.cat([corrupted_sentences[i].reshape(1, -1) for i in samples]).to(device)
+    ans_a = torch.stack([save_data["clean_answers"][i].reshape(-1)[0] for i in samples]).to(device)
+    ans_b = torch.stack([save_data["corrupted_answers"][i].reshape(-1)[0] for i in samples]).to(device)
+    checkpoint = checkpoint or f"{output_file}.ckpt"
+    config = {"input": os.path.abspath(input_file), "samples": samples, "batch_size": batch_size}
+    with span("circuit_discovery", samples=len(samples)):
+        found = discover_circuit(model, clean_tokens, corrupted_tokens, ans_a, ans_b, answer_logit_diff,
+                                 threshold, batch_size, checkpoint, config)
+    graph = found["graph"]
+    edges = graph.edges()
+    out = {"value": graph.out_degree(), "edges": edges, "kept": graph.kept, "faithfulness": found["faithfulness"],
+           "history": found["history"], "samples": samples, "threshold": threshold,
+           "title": f"circuit: {len(edges)} edges, faithfulness {found['faithfulness']:.3f} (out-degree per head)"}
+    with span("write_output", path=output_file):
+        torch.save(out, output_file)
+    elapsed = time.time() - t0
+    total = int(graph.valid.sum())
+    print(f"[OK] 电路发现完成：保留 {len(edges)}/{total} 条边，忠实度 {found['faithfulness']:.4f}，"
+          f"{found['forwards']} 次前向，用时 {elapsed:.3f}s -> {output_file}")
+    return { "time": elapsed, "samples": len(samples), "edges": len(edges), "total_edges": total,
+             "faithfulness": round(found["faithfulness"], 4), "forwards": found["forwards"], "rows": found["rows"],
+             "resumed_at": found["resumed"], "checkpoint": checkpoint }
+
+
+def significance_stats(input_file: str, output_file: str, n_boot: int = 2000, alpha: float = 0.05) -> dict:
+    """对逐样本结果存储做 bootstrap 置信区间与置换检验（ioi_stats.py），输出可交给 plot 叠加显著性"""
+    from ioi_stats import store_significance
+    t0 = time.time()
+    with span("significance", n_boot=n_boot):
+        stats = store_significance(input_file, output_file, n_boot=n_boot, n_perm=n_boot, alpha=alpha)
+    elapsed = time.time() - t0
+    print(f"[OK] 显著性统计完成：{stats['title']}，用时 {elapsed:.3f}s -> {output_file}")
+    return { "time": elapsed, "samples": stats["n_samples"], "significant_heads": int(stats["significant"].sum()) }
+
+
+def plot_heatmap_groups(groups: dict, title: str, output_file: str, t0: float) -> dict:
+    """分组查询结果：每组一张小热力图，共用色标范围"""
+    import math
+    import matplotlib.pyplot as plt
+    import seaborn as sns
+    items = list(groups.items())
+    cols = min(3, len(items))
+    rows = math.ceil(len(items) / cols)
+    vmax = max(float(v.abs().max()) for _, v in items) or 1.0
+    fig, axes = plt.subplots(rows, cols, figsize=(6 * cols, 4.5 * rows), squeeze=False)
+    for ax, (label, value) in zip(axes.flat, items):
+        sns.heatmap(value.cpu().numpy(), cmap=plt.cm.RdBu_r, center=0, vmin=-vmax, vmax=vmax, ax=ax, cbar=False)
+        ax.set_title(str(label)[:60], fontsize=9)
+        ax.set_xlabel("Head"); ax.set_ylabel("Layer")
+    for ax in list(axes.flat)[len(items):]:
+        ax.axis("off")
+    fig.suptitle(title, fontsize=14, fontweight='bold')
+    with span("write_output", path=output_file):
+        plt.tight_layout(); plt.savefig(output_file, dpi=200, bbox_inches='tight'); plt.close()
+    elapsed = time.time() - t0
+    print(f"[OK] 绘制分组热力图完成（{len(items)} 组），用时 {elapsed:.3f}s -> {output_file}")
+    return { "time": elapsed, "groups": len(items) }
+
+
+def process_age_s():
+    """进程启动至今的秒数（Linux，用于估计解释器启动开销）"""
+    try:
+        with open("/proc/stat", "r") as f:
+            btime = next(int(line.split()[1]) for line in f if line.startswith("btime"))
+        with open("/proc/self/stat", "r") as f:
+            start_ticks = int(f.read().rsplit(")", 1)[1].split()[19])
+        return time.time() - (btime + start_ticks / os.sysconf("SC_CLK_TCK"))
+    except (OSError, ValueError, StopIteration):
+        return None
+
+
+def profile_startup(task: str) -> dict:
+    """统计某个环节的启动成本：解释器启动、各依赖的导入耗时与初始化耗时"""
+    report = {"task": task}
+    age = process_age_s()
+    if age is not None:
+        # 进程启动到本模块开始导入之间（解释器启动 + 标准库），精度受 clock tick 限制
+        report["interpreter_startup_s"] = max(0.0, age - (time.time() - _IMPORT_T0))
+    report["module_import_s"] = time.time() - _IMPORT_T0
+    report["imports_s"] = import_stage_deps(task)
+    init = {}
+    t0 = time.time()
+    if task == "plot":
+        # 首次建图会初始化后端与字体缓存
+        import matplotlib.pyplot as plt
+        plt.figure(); plt.close()
+        init["pyplot_figure"] = time.time() - t0
+    elif "transformer_lens" in STAGE_DEPS[task]:
+        # 只有用到模型的环节才计入模型加载；stats 等环节没有初始化成本
+        import torch
+        load_model_safely(device="cuda" if task != "filter" and torch.cuda.is_available() else "cpu")
+        init["load_model"] = time.time() - t0
+    report["init_s"] = init
+    report["total_s"] = (report.get("interpreter_startup_s", 0.0) + report["module_import_s"]
+                         + sum(report["imports_s"].values()) + sum(init.values()))
+    print(f"[OK] --task {task} 启动成本：")
+    if "interpreter_startup_s" in report:
+        print(f"  {'解释器启动':<24}{report['interpreter_startup_s']:>8.3f}s")
+    print(f"  {'ioi_modules 自身导入':<24}{report['module_import_s']:>8.3f}s")
+    for name, cost in report["imports_s"].items():
+        print(f"  {'import ' + name:<24}{cost:>8.3f}s")
+    for name, cost in init.items():
+        print(f"  {'init ' + name:<24}{cost:>8.3f}s")
+    print(f"  {'合计':<24}{report['total_s']:>8.3f}s")
+    return report
+
+
 def main():
     parser = argparse.ArgumentParser()
-    parser.add_argument("--task", choices=["filter", "collect", "patch", "plot"], required=True)
-    parser.add_argument("--input", required=True)
-    parser.add_argument("--output", required=True)
+    parser.add_argument("--task", choices=list(STAGE_DEPS), required=True)
+    parser.add_argument("--input")
+    parser.add_argument("--output")
     parser.add_argument("--timing-output", default="timing.json")
+    parser.add_argument("--batch-size", type=int, default=1, help="filter/collect 每批 prompt 数，patch 每次前向的 patch 数，circuit 每次前向的行数")
+    parser.add_argument("--num-samples", type=int, default=10, help="patch 抽样的样本数")
+    parser.add_argument("--memory-budget", type=float, default=None, help="内存预算（MB），collect/patch 据此选择最大 batch size")
+    parser.add_argument("--trace-output", default=None, help="导出 Chrome trace-event JSON（不指定则不追踪）")
+    parser.add_argument("--target-mode", choices=["first", "multi"], default="first",
+                        help="collect：first 取 filter 生成答案的首 token；multi 对多 token 目标做 teacher forcing 打分")
+    parser.add_argument("--unembed", choices=["answers", "full"], default="answers",
+                        help="patch：answers 只在需要的位置、只对答案列反嵌入；full 计算完整 logits")
+    parser.add_argument("--adaptive", action="store_true", help="patch：先整层/整块 patch，只在效应超过阈值的块内逐头 patch")
+    parser.add_argument("--adaptive-blocks", type=lambda v: [int(x) for x in v.split(",")], default=None,
+                        help="自适应 patch 各级块大小（头数），如 12,4；默认整层")
+    parser.add_argument("--adaptive-threshold", type=float, default=0.05, help="自适应 patch 的剪枝阈值（|指标|）")
+    parser.add_argument("--prefix-reuse", action="store_true",
+                        help="collect/patch：clean/corrupted 开头相同的部分只前向一次，后缀复用其 KV cache")
+    parser.add_argument("--memo", default=None, help="前向备忘库（SQLite，如 ioi_memo.db），filter/collect/patch 共用；不指定则不启用")
+    parser.add_argument("--memo-max-mb", type=float, default=1024, help="前向备忘库的大小上限（MB），超出时淘汰最久未用的条目")
+    parser.add_argument("--memo-z", action="store_true", help="collect：clean_z 也写入前向备忘")
+    parser.add_argument("--store", default=None, help="patch：另存逐样本结果与元数据（用 ioi_results.py 查询）")
+    parser.add_argument("--n-boot", type=int, default=2000, help="stats：bootstrap 与置换检验的重采样次数")
+    parser.add_argument("--alpha", type=float, default=0.05, help="stats：BH 校正后的 FDR 水平")
+    parser.add_argument("--patch-mode", choices=["patch", "zero", "mean"], default="patch",
+                        help="patch：clean→corrupted 逐头 patch；zero/mean：在 clean 前向中逐头零消融/平均消融")
+    parser.add_argument("--mean-z-cache", default=None, help="平均消融使用的数据集平均 z 缓存（默认 <input>_mean_z.pt）")
+    parser.add_argument("--patterns", default=None, help="collect：另存选定头的压缩注意力模式（ioi_patterns.py 读取）")
+    parser.add_argument("--pattern-heads", default=None, help="collect：保存注意力模式的头，如 9.6,9.9,10.0")
+    parser.add_argument("--pattern-from", default=None, help="collect：从 patch 结果中取 |效应| 最大的头")
+    parser.add_argument("--pattern-top-n", type=int, default=8, help="collect：--pattern-from 时取的头数")
+    parser.add_argument("--pattern-format", choices=["fp16", "topk"], default="fp16", help="collect：fp16 下三角或每行 top-k")
+    parser.add_argument("--pattern-k", type=int, default=8, help="collect：topk 格式每个 query 保留的 key 数")
+    parser.add_argument("--circuit-threshold", type=float, default=0.01, help="circuit：剪边阈值（归一化指标的变化量）")
+    parser.add_argument("--checkpoint", default=None, help="circuit：检查点路径（默认 <output>.ckpt），中断后以相同参数重跑即续跑")
+    parser.add_argument("--model", default=None, help="模型名（如 gpt2-medium、gpt2-large），默认 gpt2-small")
+    parser.add_argument("--stream-weights", default=None, help="patch：按层流式执行，权重按层导出到该目录（ioi_streaming.py）")
+    parser.add_argument("--precision", choices=["fp32", "bf16"], default="fp32",
+                        help="filter/patch：bf16 autocast 推理；先在校准子集上与 fp32 对比，不一致时退回 fp32")
+    parser.add_argument("--precision-calib", type=int, default=None, help="精度守卫的校准规模（filter 默认 32 条样本，patch 默认 2 个样本）")
+    parser.add_argument("--compile", choices=["compile", "trace"], default=None,
+                        help="patch：逐头 patch 走编译后的前向（torch.compile 或 torch.jit.trace，ioi_compiled.py）")
+    parser.add_argument("--profile-startup", action="store_true", help="只统计该环节的导入与初始化耗时，不执行任务")
     args = parser.parse_args()
-    if args.task == "filter": result = filter_with_gpt2(args.input, args.output)
-    elif args.task == "collect": result = get_clean_activations(args.input, args.output)
-    elif args.task == "patch": result = activation_patching(args.input, args.output)
-    elif args.task == "plot": result = plot_heatmap(args.input, args.output)
+    if args.profile_startup:
+        with open(args.timing_output, 'w', encoding='utf-8') as f:
+            json.dump(profile_startup(args.task), f, indent=2)
+        return
+    if not args.input or not args.output:
+        parser.error("执行任务需要 --input 与 --output")
+    if args.model:
+        os.environ["IOI_MODEL"] = args.model
+    tracer = None
+    if args.trace_output:
+        tracer = enable_tracing(f"ioi_modules --task {args.task}")
+        # 模块级 import 的耗时（重量级依赖在下面按环节导入，各自记为 import:<name>）
+        tracer.add_complete("import_modules", int(_IMPORT_T0 * 1e6), now_us() - int(_IMPORT_T0 * 1e6))
+    # 依赖导入在环节计时之外，_time 口径与原先模块级导入时一致
+    import_stage_deps(args.task)
+    with span(args.task), MemoryTracker() as mem:
+        memo_args = {"memo_path": args.memo, "memo_max_mb": args.memo_max_mb}
+        precision_args = {"precision": args.precision, **({"calib": args.precision_calib} if args.precision_calib else {})}
+        if args.task == "filter": result = filter_with_gpt2(args.input, args.output, batch_size=args.batch_size, **memo_args, **precision_args)
+        elif args.task == "collect":
+            pattern_args = {}
+            if args.patterns:
+                from ioi_patterns import select_heads
+                pattern_args = {"pattern_file": args.patterns, "pattern_format": args.pattern_format, "pattern_k": args.pattern_k,
+                                "pattern_heads": select_heads(args.pattern_heads, args.pattern_from, args.pattern_top_n)}
+                if not pattern_args["pattern_heads"]:
+                    parser.error("--patterns 需要 --pattern-heads 或 --pattern-from")
+            result = get_clean_activations(args.input, args.output, batch_size=args.batch_size, memory_budget_mb=args.memory_budget, target_mode=args.target_mode, prefix_reuse=args.prefix_reuse, memo_z=args.memo_z, **memo_args, **pattern_args)
+        elif args.task == "patch": result = activation_patching(args.input, args.output, batch_size=args.batch_size, num_samples=args.num_samples, memory_budget_mb=args.memory_budget, unembed=args.unembed,
+                                                                adaptive=args.adaptive, block_sizes=args.adaptive_blocks, threshold=args.adaptive_threshold, prefix_reuse=args.prefix_reuse, store_file=args.store,
+                                                                mode=args.patch_mode, mean_z_cache=args.mean_z_cache, stream_dir=args.stream_weights, compiled=args.compile, **memo_args, **precision_args)
+        elif args.task == "plot": result = plot_heatmap(args.input, args.output)
+        elif args.task == "dla": result = direct_logit_attribution(args.input, args.output, store_file=args.store)
+        elif args.task == "circuit": result = circuit_discovery(args.input, args.output, num_samples=args.num_samples, batch_size=args.batch_size,
+                                                                threshold=args.circuit_threshold, checkpoint=args.checkpoint)
+        elif args.task == "stats": result = significance_stats(args.input, args.output, n_boot=args.n_boot, alpha=args.alpha)
+    result.update(mem.report())
+    result["import_s"] = dict(IMPORT_COSTS)
     with open(args.timing_output, 'w', encoding='utf-8') as f:
         json.dump(result, f, indent=2)
+    if tracer is not None:
+        tracer.export_chrome(args.trace_output)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -9,10 +9,14 @@ import time
 import subprocess
 from typing import Dict, Any
 
-try:
-    import paramiko
-except ImportError:
-    paramiko = None
+from ioi_history import DEFAULT_DB, record_run
+from ioi_trace import align_offset, enable_tracing, get_tracer, load_chrome, now_us, span
+
+
+# 远端执行需要上传的脚本（ioi_modules.py 及其依赖的本地模块）
+REMOTE_SCRIPTS = ["ioi_modules.py", "ioi_trace.py", "ioi_memory.py", "ioi_memo.py", "ioi_results.py", "ioi_patterns.py", "ioi_streaming.py", "ioi_precision.py", "ioi_compiled.py"]
+# 各环节结果中需要写入计时报告的内存字段
+MEMORY_FIELDS = ["peak_rss_mb", "cuda_peak_mb", "output_tensor_mb", "batch_size"]
 
 
 def load_config(path: str = "hybrid_config.json") -> Dict[str, Any]:
@@ -20,21 +24,34 @@ def load_config(path: str = "hybrid_config.json") -> Dict[str, Any]:
         return json.load(f)
 
 
-def run_local_task(task: str, input_file: str, output_file: str, timing_file: str = "timing_tmp.json") -> dict:
+def run_local_task(task: str, input_file: str, output_file: str, timing_file: str = "timing_tmp.json",
+                   trace_file: str = "trace_tmp.json", extra_args: list = None) -> dict:
     """在本地执行任务"""
+    tracer = get_tracer()
     cmd = ["python", "ioi_modules.py", "--task", task, "--input", input_file, "--output", output_file, "--timing-output", timing_file]
-    proc = subprocess.run(cmd)
+    cmd += extra_args or []
+    if tracer.enabled:
+        cmd += ["--trace-output", trace_file]
+    with span("subprocess", task=task):
+        proc = subprocess.run(cmd)
     if proc.returncode != 0:
         raise RuntimeError(f"本地任务 {task} 执行失败")
     
     with open(timing_file, 'r', encoding='utf-8') as f:
         result = json.load(f)
     os.remove(timing_file)
+    # 本地子进程与编排器共用时钟，直接合并
+    if tracer.enabled and os.path.exists(trace_file):
+        tracer.merge(load_chrome(trace_file), process_name=f"local: ioi_modules --task {task}")
+        os.remove(trace_file)
     return result
 
 
 def ssh_connect(cfg: dict, max_retries: int = 3):
-    if paramiko is None:
+    # 只有远端环节才需要 paramiko，全本地运行不付出其导入开销
+    try:
+        import paramiko
+    except ImportError:
         raise RuntimeError("需要安装 paramiko: pip install paramiko")
     
     pkey = None
@@ -106,8 +123,9 @@ def ensure_remote_dir(ssh, path: str):
     ssh_run(ssh, f"mkdir -p {path}")
 
 
-def run_remote_task(ssh, cfg: dict, task: str, local_input: str, local_output: str, remote_timing: str = "timing_remote_tmp.json") -> dict:
-    """在远端执行任务，返回 {task_time, upload_time, download_time}"""
+def run_remote_task(ssh, cfg: dict, task: str, local_input: str, local_output: str, remote_timing: str = "timing_remote_tmp.json",
+                    extra_args: list = None, extra_outputs: list = None, extra_inputs: list = None) -> dict:
+    """在远端执行任务，返回 {task_time, upload_time, download_time}；extra_inputs / extra_outputs 为需要一并上传 / 下载的其他文件"""
     # --- 添加诊断日志 ---
     print(f"\n--- 开始远程任务: {task} ---")
 
@@ -127,21 +145,27 @@ def run_remote_task(ssh, cfg: dict, task: str, local_input: str, local_output: s
     t_up_0 = time.time()
     remote_input = f"{remote_dir}/{os.path.basename(local_input)}"
     print(f"[诊断日志] 步骤 1/4: 正在上传输入文件 '{local_input}' -> '{remote_input}'...")
-    sftp_put(ssh, local_input, remote_input)
+    with span("upload_input", path=local_input):
+        sftp_put(ssh, local_input, remote_input)
+    for extra in extra_inputs or []:
+        with span("upload_input", path=extra):
+            sftp_put(ssh, extra, f"{remote_dir}/{os.path.basename(extra)}")
     t_up_1 = time.time()
     upload_time = t_up_1 - t_up_0
     print(f"[诊断日志] ...输入文件上传完成 (耗时 {upload_time:.2f}s)。")
 
-    # 2) 上传 ioi_modules.py
+    # 2) 上传 ioi_modules.py 及其依赖模块
     remote_script_name = "ioi_modules.py" # 确保这个是您在远端要执行的脚本名
-    remote_script_path = f"{remote_dir}/{remote_script_name}"
-    print(f"[诊断日志] 步骤 2/4: 正在上传执行脚本 '{remote_script_name}' -> '{remote_script_path}'...")
-    try:
-        sftp_put(ssh, remote_script_name, remote_script_path)
-        print(f"[诊断日志] ...执行脚本上传完成。")
-    except Exception as e:
-        print(f"[诊断日志] ...上传脚本失败或文件已存在，跳过。错误: {e}")
-        pass
+    for script_name in REMOTE_SCRIPTS:
+        remote_script_path = f"{remote_dir}/{script_name}"
+        print(f"[诊断日志] 步骤 2/4: 正在上传执行脚本 '{script_name}' -> '{remote_script_path}'...")
+        try:
+            with span("upload_script", path=script_name):
+                sftp_put(ssh, script_name, remote_script_path)
+            print(f"[诊断日志] ...执行脚本上传完成。")
+        except Exception as e:
+            print(f"[诊断日志] ...上传脚本失败或文件已存在，跳过。错误: {e}")
+            pass
     
     # 3) 执行远端任务
     remote_output = f"{remote_dir}/{os.path.basename(local_output)}"
@@ -154,6 +178,12 @@ def run_remote_task(ssh, cfg: dict, task: str, local_input: str, local_output: s
         f"--output {os.path.basename(local_output)} "
         f"--timing-output {remote_timing}"
     )
+    if extra_args:
+        remote_cmd += " " + " ".join(extra_args)
+    tracer = get_tracer()
+    remote_trace = "trace_remote_tmp.json"
+    if tracer.enabled:
+        remote_cmd += f" --trace-output {remote_trace}"
 
     if setup_cmd:
         remote_cmd = f"{setup_cmd} && {remote_cmd}"
@@ -162,14 +192,21 @@ def run_remote_task(ssh, cfg: dict, task: str, local_input: str, local_output: s
     print(f"    远程工作目录: {remote_dir}")
     print(f"    将要执行的命令: {remote_cmd}")
     
-    ssh_run(ssh, remote_cmd, cwd=remote_dir)
+    exec_start = now_us()
+    with span("remote_exec", task=task):
+        ssh_run(ssh, remote_cmd, cwd=remote_dir)
+    exec_end = now_us()
     
     print(f"[诊断日志] ...远程命令执行完毕！")
 
     # 4) 下载输出文件
     t_down_0 = time.time()
     print(f"[诊断日志] 步骤 4/4: 正在下载输出文件 '{remote_output}' -> '{local_output}'...")
-    sftp_get(ssh, remote_output, local_output)
+    with span("download_output", path=local_output):
+        sftp_get(ssh, remote_output, local_output)
+    for extra in extra_outputs or []:
+        with span("download_output", path=extra):
+            sftp_get(ssh, f"{remote_dir}/{os.path.basename(extra)}", extra)
     t_down_1 = time.time()
     download_time = t_down_1 - t_down_0
     print(f"[诊断日志] ...输出文件下载完成 (耗时 {download_time:.2f}s)。")
@@ -180,6 +217,13 @@ def run_remote_task(ssh, cfg: dict, task: str, local_input: str, local_output: s
         task_result = json.load(f)
     os.remove(remote_timing)
     
+    # 6) 下载并合并远端 trace
+    if tracer.enabled:
+        with span("download_trace"):
+            sftp_get(ssh, f"{remote_dir}/{remote_trace}", remote_trace)
+        merge_remote_trace(remote_trace, task, exec_start, exec_end)
+        os.remove(remote_trace)
+    
     print(f"--- 远程任务 {task} 完成 ---")
     
     return {
@@ -191,19 +235,127 @@ def run_remote_task(ssh, cfg: dict, task: str, local_input: str, local_output: s
     }
 
 
-def run_orchestrator(config_path: str = "hybrid_config.json"):
+def merge_remote_trace(trace_file: str, task: str, exec_start: int, exec_end: int):
+    """
+    将远端 trace 合并到本地 trace
+    远端事件按 remote_exec 窗口的结束对齐，窗口开头到远端第一个 span 之间
+    记为 remote_startup（SSH 通道 + 环境初始化 + 解释器启动）
+    """
+    tracer = get_tracer()
+    events = load_chrome(trace_file)
+    offset = align_offset(events, exec_start, exec_end)
+    tracer.merge(events, process_name=f"remote: ioi_modules --task {task}", offset_us=offset)
+    first = min((e["ts"] for e in events if e.get("ph") == "X"), default=None)
+    if first is not None:
+        tracer.add_complete("remote_startup", exec_start, first + offset - exec_start, args={"task": task})
+
+
+def trace_stage(stage: str, t0_wall: float):
+    """阶段结束后补记一个 stage span（与 *_wall_time 同一区间）"""
+    start = int(t0_wall * 1e6)
+    get_tracer().add_complete(f"stage:{stage}", start, now_us() - start, cat="stage")
+
+
+def record_memory(timing_report: dict, stage: str, result: dict):
+    """把环节的内存统计写入计时报告（键名 <stage>_peak_rss_mb 等）"""
+    for field in MEMORY_FIELDS:
+        if result.get(field) is not None:
+            timing_report[f"{stage}_{field}"] = result[field]
+
+
+def record_precision(timing_report: dict, stage: str, result: dict):
+    """低精度推理时记录实际采用的精度与校准加速比（键名 <stage>_precision 等）"""
+    guard = result.get("precision")
+    if not guard or guard.get("requested") == "fp32":
+        return
+    timing_report[f"{stage}_precision"] = guard["used"]
+    timing_report[f"{stage}_precision_speedup"] = guard.get("speedup")
+
+
+def record_compiled(timing_report: dict, stage: str, result: dict):
+    """编译路径的总编译耗时与各长度的加速比（键名 <stage>_compile_s 等）"""
+    report = result.get("compiled")
+    if not report:
+        return
+    timing_report[f"{stage}_compile_s"] = report["compile_s"]
+    timing_report[f"{stage}_compiled_speedup"] = {seq: b.get("speedup") for seq, b in report["buckets"].items()}
+
+
+def count_records(path: str):
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            return len(json.load(f))
+    except (OSError, ValueError):
+        return None
+
+
+def run_orchestrator(config_path: str = "hybrid_config.json", trace_output: str = None, history_db: str = None,
+                     memory_budget_mb: float = None):
     cfg = load_config(config_path)
     execution = cfg["execution"]
     paths = cfg["paths"]
     
     timing_report = {}
     ssh_conn = None
+    memory_budget_mb = memory_budget_mb or cfg.get("memory_budget_mb")
+    
+    def stage_args(task: str, remote: bool = False) -> list:
+        """把配置转换成各环节的命令行参数"""
+        args = []
+        # 远端在 remote_dir 中执行，文件参数与 --input/--output 一样只传文件名（输出之后从 remote_dir 下载，备忘留在 remote_dir）
+        out_path = os.path.basename if remote else (lambda p: p)
+        if cfg.get("model") and task in ("filter", "collect", "patch"):
+            args += ["--model", cfg["model"]]
+        if cfg.get("precision", {}).get(task):
+            args += ["--precision", cfg["precision"][task]]
+        if task == "patch" and cfg.get("stream_weights"):
+            args += ["--stream-weights", cfg["stream_weights"]]
+        if task == "patch" and cfg.get("compile"):
+            args += ["--compile", cfg["compile"]]
+        if memory_budget_mb and task in ("collect", "patch"):
+            args += ["--memory-budget", str(memory_budget_mb)]
+        if task == "collect" and cfg.get("target_mode"):
+            args += ["--target-mode", cfg["target_mode"]]
+        if task == "patch" and cfg.get("patch_mode"):
+            args += ["--patch-mode", cfg["patch_mode"]]
+        if task == "patch" and cfg.get("unembed"):
+            args += ["--unembed", cfg["unembed"]]
+        if task in ("collect", "patch") and cfg.get("prefix_reuse"):
+            args += ["--prefix-reuse"]
+        if task == "patch" and paths.get("local_results_store"):
+            args += ["--store", out_path(paths["local_results_store"])]
+        memo = cfg.get("memo")
+        if task in ("filter", "collect", "patch") and memo:
+            args += ["--memo", out_path(memo.get("path", "ioi_memo.db")), "--memo-max-mb", str(memo.get("max_mb", 1024))]
+            if task == "collect" and memo.get("z"):
+                args += ["--memo-z"]
+        patterns = cfg.get("patterns")
+        if task == "collect" and patterns:
+            if not patterns.get("heads") and not patterns.get("from"):
+                raise ValueError("patterns 需要 heads（如 \"9.6,9.9\"）或 from（patch 结果文件）来选择头")
+            args += ["--patterns", out_path(patterns.get("path", "patterns.bin")),
+                     "--pattern-format", patterns.get("format", "fp16"), "--pattern-k", str(patterns.get("k", 8))]
+            if patterns.get("heads"):
+                args += ["--pattern-heads", patterns["heads"]]
+            if patterns.get("from"):
+                args += ["--pattern-from", out_path(patterns["from"]), "--pattern-top-n", str(patterns.get("top_n", 8))]
+        adaptive = cfg.get("adaptive_patch")
+        if task == "patch" and adaptive:
+            args += ["--adaptive", "--adaptive-threshold", str(adaptive.get("threshold", 0.05))]
+            if adaptive.get("blocks"):
+                args += ["--adaptive-blocks", ",".join(map(str, adaptive["blocks"]))]
+        return args
+    trace_output = trace_output or paths.get("trace_report")
+    if trace_output:
+        enable_tracing("ioi_orchestrator")
+    t_run0 = now_us()
     
     # 需要远端执行时建立SSH连接
     need_remote = any(loc == "remote" for loc in execution.values())
     if need_remote:
         print("检测到需要远程执行的任务，正在建立SSH连接...")
-        ssh_conn = ssh_connect(cfg["ssh"])
+        with span("ssh_connect", host=cfg["ssh"].get("host")):
+            ssh_conn = ssh_connect(cfg["ssh"])
         print("SSH连接成功！\n")
     
     try:
@@ -214,6 +366,7 @@ def run_orchestrator(config_path: str = "hybrid_config.json"):
         t0_gen_wall = time.time()
         subprocess.run(["python", "ioi_local_pre.py", "--step", "generate"], check=True)
         timing_report["generate_data_wall_time"] = time.time() - t0_gen_wall
+        trace_stage("generate_data", t0_gen_wall)
         
         # 读取内部纯计算时间
         try:
@@ -231,6 +384,7 @@ def run_orchestrator(config_path: str = "hybrid_config.json"):
         t0_check_wall = time.time()
         subprocess.run(["python", "ioi_local_pre.py", "--step", "check"], check=True)
         timing_report["check_structure_wall_time"] = time.time() - t0_check_wall
+        trace_stage("check_structure", t0_check_wall)
         
         # 读取内部纯计算时间
         try:
@@ -250,19 +404,24 @@ def run_orchestrator(config_path: str = "hybrid_config.json"):
         t0_filter_wall = time.time()
         if execution["filter_gpt2"] == "local":
             print("[本地执行]")
-            result = run_local_task("filter", paths["local_data_check1"], paths["local_data_check2"])
+            result = run_local_task("filter", paths["local_data_check1"], paths["local_data_check2"], extra_args=stage_args("filter"))
             timing_report["filter_gpt2_time"] = result["time"]
             timing_report["filter_gpt2_wall_time"] = time.time() - t0_filter_wall
             timing_report["filter_gpt2_location"] = "local"
+            record_memory(timing_report, "filter_gpt2", result)
+            record_precision(timing_report, "filter_gpt2", result)
         else:
             print("[远端执行]")
-            result = run_remote_task(ssh_conn, cfg, "filter", paths["local_data_check1"], paths["local_data_check2"])
+            result = run_remote_task(ssh_conn, cfg, "filter", paths["local_data_check1"], paths["local_data_check2"], extra_args=stage_args("filter", remote=True))
             timing_report["filter_gpt2_time"] = result["task_time"]
             timing_report["filter_gpt2_upload_time"] = result["upload_time"]
             timing_report["filter_gpt2_download_time"] = result["download_time"]
             timing_report["filter_gpt2_total_time"] = result["total_time"]
             timing_report["filter_gpt2_wall_time"] = time.time() - t0_filter_wall
             timing_report["filter_gpt2_location"] = "remote"
+            record_memory(timing_report, "filter_gpt2", result["meta"])
+            record_precision(timing_report, "filter_gpt2", result["meta"])
+        trace_stage("filter_gpt2", t0_filter_wall)
         print()
         
         # 任务2: collect_activations
@@ -272,19 +431,26 @@ def run_orchestrator(config_path: str = "hybrid_config.json"):
         t0_collect_wall = time.time()
         if execution["collect_activations"] == "local":
             print("[本地执行]")
-            result = run_local_task("collect", paths["local_data_check2"], paths["local_saved"])
+            result = run_local_task("collect", paths["local_data_check2"], paths["local_saved"], extra_args=stage_args("collect"))
             timing_report["collect_activations_time"] = result["time"]
             timing_report["collect_activations_wall_time"] = time.time() - t0_collect_wall
             timing_report["collect_activations_location"] = "local"
+            record_memory(timing_report, "collect_activations", result)
         else:
             print("[远端执行]")
-            result = run_remote_task(ssh_conn, cfg, "collect", paths["local_data_check2"], paths["local_saved"])
+            patterns = cfg.get("patterns")
+            pattern_files = [patterns.get("path", "patterns.bin")] if patterns else []
+            result = run_remote_task(ssh_conn, cfg, "collect", paths["local_data_check2"], paths["local_saved"], extra_args=stage_args("collect", remote=True),
+                                     extra_outputs=pattern_files + [f + ".idx.json" for f in pattern_files],
+                                     extra_inputs=[patterns["from"]] if patterns and patterns.get("from") else None)
             timing_report["collect_activations_time"] = result["task_time"]
             timing_report["collect_activations_upload_time"] = result["upload_time"]
             timing_report["collect_activations_download_time"] = result["download_time"]
             timing_report["collect_activations_total_time"] = result["total_time"]
             timing_report["collect_activations_wall_time"] = time.time() - t0_collect_wall
             timing_report["collect_activations_location"] = "remote"
+            record_memory(timing_report, "collect_activations", result["meta"])
+        trace_stage("collect_activations", t0_collect_wall)
         print()
         
         # 任务3: patch_activations
@@ -294,19 +460,28 @@ def run_orchestrator(config_path: str = "hybrid_config.json"):
         t0_patch_wall = time.time()
         if execution["patch_activations"] == "local":
             print("[本地执行]")
-            result = run_local_task("patch", paths["local_saved"], paths["local_results"])
+            result = run_local_task("patch", paths["local_saved"], paths["local_results"], extra_args=stage_args("patch"))
             timing_report["patch_activations_time"] = result["time"]
             timing_report["patch_activations_wall_time"] = time.time() - t0_patch_wall
             timing_report["patch_activations_location"] = "local"
+            record_memory(timing_report, "patch_activations", result)
+            record_precision(timing_report, "patch_activations", result)
+            record_compiled(timing_report, "patch_activations", result)
         else:
             print("[远端执行]")
-            result = run_remote_task(ssh_conn, cfg, "patch", paths["local_saved"], paths["local_results"])
+            store = [paths["local_results_store"]] if paths.get("local_results_store") else None
+            result = run_remote_task(ssh_conn, cfg, "patch", paths["local_saved"], paths["local_results"], extra_args=stage_args("patch", remote=True),
+                                     extra_outputs=store)
             timing_report["patch_activations_time"] = result["task_time"]
             timing_report["patch_activations_upload_time"] = result["upload_time"]
             timing_report["patch_activations_download_time"] = result["download_time"]
             timing_report["patch_activations_total_time"] = result["total_time"]
             timing_report["patch_activations_wall_time"] = time.time() - t0_patch_wall
             timing_report["patch_activations_location"] = "remote"
+            record_memory(timing_report, "patch_activations", result["meta"])
+            record_precision(timing_report, "patch_activations", result["meta"])
+            record_compiled(timing_report, "patch_activations", result["meta"])
+        trace_stage("patch_activations", t0_patch_wall)
         print()
         
         # 任务4: plot_heatmap
@@ -316,24 +491,32 @@ def run_orchestrator(config_path: str = "hybrid_config.json"):
         t0_plot_wall = time.time()
         if execution["plot_heatmap"] == "local":
             print("[本地执行]")
-            result = run_local_task("plot", paths["local_results"], paths["local_heatmap"])
+            result = run_local_task("plot", paths["local_results"], paths["local_heatmap"], extra_args=stage_args("plot"))
             timing_report["plot_heatmap_time"] = result["time"]
             timing_report["plot_heatmap_wall_time"] = time.time() - t0_plot_wall
             timing_report["plot_heatmap_location"] = "local"
+            record_memory(timing_report, "plot_heatmap", result)
         else:
             print("[远端执行]")
-            result = run_remote_task(ssh_conn, cfg, "plot", paths["local_results"], paths["local_heatmap"])
+            result = run_remote_task(ssh_conn, cfg, "plot", paths["local_results"], paths["local_heatmap"], extra_args=stage_args("plot", remote=True))
             timing_report["plot_heatmap_time"] = result["task_time"]
             timing_report["plot_heatmap_upload_time"] = result["upload_time"]
             timing_report["plot_heatmap_download_time"] = result["download_time"]
             timing_report["plot_heatmap_total_time"] = result["total_time"]
             timing_report["plot_heatmap_wall_time"] = time.time() - t0_plot_wall
             timing_report["plot_heatmap_location"] = "remote"
+            record_memory(timing_report, "plot_heatmap", result["meta"])
+        trace_stage("plot_heatmap", t0_plot_wall)
         print()
         
     finally:
         if ssh_conn:
             ssh_conn.close()
+        tracer = get_tracer()
+        tracer.add_complete("orchestrator", t_run0, now_us() - t_run0, args={"config": config_path})
+        if trace_output:
+            tracer.export_chrome(trace_output)
+            print(f"[OK] Chrome trace 已导出至 {trace_output}（chrome://tracing 或 https://ui.perfetto.dev 打开）")
     
     # 保存计时报告
     with open(paths["timing_report"], 'w', encoding='utf-8') as f:
@@ -346,16 +529,35 @@ def run_orchestrator(config_path: str = "hybrid_config.json"):
     # 打印汇总
     print("\n计时汇总：")
     for k, v in timing_report.items():
-        if isinstance(v, float):
+        if k.endswith("_mb"):
+            print(f"  {k}: {v:.1f}MB")
+        elif isinstance(v, float):
             print(f"  {k}: {v:.3f}s")
         else:
             print(f"  {k}: {v}")
+    
+    # 追加到运行历史库（失败不影响本次结果）
+    # history_db 为 None 时取配置，为空串时不记录
+    if history_db is None:
+        history_db = paths.get("history_db", DEFAULT_DB)
+    if history_db:
+        try:
+            run_id = record_run(history_db, config_path, cfg, timing_report,
+                                dataset_size=count_records(paths.get("local_data", "data.json")))
+            print(f"\n[OK] 已记录到运行历史 {history_db} (run #{run_id})")
+        except Exception as e:
+            print(f"\n[WARN] 写入运行历史失败: {e}")
 
 
 if __name__ == "__main__":
     import argparse
     parser = argparse.ArgumentParser()
     parser.add_argument("--config", default="hybrid_config.json", help="配置文件路径")
+    parser.add_argument("--trace-output", default=None, help="导出 Chrome trace-event JSON（也可在 paths.trace_report 中配置）")
+    parser.add_argument("--history-db", default=None, help=f"运行历史库路径（默认 paths.history_db 或 {DEFAULT_DB}）")
+    parser.add_argument("--no-history", action="store_true", help="不记录到运行历史库")
+    parser.add_argument("--memory-budget", type=float, default=None, help="内存预算（MB），collect/patch 据此选择 batch size（也可配置 memory_budget_mb）")
     args = parser.parse_args()
     
-    run_orchestrator(args.config)
\ No newline at end of file
+    run_orchestrator(args.config, trace_output=args.trace_output, history_db="" if args.no_history else args.history_db,
+                     memory_budget_mb=args.memory_budget)
\ No newline at end of file
@@ -0,0 +1,182 @@
+"""
+选定注意力头的注意力模式（hook_pattern）的压缩存储与按需读取
+全部头 × 全部样本的注意力模式随 seq² 增长，collect 只为选定的头（或上次 patch 结果中 |效应| 最大的 N 个头）保存：
+- fp16：只存因果下三角，半精度
+- topk：每个 query 位置只存权重最大的 k 个 key（fp16 权重 + int16 位置），其余视为 0
+数据文件是逐样本的原始字节首尾相接（fp16 下三角值；或 fp16 权重后接 int16 位置），
+索引（<数据文件>.idx.json）记录每个样本的偏移、长度与序列长度；读取时只 seek 到需要的样本，不整体载入
+
+用法：
+    python ioi_modules.py --task collect --input data_check2.json --output saved_data.pt --patterns patterns.bin --pattern-heads 9.6,9.9,10.0
+    python ioi_modules.py --task collect ... --patterns patterns.bin --pattern-from results.pt --pattern-top-n 8 --pattern-format topk --pattern-k 4
+    python ioi_patterns.py --patterns patterns.bin --info
+    python ioi_patterns.py --patterns patterns.bin --sample 3 --head 9.9 --output pattern_3.png
+"""
+import os
+import json
+import argparse
+from typing import Dict, List, Optional, Tuple
+
+import torch
+
+FORMATS = ("fp16", "topk")
+
+
+def parse_heads(spec: str) -> List[Tuple[int, int]]:
+    """层.头 列表，如 "9.6,9.9,10.0" -> [(9, 6), (9, 9), (10, 0)]"""
+    heads = []
+    for item in spec.split(","):
+        layer, head = item.strip().split(".")
+        heads.append((int(layer), int(head)))
+    return sorted(set(heads))
+
+
+def top_heads(results_file: str, top_n: int) -> List[Tuple[int, int]]:
+    """从 patch 结果（平均矩阵、查询结果或结果存储）中取 |值| 最大的 top_n 个头"""
+    data = torch.load(results_file, map_location="cpu")
+    if isinstance(data, dict):
+        data = data["effects"].mean(dim=0) if "effects" in data else data["value"]
+    n_heads = data.shape[1]
+    idx = torch.topk(data.abs().flatten(), min(top_n, data.numel())).indices.tolist()
+    return sorted((i // n_heads, i % n_heads) for i in idx)
+
+
+def select_heads(spec: Optional[str] = None, results_file: Optional[str] = None, top_n: int = 0) -> List[Tuple[int, int]]:
+    heads = set(parse_heads(spec)) if spec else set()
+    if results_file and top_n:
+        heads.update(top_heads(results_file, top_n))
+    return sorted(heads)
+
+
+def compress(pattern: torch.Tensor, fmt: str, k: int) -> bytes:
+    """pattern: [n_heads_selected, q, k] -> 紧凑记录的字节"""
+    q = pattern.shape[-1]
+    if fmt == "fp16":
+        rows, cols = torch.tril_indices(q, q)
+        return pattern[:, rows, cols].half().cpu().numpy().tobytes()
+    if fmt == "topk":
+        values, index = pattern.topk(min(k, q), dim=-1)
+        return values.half().cpu().numpy().tobytes() + index.to(torch.int16).cpu().numpy().tobytes()
+    raise ValueError(f"未知的格式: {fmt}（可选 {', '.join(FORMATS)}）")
+
+
+def decompress(data: bytes, n_heads: int, q: int, fmt: str, k: int) -> torch.Tensor:
+    """紧凑记录 -> [n_heads_selected, q, k] float32（topk 格式中未保存的位置为 0）"""
+    out = torch.zeros(n_heads, q, q)
+    if fmt == "fp16":
+        rows, cols = torch.tril_indices(q, q)
+        out[:, rows, cols] = torch.frombuffer(bytearray(data), dtype=torch.float16).float().view(n_heads, -1)
+        return out
+    k = min(k, q)
+    split = n_heads * q * k * 2
+    values = torch.frombuffer(bytearray(data[:split]), dtype=torch.float16).float().view(n_heads, q, k)
+    index = torch.frombuffer(bytearray(data[split:]), dtype=torch.int16).long().view(n_heads, q, k)
+    return out.scatter_(-1, index, values)
+
+
+class PatternWriter:
+    """collect 逐批写入；样本可以乱序到达（按长度分批），重复样本用 alias 指向同一条记录"""
+
+    def __init__(self, path: str, heads: List[Tuple[int, int]], fmt: str = "fp16", k: int = 8):
+        if fmt not in FORMATS:
+            raise ValueError(f"未知的格式: {fmt}（可选 {', '.join(FORMATS)}）")
+        self.path, self.heads, self.fmt, self.k = path, heads, fmt, k
+        self.file = open(path, "wb")
+        self.records: Dict[int, List[int]] = {}
+        self.dense_bytes = 0
+
+    def add(self, sample: int, pattern: torch.Tensor):
+        data = compress(pattern, self.fmt, self.k)
+        self.records[sample] = [self.file.tell(), len(data), pattern.shape[-1]]
+        self.file.write(data)
+        self.dense_bytes += pattern.numel() * 4
+
+    def alias(self, sample: int, source: int):
+        if source in self.records:
+            self.records[sample] = self.records[source]
+
+    def close(self) -> Dict:
+        size = self.file.tell()
+        self.file.close()
+        index = {"heads": self.heads, "format": self.fmt, "k": self.k, "records": {str(i): r for i, r in self.records.items()}}
+        with open(self.path + ".idx.json", "w", encoding="utf-8") as f:
+            json.dump(index, f)
+        return {"path": self.path, "heads": len(self.heads), "format": self.fmt, "samples": len(self.records),
+                "size_mb": round(size / 1024 / 1024, 3),
+                "compression": round(self.dense_bytes / size, 2) if size else 0.0}
+
+
+class PatternStore:
+    """按需读取：get(sample) 只读取该样本的记录并还原为 [n_heads_selected, q, k]"""
+
+    def __init__(self, path: str):
+        with open(path + ".idx.json", "r", encoding="utf-8") as f:
+            index = json.load(f)
+        self.path = path
+        self.heads = [tuple(h) for h in index["heads"]]
+        self.fmt, self.k = index["format"], index["k"]
+        self.records = {int(i): r for i, r in index["records"].items()}
+        self._file = None
+
+    def __len__(self) -> int:
+        return len(self.records)
+
+    def get(self, sample: int) -> torch.Tensor:
+        if sample not in self.records:
+            raise KeyError(f"样本 {sample} 没有保存注意力模式")
+        if self._file is None:
+            self._file = open(self.path, "rb")
+        offset, length, seq = self.records[sample]
+        self._file.seek(offset)
+        return decompress(self._file.read(length), len(self.heads), seq, self.fmt, self.k)
+
+    def head(self, sample: int, layer: int, head: int) -> torch.Tensor:
+        if (layer, head) not in self.heads:
+            raise KeyError(f"L{layer}H{head} 不在保存的头中: {self.heads}")
+        return self.get(sample)[self.heads.index((layer, head))]
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+def plot_sample(store: PatternStore, sample: int, heads: List[Tuple[int, int]], output_file: str):
+    """一个样本的若干头各画一张注意力热力图（行为 query，列为 key）"""
+    import matplotlib.pyplot as plt
+    patterns = store.get(sample)
+    fig, axes = plt.subplots(1, len(heads), figsize=(5 * len(heads), 4.5), squeeze=False)
+    for ax, (layer, head) in zip(axes[0], heads):
+        im = ax.imshow(patterns[store.heads.index((layer, head))], cmap="Blues", vmin=0, vmax=1)
+        ax.set_title(f"sample {sample}, L{layer}H{head}" + (f" (top-{store.k})" if store.fmt == "topk" else ""))
+        ax.set_xlabel("key")
+        ax.set_ylabel("query")
+        fig.colorbar(im, ax=ax, fraction=0.046)
+    fig.tight_layout()
+    fig.savefig(output_file, dpi=150)
+    plt.close(fig)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="读取 collect 保存的压缩注意力模式")
+    parser.add_argument("--patterns", required=True, help="collect --patterns 输出的数据文件")
+    parser.add_argument("--info", action="store_true", help="只显示保存的头、格式与样本数")
+    parser.add_argument("--sample", type=int, default=0)
+    parser.add_argument("--head", default=None, help="要画的头，如 9.9 或 9.6,9.9；默认全部保存的头")
+    parser.add_argument("--output", default="pattern.png")
+    args = parser.parse_args()
+
+    store = PatternStore(args.patterns)
+    if args.info:
+        size = os.path.getsize(args.patterns) / 1024 / 1024
+        print(f"heads: {' '.join(f'L{l}H{h}' for l, h in store.heads)}")
+        print(f"format: {store.fmt}" + (f" (k={store.k})" if store.fmt == "topk" else "") + f", samples: {len(store)}, size: {size:.3f}MB")
+        return
+    heads = parse_heads(args.head) if args.head else store.heads
+    plot_sample(store, args.sample, heads, args.output)
+    store.close()
+    print(f"[OK] 样本 {args.sample} 的注意力模式 -> {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,61 @@
+"""
+模型环节的低精度推理与精度守卫
+filter 只需要 argmax token，patch 的筛查只需要近似的头效应，都不必用 fp32：
+- bf16：前向在 torch.autocast(bfloat16) 下执行（CPU 与 CUDA 均可），einsum/matmul 以 bf16 计算，权重不变
+执行前先在校准子集上分别以 fp32 与低精度各跑一次，结果不一致（filter 的保留判定、patch 的 top-k 头排名）时
+整个环节退回 fp32；校准的两次耗时之比即该环节的加速比
+只依赖标准库，torch 在用到时导入
+"""
+import time
+import contextlib
+from typing import Callable, Dict
+
+PRECISIONS = ("fp32", "bf16")
+
+
+def autocast(precision: str, device: str = "cpu"):
+    """precision 对应的前向上下文；fp32 时什么都不做"""
+    if precision == "fp32":
+        return contextlib.nullcontext()
+    if precision == "bf16":
+        import torch
+        return torch.autocast(device_type="cuda" if str(device).startswith("cuda") else "cpu", dtype=torch.bfloat16)
+    raise ValueError(f"未知的精度: {precision}（可选 {', '.join(PRECISIONS)}）")
+
+
+def precision_guard(run: Callable, same: Callable, precision: str, label: str) -> Dict:
+    """
+    run(precision) 在校准子集上执行并返回结果；same(fp32 结果, 低精度结果) -> (是否一致, 说明)
+    返回 {"requested", "used", "agree", "detail", "fp32_s", "low_s", "speedup"}；不一致时 used 为 fp32
+    """
+    if precision == "fp32":
+        return {"requested": "fp32", "used": "fp32"}
+    t0 = time.time()
+    reference = run("fp32")
+    t1 = time.time()
+    low = run(precision)
+    t2 = time.time()
+    agree, detail = same(reference, low)
+    report = {"requested": precision, "used": precision if agree else "fp32", "agree": agree, "detail": detail,
+              "fp32_s": round(t1 - t0, 4), "low_s": round(t2 - t1, 4),
+              "speedup": round((t1 - t0) / (t2 - t1), 3) if t2 > t1 else None}
+    if agree:
+        print(f"[日志] {label} 精度守卫：{precision} 与 fp32 一致（{detail}），校准加速比 {report['speedup']}x")
+    else:
+        print(f"[WARN] {label} 精度守卫：{precision} 与 fp32 不一致（{detail}），退回 fp32")
+    return report
+
+
+def same_decisions(reference, low):
+    """filter：两种精度下每条样本的保留判定相同"""
+    diff = sum(1 for a, b in zip(reference, low) if a != b)
+    return diff == 0, f"{len(reference) - diff}/{len(reference)} 条判定相同"
+
+
+def same_top_heads(k: int):
+    """patch：两种精度下 |平均效应| 最大的 k 个头及其顺序相同"""
+    def check(reference, low):
+        n_heads = reference.shape[-1]
+        top = [[(i // n_heads, i % n_heads) for i in x.abs().flatten().topk(k).indices.tolist()] for x in (reference, low)]
+        return top[0] == top[1], f"top-{k}: " + " ".join(f"L{l}H{h}" for l, h in top[1])
+    return check
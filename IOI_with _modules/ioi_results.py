@@ -0,0 +1,228 @@
+"""
+逐样本 patch 结果的列式存储与查询
+patch 的 results.pt 只保存 12×12 的平均值；指定 --store 时另存每个样本的指标 [samples, layers, heads]
+与样本元数据列（模板、名字对、token 长度、clean/corrupted logits diff），之后的分组、中位数/分位数、top-k
+等问题直接在已有结果上向量化计算，无需重新 patch
+
+用法：
+    python ioi_results.py --store results_store.pt --info
+    python ioi_results.py --store results_store.pt --where "seq_len>=16" --reduce median --top-k 10
+    python ioi_results.py --store results_store.pt --group-by template --reduce mean --output by_template.pt
+    python ioi_modules.py --task plot --input by_template.pt --output HeatMap_by_template.png
+"""
+import re
+import argparse
+from typing import Dict, List, Optional
+
+import torch
+
+# 分类列保存为整数编码 + 取值表
+CATEGORICAL = ("template", "name_a", "name_b", "name_pair")
+REDUCTIONS = ("mean", "median", "quantile", "std", "abs_mean", "min", "max")
+
+
+def template_of(clean: str, name_a: str, name_b: str) -> str:
+    """把 clean 句中的两个名字换回 A/B，得到模板（同一模板的样本共享）"""
+    names = {name_a: "A", name_b: "B"}
+    pattern = r"\b(" + "|".join(re.escape(n) for n in sorted(names, key=len, reverse=True) if n) + r")\b"
+    return re.sub(pattern, lambda m: names[m.group(0)], clean) if names else clean
+
+
+def record_meta(item: Dict) -> Dict:
+    """collect 为每个保留的样本记录的元数据"""
+    name_a, name_b = item["corrupted_answer"].strip(), item["clean_answer"].strip()
+    return {"template": template_of(item["clean"], name_a, name_b), "name_a": name_a, "name_b": name_b}
+
+
+def encode_column(values: List[str]):
+    levels = sorted(set(values))
+    index = {v: i for i, v in enumerate(levels)}
+    return torch.tensor([index[v] for v in values], dtype=torch.long), levels
+
+
+def reduce_effects(effects: torch.Tensor, how: str = "mean", q: float = 0.5) -> torch.Tensor:
+    """沿样本维归约 [n, layers, heads] -> [layers, heads]"""
+    if effects.shape[0] == 0:
+        return torch.full(effects.shape[1:], float("nan"))
+    if how == "mean":
+        return effects.mean(dim=0)
+    if how == "median":
+        return effects.quantile(0.5, dim=0)
+    if how == "quantile":
+        return effects.quantile(q, dim=0)
+    if how == "std":
+        return effects.std(dim=0, unbiased=effects.shape[0] > 1)
+    if how == "abs_mean":
+        return effects.abs().mean(dim=0)
+    if how == "min":
+        return effects.min(dim=0).values
+    if how == "max":
+        return effects.max(dim=0).values
+    raise ValueError(f"未知的归约方式: {how}（可选 {', '.join(REDUCTIONS)}）")
+
+
+class ResultStore:
+    """
+    effects: [samples, layers, heads] 的指标 (patched - corrupted) / (clean - corrupted)
+    columns: 每列一个长度为 samples 的张量；CATEGORICAL 中的列为编码，取值表在 levels
+    查询方法都返回新的 ResultStore（共享底层张量）或 [layers, heads] 张量，不修改原存储
+    """
+
+    def __init__(self, effects: torch.Tensor, columns: Dict[str, torch.Tensor], levels: Dict[str, List[str]],
+                 info: Optional[Dict] = None):
+        self.effects = effects
+        self.columns = columns
+        self.levels = levels
+        self.info = info or {}
+
+    @classmethod
+    def from_patching(cls, effects: torch.Tensor, samples: List[int], meta: Optional[Dict[str, List[str]]],
+                      seq_lens: List[int], clean_diffs, corrupted_diffs, info: Optional[Dict] = None) -> "ResultStore":
+        columns = {
+            "sample": torch.tensor(samples, dtype=torch.long),
+            "seq_len": torch.tensor(seq_lens, dtype=torch.long),
+            "clean_logit_diff": torch.tensor([float(x) for x in clean_diffs]),
+            "corrupted_logit_diff": torch.tensor([float(x) for x in corrupted_diffs]),
+        }
+        levels = {}
+        if meta:
+            rows = {k: [meta[k][i] for i in samples] for k in ("template", "name_a", "name_b")}
+            rows["name_pair"] = [f"{a}/{b}" for a, b in zip(rows["name_a"], rows["name_b"])]
+            for name in CATEGORICAL:
+                columns[name], levels[name] = encode_column(rows[name])
+        return cls(effects.detach().float().cpu(), columns, levels, info)
+
+    def save(self, path: str):
+        torch.save({"effects": self.effects, "columns": self.columns, "levels": self.levels, "info": self.info}, path)
+
+    @classmethod
+    def load(cls, path: str) -> "ResultStore":
+        data = torch.load(path, map_location="cpu")
+        return cls(data["effects"], data["columns"], data["levels"], data.get("info"))
+
+    def __len__(self) -> int:
+        return self.effects.shape[0]
+
+    def labels(self, column: str) -> List:
+        """列的逐样本取值（分类列还原为字符串）"""
+        values = self.columns[column].tolist()
+        if column in self.levels:
+            return [self.levels[column][v] for v in values]
+        return values
+
+    def _code(self, column: str, value):
+        if column not in self.levels:
+            return value
+        if value in self.levels[column]:
+            return self.levels[column].index(value)
+        if isinstance(value, int) or (isinstance(value, str) and value.isdigit()):
+            return int(value)
+        return -1
+
+    def filter(self, mask: torch.Tensor) -> "ResultStore":
+        return ResultStore(self.effects[mask], {k: v[mask] for k, v in self.columns.items()}, self.levels, self.info)
+
+    def where(self, **conditions) -> "ResultStore":
+        """列等于给定值（或属于给定列表）；分类列可用取值或编码"""
+        mask = torch.ones(len(self), dtype=torch.bool)
+        for column, value in conditions.items():
+            values = value if isinstance(value, (list, tuple, set)) else [value]
+            codes = torch.tensor([self._code(column, v) for v in values], dtype=self.columns[column].dtype)
+            mask &= torch.isin(self.columns[column], codes)
+        return self.filter(mask)
+
+    def reduce(self, how: str = "mean", q: float = 0.5) -> torch.Tensor:
+        return reduce_effects(self.effects, how, q)
+
+    def group_by(self, column: str, how: str = "mean", q: float = 0.5) -> Dict:
+        """按列分组归约，返回 {取值: [layers, heads]}；mean 一次 index_add 完成，其余按组切片"""
+        codes = self.columns[column]
+        uniq, inverse, counts = torch.unique(codes, return_inverse=True, return_counts=True)
+        if how == "mean":
+            sums = torch.zeros(len(uniq), *self.effects.shape[1:]).index_add_(0, inverse, self.effects)
+            values = sums / counts[:, None, None]
+        else:
+            order = torch.argsort(inverse, stable=True)
+            values = [reduce_effects(chunk, how, q) for chunk in torch.split(self.effects[order], counts.tolist())]
+        keys = [self.levels[column][c] if column in self.levels else c for c in uniq.tolist()]
+        return {k: v for k, v in zip(keys, values)}
+
+    def top_k(self, k: int = 10, how: str = "mean", q: float = 0.5, by_abs: bool = True) -> List[Dict]:
+        value = self.reduce(how, q)
+        flat = value.abs().flatten() if by_abs else value.flatten()
+        idx = torch.topk(flat, min(k, flat.numel())).indices
+        n_heads = value.shape[1]
+        return [{"layer": i // n_heads, "head": i % n_heads, "value": float(value.flatten()[i])} for i in idx.tolist()]
+
+    def describe(self) -> Dict:
+        return {"samples": len(self), "shape": list(self.effects.shape), "columns": list(self.columns),
+                "levels": {k: len(v) for k, v in self.levels.items()}, "info": self.info}
+
+
+def parse_condition(store: ResultStore, expr: str) -> torch.Tensor:
+    """
+    命令行条件：col=v1|v2（等于其一），数值列还可用 col>=v、col<=v、col>v、col<v
+    取值以 | 分隔而不是逗号：模板文本本身含有逗号（"..., B gave ..."）
+    """
+    m = re.match(r"^\s*(\w+)\s*(>=|<=|=|>|<)\s*(.+?)\s*$", expr)
+    if not m:
+        raise ValueError(f"无法解析的条件: {expr}")
+    column, op, value = m.groups()
+    if column not in store.columns:
+        raise ValueError(f"未知的列: {column}（可选 {', '.join(store.columns)}）")
+    col = store.columns[column]
+    if op == "=":
+        codes = [store._code(column, v if column in store.levels else float(v)) for v in value.split("|")]
+        return torch.isin(col, torch.tensor(codes, dtype=col.dtype))
+    v = float(value)
+    return {">=": col >= v, "<=": col <= v, ">": col > v, "<": col < v}[op]
+
+
+def run_query(store: ResultStore, where: Optional[List[str]] = None, group_by: Optional[str] = None,
+              how: str = "mean", q: float = 0.5) -> Dict:
+    """
+    条件过滤后归约；返回可直接交给 plot 的查询结果：
+    {"value": [layers, heads], "title": ...} 或分组时 {"groups": {取值: [layers, heads]}, "title": ...}
+    """
+    for expr in where or []:
+        store = store.filter(parse_condition(store, expr))
+    label = f"{how}{'' if how != 'quantile' else f'(q={q})'}"
+    title = f"{label} over {len(store)} samples" + (f" where {' & '.join(where)}" if where else "")
+    if group_by:
+        return {"groups": store.group_by(group_by, how, q), "title": f"{title}, by {group_by}", "samples": len(store)}
+    return {"value": store.reduce(how, q), "title": title, "samples": len(store)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="逐样本 patch 结果的查询")
+    parser.add_argument("--store", required=True, help="patch --store 输出的结果存储")
+    parser.add_argument("--where", action="append", default=[], help="过滤条件，可多次指定，如 template=0|2、seq_len>=16；模板也可直接写文本")
+    parser.add_argument("--group-by", default=None, help="按列分组（如 template、name_pair、seq_len）")
+    parser.add_argument("--reduce", choices=REDUCTIONS, default="mean")
+    parser.add_argument("--q", type=float, default=0.5, help="--reduce quantile 的分位点")
+    parser.add_argument("--top-k", type=int, default=0, help="列出归约后 |值| 最大的 k 个头")
+    parser.add_argument("--output", default=None, help="保存查询结果（plot 可直接绘制）")
+    parser.add_argument("--info", action="store_true", help="只显示存储的列与规模")
+    args = parser.parse_args()
+
+    store = ResultStore.load(args.store)
+    if args.info:
+        print(store.describe())
+        for column, levels in store.levels.items():
+            print(f"{column}: " + "; ".join(f"{i}={v}" for i, v in enumerate(levels[:20])) + (" ..." if len(levels) > 20 else ""))
+        return
+    result = run_query(store, args.where, args.group_by, args.reduce, args.q)
+    print(f"[OK] {result['title']}")
+    if args.top_k:
+        filtered = store
+        for expr in args.where:
+            filtered = filtered.filter(parse_condition(filtered, expr))
+        for row in filtered.top_k(args.top_k, args.reduce, args.q):
+            print(f"  L{row['layer']}H{row['head']}: {row['value']:+.3f}")
+    if args.output:
+        torch.save(result, args.output)
+        print(f"[OK] 查询结果已保存 -> {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,145 @@
+"""
+头效应的不确定性：bootstrap 置信区间与符号翻转置换检验（全部头同时计算）
+输入为 patch --store 的逐样本结果 [samples, layers, heads]，每次重采样都是一次矩阵乘法：
+- bootstrap：重采样计数矩阵 W [B, N]（每行是 N 次有放回抽样的计数），均值 = W @ X / N
+- 置换检验：H0 为头效应均值为 0、样本效应关于 0 对称，随机符号矩阵 S [B, N]，零分布均值 = S @ X / N
+重采样按块生成，单块 [B_chunk, N] 的全部临时张量合计不超过 chunk_mb，数万样本时内存仍有界
+多重比较用 Benjamini-Hochberg 控制 FDR，输出的 significant 掩码可直接叠加到热力图上
+
+用法：
+    python ioi_stats.py --store results_store.pt --output stats.pt --n-boot 2000 --alpha 0.05
+    python ioi_modules.py --task plot --input stats.pt --output HeatMap_sig.png
+"""
+import math
+import argparse
+from typing import Dict, List, Optional
+
+import torch
+
+from ioi_results import ResultStore, parse_condition
+
+MB = 1024 * 1024
+
+
+# 每块 [B_chunk, N] 上同时存活的临时张量，每个元素的字节数
+# bootstrap：int64 抽样下标 + float32 的 1 + float32 计数；符号翻转：int64 随机位 + float32 符号（原地变换）
+BOOT_BYTES = 8 + 4 + 4
+FLIP_BYTES = 8 + 4
+
+
+def _chunks(total: int, n_samples: int, chunk_mb: float, elem_bytes: int):
+    """每块的重采样次数，使该块的临时张量合计不超过 chunk_mb"""
+    per_chunk = max(1, int(chunk_mb * MB // (elem_bytes * max(n_samples, 1))))
+    for start in range(0, total, per_chunk):
+        yield min(per_chunk, total - start)
+
+
+def bootstrap_means(x: torch.Tensor, n_boot: int, generator: torch.Generator, chunk_mb: float = 256) -> torch.Tensor:
+    """x: [N, K] -> [n_boot, K]，每行是一次有放回重采样的均值"""
+    n = x.shape[0]
+    out = []
+    for b in _chunks(n_boot, n, chunk_mb, BOOT_BYTES):
+        idx = torch.randint(n, (b, n), generator=generator, device=x.device)
+        counts = torch.zeros(b, n, device=x.device).scatter_add_(1, idx, torch.ones(b, n, device=x.device))
+        out.append(counts @ x / n)
+    return torch.cat(out)
+
+
+def sign_flip_pvalues(x: torch.Tensor, n_perm: int, generator: torch.Generator, chunk_mb: float = 256) -> torch.Tensor:
+    """双侧符号翻转检验的 p 值 [K]：(1 + #{|零分布均值| ≥ |观测均值|}) / (n_perm + 1)"""
+    n = x.shape[0]
+    observed = x.mean(dim=0).abs()
+    exceed = torch.zeros(x.shape[1], device=x.device)
+    for b in _chunks(n_perm, n, chunk_mb, FLIP_BYTES):
+        signs = torch.randint(0, 2, (b, n), generator=generator, device=x.device).float().mul_(2).sub_(1)
+        null = (signs @ x / n).abs()
+        exceed += (null >= observed - 1e-12).sum(dim=0)
+    return (exceed + 1) / (n_perm + 1)
+
+
+def benjamini_hochberg(p: torch.Tensor) -> torch.Tensor:
+    """BH 校正后的 q 值（与 p 同形状）"""
+    flat = p.flatten()
+    m = flat.numel()
+    order = torch.argsort(flat)
+    ranked = flat[order] * m / torch.arange(1, m + 1, dtype=flat.dtype, device=flat.device)
+    # 从大到小取累计最小值，保证单调
+    ranked = torch.flip(torch.cummin(torch.flip(ranked, [0]), dim=0).values, [0]).clamp(max=1.0)
+    q = torch.empty_like(flat)
+    q[order] = ranked
+    return q.view_as(p)
+
+
+def head_significance(effects: torch.Tensor, n_boot: int = 2000, n_perm: int = 2000, alpha: float = 0.05,
+                      ci: float = 0.95, seed: int = 0, chunk_mb: float = 256) -> Dict:
+    """
+    effects: [N, layers, heads]
+    返回 mean / ci_low / ci_high / p_value / q_value / significant（均为 [layers, heads]）；
+    显著 = BH 校正后 q < alpha 且 bootstrap 置信区间不含 0
+    """
+    n, n_layers, n_heads = effects.shape
+    x = effects.reshape(n, -1).float()
+    gen = torch.Generator(device=x.device).manual_seed(seed)
+    boot = bootstrap_means(x, n_boot, gen, chunk_mb)
+    lo, hi = (1 - ci) / 2, 1 - (1 - ci) / 2
+    bounds = torch.quantile(boot, torch.tensor([lo, hi], device=x.device), dim=0)
+    p = sign_flip_pvalues(x, n_perm, gen, chunk_mb)
+    q = benjamini_hochberg(p)
+    significant = (q < alpha) & ((bounds[0] > 0) | (bounds[1] < 0))
+    shape = (n_layers, n_heads)
+    return {
+        "mean": x.mean(dim=0).view(shape).cpu(),
+        "ci_low": bounds[0].view(shape).cpu(),
+        "ci_high": bounds[1].view(shape).cpu(),
+        "p_value": p.view(shape).cpu(),
+        "q_value": q.view(shape).cpu(),
+        "significant": significant.view(shape).cpu(),
+        "n_samples": n, "n_boot": n_boot, "n_perm": n_perm, "alpha": alpha, "ci": ci,
+    }
+
+
+def store_significance(store_file: str, output_file: Optional[str] = None, where: Optional[List[str]] = None,
+                       **options) -> Dict:
+    """读取结果存储、按条件过滤后计算；输出可直接交给 plot（value 为均值，significant 为叠加掩码）"""
+    store = ResultStore.load(store_file)
+    for expr in where or []:
+        store = store.filter(parse_condition(store, expr))
+    if len(store) < 2:
+        raise ValueError(f"样本数 {len(store)} 太少，无法估计不确定性")
+    stats = head_significance(store.effects, **options)
+    stats["value"] = stats["mean"]
+    stats["title"] = (f"mean over {stats['n_samples']} samples, "
+                      f"{int(stats['significant'].sum())} heads q<{stats['alpha']}"
+                      + (f" where {' & '.join(where)}" if where else ""))
+    if output_file:
+        torch.save(stats, output_file)
+    return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description="头效应的 bootstrap 置信区间与置换检验")
+    parser.add_argument("--store", required=True, help="patch --store 输出的结果存储")
+    parser.add_argument("--output", default="stats.pt")
+    parser.add_argument("--where", action="append", default=[], help="过滤条件，同 ioi_results.py")
+    parser.add_argument("--n-boot", type=int, default=2000)
+    parser.add_argument("--n-perm", type=int, default=2000)
+    parser.add_argument("--alpha", type=float, default=0.05, help="BH 校正后的 FDR 水平")
+    parser.add_argument("--ci", type=float, default=0.95)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--chunk-mb", type=float, default=256, help="单块重采样矩阵的内存上限")
+    args = parser.parse_args()
+    stats = store_significance(args.store, args.output, args.where, n_boot=args.n_boot, n_perm=args.n_perm,
+                               alpha=args.alpha, ci=args.ci, seed=args.seed, chunk_mb=args.chunk_mb)
+    print(f"[OK] {stats['title']} -> {args.output}")
+    sig = stats["significant"].nonzero().tolist()
+    order = sorted(sig, key=lambda lh: -abs(float(stats["mean"][lh[0], lh[1]])))
+    for layer, head in order[:20]:
+        print(f"  L{layer}H{head}: {float(stats['mean'][layer, head]):+.3f} "
+              f"[{float(stats['ci_low'][layer, head]):+.3f}, {float(stats['ci_high'][layer, head]):+.3f}] "
+              f"q={float(stats['q_value'][layer, head]):.4f}")
+    if not math.isfinite(float(stats["mean"].abs().max())):
+        print("[WARN] 结果中存在 NaN/Inf（clean 与 corrupted 的 logits diff 相等的样本会导致指标发散）")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,620 @@
+"""
+IOI 大规模数据的流式预处理
+- 生成：把 (模板, 有序名字对) 组合编号为 [0, N)，用带密钥的 Feistel 置换打乱后按分片流式写出。
+  置换是双射，所以任意数量的样本天然不重复，不需要在内存中维护去重集合；
+  所有分片共用同一个由 seed 决定的置换，第 k 个分片取置换后的 [start, start + count) 段，
+  因此每个分片只依赖 (seed, 分片号)，可以多进程并行生成，也可以单独重现某个分片
+- 输出格式：JSONL（每行一条，字段与 data.json 一致）或二进制分片（每条 3 个 uint16：模板/名字 A/名字 B 的下标），
+  分片目录下的 index.json 记录模板与名字表、种子与各分片信息
+- 按分词器生成（--tokenizer-aware）：每个名字只分词一次并缓存 token 数，只保留单 token 名字，
+  每个模板按片段分词一次，于是 clean/corrupted 等长且 IO/S1/S2 位置已知，直接写入记录
+- 结构校验：按块读取 JSONL 分发到进程池，已知模板逐段精确比对（无回溯），未知模板退回原有正则；
+  通过/拒绝的记录边校验边写出，并按拒绝原因计数
+
+用法：
+    python ioi_stream_pre.py generate --num-samples 500000 --out-dir data_shards --format jsonl --workers 8
+    python ioi_stream_pre.py generate --num-samples 500000 --out-dir data_shards --tokenizer-aware
+    python ioi_stream_pre.py check --input data_shards --output data_check1.jsonl --rejected rejected.jsonl --workers 8
+    python ioi_stream_pre.py export --input data_shards --output data.json --limit 50
+"""
+import os
+import re
+import sys
+import json
+import time
+import struct
+import argparse
+from array import array
+from itertools import product
+from multiprocessing import Pool
+from collections import Counter
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+from ioi_blocks import bounded_imap, iter_record_blocks, iter_text_blocks
+
+MASK64 = (1 << 64) - 1
+FEISTEL_ROUNDS = 4
+# 模板形如 "After A and B <地点>, A <动作> to"，corrupted 把第二个 A 换成 B
+TEMPLATE_RE = re.compile(r"^After A and B (.+), A (.+) to$")
+BIN_MAGIC = b"IOIB"
+BIN_VERSION = 1
+BIN_HEADER = struct.Struct("<4sHI")
+# 与 ioi_local_pre.check_sentence_structure 相同的通用正则，只用于未知模板
+GENERIC_CLEAN_RE = re.compile(r"After (.+?) and (.+?) (.+?), \1 (.+?) to")
+GENERIC_CORRUPTED_RE = re.compile(r"After (.+?) and (.+?) (.+?), \2 (.+?) to")
+# 记录中的 token 位置字段（to_tokens 坐标，含 BOS）
+POSITION_FIELDS = ["s1_pos", "io_pos", "s2_pos", "end_pos", "seq_len"]
+REJECT_REASONS = ["bad_json", "missing_field", "clean_format", "corrupted_mismatch", "answer_mismatch"]
+
+
+def _mix64(x: int) -> int:
+    """splitmix64 的终结函数，作为 Feistel 轮函数与种子派生"""
+    x = (x + 0x9E3779B97F4A7C15) & MASK64
+    x = ((x ^ (x >> 30)) * 0xBF58476D1CE4E5B9) & MASK64
+    x = ((x ^ (x >> 27)) * 0x94D049BB133111EB) & MASK64
+    return x ^ (x >> 31)
+
+
+class KeyedPermutation:
+    """
+    [0, n) 上由 seed 决定的伪随机置换（平衡 Feistel 网络 + cycle walking）
+    O(1) 内存，可以对任意下标单独求值
+    """
+
+    def __init__(self, n: int, seed: int):
+        if n <= 0:
+            raise ValueError("置换的定义域不能为空")
+        self.n = n
+        self.half_bits = max(1, ((n - 1).bit_length() + 1) // 2)
+        self.half_mask = (1 << self.half_bits) - 1
+        self.keys = [_mix64(seed * FEISTEL_ROUNDS + r + 1) for r in range(FEISTEL_ROUNDS)]
+
+    def _encrypt(self, x: int) -> int:
+        left, right = x >> self.half_bits, x & self.half_mask
+        for k in self.keys:
+            left, right = right, left ^ (_mix64(right ^ k) & self.half_mask)
+        return (left << self.half_bits) | right
+
+    def __call__(self, i: int) -> int:
+        # 定义域是 2^(2h) >= n，结果落在 [n, 2^(2h)) 时继续加密直到回到 [0, n)，保持双射
+        x = self._encrypt(i)
+        while x >= self.n:
+            x = self._encrypt(x)
+        return x
+
+
+def load_names(path: str) -> List[str]:
+    """名字表：字符串列表（names_pool.json），或 names.json 的 {"A","B"} 对列表（展开去重）"""
+    with open(path, 'r', encoding='utf-8') as f:
+        raw = json.load(f)
+    names = []
+    for item in raw:
+        for name in ([item["A"], item["B"]] if isinstance(item, dict) else [item]):
+            if name not in names:
+                names.append(name)
+    return names
+
+
+def load_templates(path: str, cross: bool = True) -> List[Tuple[str, str]]:
+    """
+    解析 sentences.json 为 (地点, 动作) 模板
+    cross=True 时把所有地点与所有动作两两组合（10 个句子 -> 100 个模板）
+    """
+    with open(path, 'r', encoding='utf-8') as f:
+        sentences = json.load(f)
+    parsed = []
+    for sp in sentences:
+        m = TEMPLATE_RE.match(sp["clean"])
+        if not m or sp["corrupted"] != f"After A and B {m.group(1)}, B {m.group(2)} to":
+            print(f"[WARN] 跳过无法解析的模板: {sp['clean']}")
+            continue
+        if m.groups() not in parsed:
+            parsed.append(m.groups())
+    if not cross:
+        return parsed
+    places = list(dict.fromkeys(p for p, _ in parsed))
+    actions = list(dict.fromkeys(a for _, a in parsed))
+    return list(product(places, actions))
+
+
+def make_record(template: Tuple[str, str], a: str, b: str, layout: Optional[Dict] = None) -> Dict:
+    place, action = template
+    rec = {
+        "clean": f"After {a} and {b} {place}, {a} {action} to",
+        "corrupted": f"After {a} and {b} {place}, {b} {action} to",
+        "clean_answer": " " + b,
+        "corrupted_answer": " " + a,
+    }
+    if layout is not None:
+        rec.update(layout)
+    return rec
+
+
+def load_tokenizer():
+    """GPT-2 分词器（与 HookedTransformer gpt2-small 一致），只用本地缓存"""
+    os.environ.setdefault("HF_HUB_OFFLINE", "1")
+    os.environ.setdefault("TRANSFORMERS_OFFLINE", "1")
+    from transformers import AutoTokenizer
+    return AutoTokenizer.from_pretrained("gpt2")
+
+
+def name_token_counts(names: List[str], encode, cache_path: Optional[str] = None) -> Dict[str, int]:
+    """每个名字（带前导空格，与句中形式一致）的 token 数；结果缓存在 cache_path，已缓存的名字不再分词"""
+    cache = {}
+    if cache_path and os.path.exists(cache_path):
+        with open(cache_path, 'r', encoding='utf-8') as f:
+            cache = json.load(f)
+    missing = [n for n in names if n not in cache]
+    for name in missing:
+        cache[name] = len(encode(" " + name))
+    if cache_path and missing:
+        with open(cache_path, 'w', encoding='utf-8') as f:
+            json.dump(cache, f, indent=2, ensure_ascii=False)
+    return {n: cache[n] for n in names}
+
+
+def template_layout(template: Tuple[str, str], encode, probe: Tuple[str, str]) -> Optional[Dict]:
+    """
+    单 token 名字下模板的 token 位置（含 BOS，BOS 在位置 0）
+    GPT-2 的预分词在空格前断开，所以按 "After" / " A" / " and" / " B" / " 地点," / " A" / " 动作 to" 分段分词即可；
+    用一对探针名字对整句分词校验，不一致（说明片段边界发生了合并）时返回 None
+    """
+    place, action = template
+    n_after, n_and = len(encode("After")), len(encode(" and"))
+    n_place, n_action = len(encode(f" {place},")), len(encode(f" {action} to"))
+    s1 = 1 + n_after
+    io = s1 + 1 + n_and
+    s2 = io + 1 + n_place
+    end = s2 + n_action
+    layout = {"s1_pos": s1, "io_pos": io, "s2_pos": s2, "end_pos": end, "seq_len": end + 1}
+    a, b = probe
+    rec = make_record(template, a, b)
+    clean, corrupted = encode(rec["clean"]), encode(rec["corrupted"])
+    a_tok, b_tok = encode(" " + a)[0], encode(" " + b)[0]
+    if len(clean) != end or len(corrupted) != end:
+        return None
+    # encode 不含 BOS，位置减 1
+    if (clean[s1 - 1], clean[io - 1], clean[s2 - 1], corrupted[s2 - 1]) != (a_tok, b_tok, a_tok, b_tok):
+        return None
+    return layout
+
+
+def tokenizer_plan(names: List[str], templates: List[Tuple[str, str]], encode,
+                   cache_path: Optional[str] = None) -> Tuple[List[str], List[Tuple[str, str]], List[Dict]]:
+    """只保留单 token 名字与能确定位置的模板，返回 (名字, 模板, 各模板的位置)"""
+    counts = name_token_counts(names, encode, cache_path)
+    single = [n for n in names if counts[n] == 1]
+    if len(single) < 2:
+        raise ValueError("单 token 的名字少于 2 个，无法组成名字对")
+    if len(single) < len(names):
+        dropped = [n for n in names if counts[n] != 1]
+        print(f"[日志] 剔除 {len(dropped)} 个多 token 名字: {', '.join(dropped[:10])}{' ...' if len(dropped) > 10 else ''}")
+    kept, layouts = [], []
+    for template in templates:
+        layout = template_layout(template, encode, (single[0], single[1]))
+        if layout is None:
+            print(f"[WARN] 模板分段分词与整句不一致，已跳过: {template}")
+            continue
+        kept.append(template)
+        layouts.append(layout)
+    return single, kept, layouts
+
+
+class ComboSpace:
+    """(模板, 有序名字对 A != B) 组合与 [0, N) 的一一对应"""
+
+    def __init__(self, templates: List[Tuple[str, str]], names: List[str], layouts: Optional[List[Dict]] = None):
+        self.templates = templates
+        self.names = names
+        self.layouts = layouts
+        self.n_pairs = len(names) * (len(names) - 1)
+        self.size = len(templates) * self.n_pairs
+
+    def decode(self, idx: int) -> Tuple[int, int, int]:
+        t, p = divmod(idx, self.n_pairs)
+        a, b = divmod(p, len(self.names) - 1)
+        if b >= a:
+            b += 1
+        return t, a, b
+
+    def record(self, t: int, a: int, b: int) -> Dict:
+        return make_record(self.templates[t], self.names[a], self.names[b],
+                           self.layouts[t] if self.layouts else None)
+
+
+def shard_path(out_dir: str, shard: int, fmt: str) -> str:
+    return os.path.join(out_dir, f"shard-{shard:05d}.{fmt}")
+
+
+def _write_shard(job: Dict) -> Dict:
+    """生成一个分片：第 start..start+count 个置换值"""
+    t0 = time.time()
+    space = ComboSpace([tuple(t) for t in job["templates"]], job["names"], job["layouts"])
+    perm = KeyedPermutation(space.size, job["seed"])
+    path = shard_path(job["out_dir"], job["shard"], job["format"])
+    tmp = path + ".tmp"
+    if job["format"] == "bin":
+        triples = array("H")
+        for j in range(job["start"], job["start"] + job["count"]):
+            triples.extend(space.decode(perm(j)))
+        if sys.byteorder != "little":
+            triples.byteswap()
+        with open(tmp, 'wb') as f:
+            f.write(BIN_HEADER.pack(BIN_MAGIC, BIN_VERSION, job["count"]))
+            triples.tofile(f)
+    else:
+        with open(tmp, 'w', encoding='utf-8') as f:
+            lines = []
+            for j in range(job["start"], job["start"] + job["count"]):
+                idx = perm(j)
+                rec = space.record(*space.decode(idx))
+                rec["id"] = idx
+                lines.append(json.dumps(rec, ensure_ascii=False))
+                if len(lines) >= 4096:
+                    f.write("\n".join(lines) + "\n")
+                    lines = []
+            if lines:
+                f.write("\n".join(lines) + "\n")
+    os.replace(tmp, path)
+    return {"shard": job["shard"], "path": os.path.basename(path), "start": job["start"], "count": job["count"],
+            "bytes": os.path.getsize(path),
+            "time": time.time() - t0}
+
+
+def generate_stream(num_samples: int, out_dir: str = "data_shards", fmt: str = "jsonl", shard_size: int = 100000,
+                    seed: int = 42, workers: int = 1, names_file: str = "names_pool.json",
+                    templates_file: str = "sentences.json", cross_templates: bool = True,
+                    shards: Optional[List[int]] = None, tokenizer_aware: bool = False,
+                    token_cache: Optional[str] = "name_token_counts.json") -> Tuple[Dict, float]:
+    """
+    流式生成 num_samples 条互不重复的样本，按 shard_size 切分成分片
+    shards 指定时只（重新）生成这些分片，其余分片保持不变
+    tokenizer_aware 时组合空间只含单 token 名字与可定位模板，记录附带 POSITION_FIELDS
+    """
+    t0 = time.time()
+    names = load_names(names_file)
+    templates = load_templates(templates_file, cross=cross_templates)
+    layouts = None
+    if tokenizer_aware:
+        tokenizer = load_tokenizer()
+        names, templates, layouts = tokenizer_plan(names, templates, tokenizer.encode, token_cache)
+    space = ComboSpace(templates, names, layouts)
+    if fmt == "bin" and max(len(names), len(templates)) > 0xFFFF:
+        raise ValueError("二进制分片用 uint16 存下标，名字/模板数不能超过 65535")
+    if num_samples > space.size:
+        print(f"[WARN] 组合空间只有 {space.size} 种（{len(templates)} 模板 × {space.n_pairs} 名字对），"
+              f"样本数从 {num_samples} 截断为 {space.size}")
+        num_samples = space.size
+    os.makedirs(out_dir, exist_ok=True)
+    n_shards = (num_samples + shard_size - 1) // shard_size
+    jobs = [{"shard": s, "start": s * shard_size, "count": min(shard_size, num_samples - s * shard_size),
+             "seed": seed, "format": fmt, "out_dir": out_dir, "names": names, "templates": templates,
+             "layouts": layouts}
+            for s in range(n_shards) if shards is None or s in shards]
+    if workers > 1 and len(jobs) > 1:
+        with Pool(min(workers, len(jobs))) as pool:
+            done = pool.map(_write_shard, jobs)
+    else:
+        done = [_write_shard(job) for job in jobs]
+
+    index_path = os.path.join(out_dir, "index.json")
+    previous = {}
+    if shards is not None and os.path.exists(index_path):
+        with open(index_path, 'r', encoding='utf-8') as f:
+            previous = {s["shard"]: s for s in json.load(f).get("shards", [])}
+    previous.update({s["shard"]: s for s in done})
+    index = {
+        "format": fmt,
+        "seed": seed,
+        "num_samples": num_samples,
+        "shard_size": shard_size,
+        "space_size": space.size,
+        "templates": [list(t) for t in templates],
+        "names": names,
+        "layouts": layouts,
+        "shards": [previous[s] for s in sorted(previous)],
+    }
+    with open(index_path, 'w', encoding='utf-8') as f:
+        json.dump(index, f, indent=2, ensure_ascii=False)
+    duration = time.time() - t0
+    print(f"[OK] 流式生成 {out_dir} 共 {num_samples} 条（{n_shards} 个分片，本次写出 {len(done)} 个），用时 {duration:.3f}s")
+    return index, duration
+
+
+def _iter_bin(path: str, space: ComboSpace) -> Iterator[Dict]:
+    with open(path, 'rb') as f:
+        magic, version, count = BIN_HEADER.unpack(f.read(BIN_HEADER.size))
+        if magic != BIN_MAGIC or version != BIN_VERSION:
+            raise ValueError(f"{path} 不是 IOI 二进制分片")
+        triples = array("H")
+        triples.fromfile(f, 3 * count)
+    if sys.byteorder != "little":
+        triples.byteswap()
+    for i in range(count):
+        t, a, b = triples[3 * i:3 * i + 3]
+        rec = space.record(t, a, b)
+        rec["id"] = (t * len(space.names) + a) * (len(space.names) - 1) + (b - (b > a))
+        yield rec
+
+
+def iter_records(path: str) -> Iterator[Dict]:
+    """
+    逐条读取样本：分片目录 / index.json / 单个 .jsonl 或 .bin 分片 / 传统的 .json 列表
+    .bin 分片需要同目录下的 index.json 提供模板与名字表
+    """
+    if os.path.isdir(path):
+        path = os.path.join(path, "index.json")
+    if path.endswith(".jsonl"):
+        with open(path, 'r', encoding='utf-8') as f:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+        return
+    if path.endswith(".bin"):
+        with open(os.path.join(os.path.dirname(path) or ".", "index.json"), 'r', encoding='utf-8') as f:
+            index = json.load(f)
+        yield from _iter_bin(path, ComboSpace([tuple(t) for t in index["templates"]], index["names"],
+                                              index.get("layouts")))
+        return
+    with open(path, 'r', encoding='utf-8') as f:
+        data = json.load(f)
+    if isinstance(data, list):
+        yield from data
+        return
+    base = os.path.dirname(path) or "."
+    for shard in data["shards"]:
+        yield from iter_records(os.path.join(base, shard["path"]))
+
+
+def export_json(input_path: str, output_file: str, limit: Optional[int] = None) -> Tuple[int, float]:
+    """把流式数据（前 limit 条）导出为现有流水线使用的 data.json 格式"""
+    t0 = time.time()
+    records = []
+    for rec in iter_records(input_path):
+        if limit is not None and len(records) >= limit:
+            break
+        records.append(rec)
+    with open(output_file, 'w', encoding='utf-8') as f:
+        json.dump(records, f, indent=2)
+    duration = time.time() - t0
+    print(f"[OK] 导出 {output_file} 共 {len(records)} 条，用时 {duration:.3f}s")
+    return len(records), duration
+
+
+class TemplateMatcher:
+    """
+    已知模板的结构校验：按 ", " 与空格位置切分后查表，不做正则回溯
+    clean 必须恰为 "After {A} and {B} {地点}, {A} {动作} to"，corrupted 把第二个 A 换成 B
+    """
+
+    def __init__(self, templates: Iterable[Tuple[str, str]]):
+        self.places = {p for p, _ in templates}
+        self.actions = {a for _, a in templates}
+
+    @staticmethod
+    def _split_suffix(text: str, known: set) -> Optional[Tuple[str, str]]:
+        """把 text 切成 (前缀, 已知后缀)，后缀从最短的开始尝试"""
+        i = len(text)
+        while True:
+            i = text.rfind(" ", 0, i)
+            if i <= 0:
+                return None
+            if text[i + 1:] in known:
+                return text[:i], text[i + 1:]
+
+    def parse(self, clean: str) -> Optional[Tuple[str, str, str, str]]:
+        """返回 (A, B, 地点, 动作)；不是已知模板时返回 None"""
+        if not clean.startswith("After ") or not clean.endswith(" to"):
+            return None
+        head, sep, tail = clean[6:-3].rpartition(", ")
+        if not sep:
+            return None
+        left = self._split_suffix(head, self.places)
+        right = self._split_suffix(tail, self.actions)
+        if left is None or right is None:
+            return None
+        (names, place), (subject, action) = left, right
+        if not names.startswith(subject + " and "):
+            return None
+        return subject, names[len(subject) + 5:], place, action
+
+
+def generic_reason(item: Dict) -> Optional[str]:
+    """原 check_sentence_structure 的判定逻辑，返回拒绝原因（通过时为 None）"""
+    cm = GENERIC_CLEAN_RE.match(item["clean"])
+    if not cm:
+        return "clean_format"
+    xm = GENERIC_CORRUPTED_RE.match(item["corrupted"])
+    if not xm or cm.groups() != xm.groups():
+        return "corrupted_mismatch"
+    a, b = cm.group(1), cm.group(2)
+    if " " + a != item["corrupted_answer"] or " " + b != item["clean_answer"]:
+        return "answer_mismatch"
+    return None
+
+
+def check_record(item: Dict, matcher: Optional[TemplateMatcher]) -> Tuple[Optional[str], bool]:
+    """返回 (拒绝原因或 None, 是否走了已知模板的快速路径)"""
+    if not isinstance(item, dict) or any(not isinstance(item.get(k), str) for k in
+                                         ("clean", "corrupted", "clean_answer", "corrupted_answer")):
+        return "missing_field", False
+    parsed = matcher.parse(item["clean"]) if matcher is not None else None
+    if parsed is None:
+        return generic_reason(item), False
+    a, b, place, action = parsed
+    if item["corrupted"] != f"After {a} and {b} {place}, {b} {action} to":
+        return "corrupted_mismatch", True
+    if item["clean_answer"] != " " + b or item["corrupted_answer"] != " " + a:
+        return "answer_mismatch", True
+    return None, True
+
+
+_MATCHER: Optional[TemplateMatcher] = None
+
+
+def _init_checker(templates):
+    global _MATCHER
+    _MATCHER = TemplateMatcher(templates) if templates else None
+
+
+def _check_block(block: Tuple[int, str]) -> Tuple[str, str, Counter]:
+    """
+    校验一块原始 JSONL 文本；通过的行原样拼接返回，拒绝的行附上原因与行号
+    以整块文本而不是逐行对象在进程间传递，主进程只负责读块和写块
+    """
+    first_line, text = block
+    accepted, rejected, counts = [], [], Counter()
+    for offset, line in enumerate(text.split("\n")):
+        if not line.strip():
+            continue
+        try:
+            item = json.loads(line)
+        except ValueError:
+            item = None
+            reason, fast = "bad_json", False
+        else:
+            reason, fast = check_record(item, _MATCHER)
+        if reason is None:
+            accepted.append(line)
+            counts["accepted_template" if fast else "accepted_generic"] += 1
+        else:
+            counts[reason] += 1
+            record = line if item is not None else json.dumps(line, ensure_ascii=False)
+            rejected.append(f'{{"reason": "{reason}", "line": {first_line + offset}, "record": {record}}}')
+    return "".join(line + "\n" for line in accepted), "".join(line + "\n" for line in rejected), counts
+
+
+def jsonl_files(path: str) -> Optional[List[str]]:
+    """输入对应的 JSONL 文件列表（分片目录按分片顺序）；不是 JSONL 时返回 None"""
+    if os.path.isdir(path):
+        path = os.path.join(path, "index.json")
+    if path.endswith(".jsonl"):
+        return [path]
+    if path.endswith("index.json"):
+        with open(path, 'r', encoding='utf-8') as f:
+            index = json.load(f)
+        if index.get("format") == "jsonl":
+            return [os.path.join(os.path.dirname(path) or ".", shard["path"]) for shard in index["shards"]]
+    return None
+
+
+def iter_blocks(path: str, block_bytes: int = 4 << 20) -> Iterator[Tuple[int, str]]:
+    """
+    按约 block_bytes 大小读取整行文本块，返回 (块首行号, 文本)
+    非 JSONL 输入（.json / .bin）逐条转成 JSONL 行再分块
+    """
+    files = jsonl_files(path)
+    if files is None:
+        return iter_record_blocks(iter_records(path), block_bytes)
+    return iter_text_blocks(files, block_bytes)
+
+
+def known_templates(input_path: str, templates_file: Optional[str]) -> List[Tuple[str, str]]:
+    """已知模板：sentences.json（交叉组合）与分片 index.json 中记录的模板"""
+    templates = load_templates(templates_file, cross=True) if templates_file else []
+    index_path = os.path.join(input_path, "index.json") if os.path.isdir(input_path) else input_path
+    if index_path.endswith("index.json") and os.path.exists(index_path):
+        with open(index_path, 'r', encoding='utf-8') as f:
+            templates += [tuple(t) for t in json.load(f).get("templates", [])]
+    return list(dict.fromkeys(templates))
+
+
+def check_stream(input_path: str, output_file: str = "data_check1.jsonl", rejected_file: Optional[str] = None,
+                 workers: int = 1, block_mb: float = 4, templates_file: Optional[str] = "sentences.json") -> Tuple[Dict, float]:
+    """
+    流式结构校验：按 block_mb 大小的文本块分发给 workers 个进程，结果按输入顺序边算边写
+    返回 (各原因计数, 用时)
+    """
+    t0 = time.time()
+    templates = known_templates(input_path, templates_file)
+    counts = Counter()
+    out = open(output_file, 'w', encoding='utf-8')
+    rej = open(rejected_file, 'w', encoding='utf-8') if rejected_file else None
+    pool = Pool(workers, initializer=_init_checker, initargs=(templates,)) if workers > 1 else None
+    try:
+        blocks = iter_blocks(input_path, int(block_mb * (1 << 20)))
+        if pool is not None:
+            results = bounded_imap(pool, _check_block, blocks, 2 * workers)
+        else:
+            _init_checker(templates)
+            results = map(_check_block, blocks)
+        for accepted, rejected, block_counts in results:
+            out.write(accepted)
+            if rej is not None:
+                rej.write(rejected)
+            counts.update(block_counts)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+        out.close()
+        if rej is not None:
+            rej.close()
+    duration = time.time() - t0
+    total = sum(counts.values())
+    kept = counts["accepted_template"] + counts["accepted_generic"]
+    stats = {"total": total, "accepted": kept, **{k: counts[k] for k in ["accepted_template", "accepted_generic"] + REJECT_REASONS},
+             "time": duration, "lines_per_s": total / duration if duration > 0 else None, "workers": workers}
+    print(f"[OK] 结构校验 {output_file} 保留 {kept}/{total} 条，用时 {duration:.3f}s（{stats['lines_per_s'] or 0:.0f} 行/s）")
+    for reason in REJECT_REASONS:
+        if counts[reason]:
+            print(f"  拒绝 {reason:<20}{counts[reason]:>10}")
+    if counts["accepted_generic"]:
+        print(f"[WARN] {counts['accepted_generic']} 条不属于已知模板，按通用正则校验通过")
+    return stats, duration
+
+
+def _int_list(s: str) -> List[int]:
+    return [int(x) for x in s.split(",") if x]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="IOI 大规模数据的流式预处理")
+    sub = parser.add_subparsers(dest="command", required=True)
+    p_gen = sub.add_parser("generate", help="流式生成互不重复的样本分片")
+    p_gen.add_argument("--num-samples", type=int, required=True)
+    p_gen.add_argument("--out-dir", default="data_shards")
+    p_gen.add_argument("--format", choices=["jsonl", "bin"], default="jsonl")
+    p_gen.add_argument("--shard-size", type=int, default=100000)
+    p_gen.add_argument("--seed", type=int, default=42)
+    p_gen.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    p_gen.add_argument("--names", default="names_pool.json", help="名字表（字符串列表或 names.json 格式）")
+    p_gen.add_argument("--templates", default="sentences.json")
+    p_gen.add_argument("--no-cross-templates", action="store_true", help="不交叉组合地点与动作，只用原句模板")
+    p_gen.add_argument("--shards", type=_int_list, default=None, help="只重新生成这些分片，逗号分隔")
+    p_gen.add_argument("--tokenizer-aware", action="store_true",
+                       help="按 GPT-2 分词器只生成单 token 名字的组合，并记录 IO/S1/S2 位置")
+    p_gen.add_argument("--token-cache", default="name_token_counts.json", help="名字 token 数的缓存文件")
+    p_gen.add_argument("--timing-output", default=None)
+    p_chk = sub.add_parser("check", help="流式并行结构校验")
+    p_chk.add_argument("--input", required=True, help="JSONL 文件或分片目录")
+    p_chk.add_argument("--output", default="data_check1.jsonl")
+    p_chk.add_argument("--rejected", default=None, help="被拒绝记录的输出（附原因与行号）")
+    p_chk.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    p_chk.add_argument("--block-mb", type=float, default=4, help="每个任务块的大小（MB）")
+    p_chk.add_argument("--templates", default="sentences.json", help="已知模板（交叉组合）；分片 index.json 中的模板自动加入")
+    p_chk.add_argument("--stats-output", default=None)
+    p_exp = sub.add_parser("export", help="导出为 data.json 格式")
+    p_exp.add_argument("--input", required=True)
+    p_exp.add_argument("--output", default="data.json")
+    p_exp.add_argument("--limit", type=int, default=None)
+    args = parser.parse_args()
+
+    if args.command == "generate":
+        _, duration = generate_stream(args.num_samples, args.out_dir, args.format, args.shard_size, args.seed,
+                                      args.workers, args.names, args.templates, not args.no_cross_templates,
+                                      args.shards, args.tokenizer_aware, args.token_cache)
+        if args.timing_output:
+            with open(args.timing_output, 'w', encoding='utf-8') as f:
+                json.dump({"local_generate_s": duration}, f, indent=2)
+    elif args.command == "check":
+        stats, _ = check_stream(args.input, args.output, args.rejected, args.workers, args.block_mb, args.templates)
+        if args.stats_output:
+            with open(args.stats_output, 'w', encoding='utf-8') as f:
+                json.dump(stats, f, indent=2)
+    else:
+        export_json(args.input, args.output, args.limit)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,224 @@
+"""
+按层流式执行：在 CPU 上跑 gpt2-medium / gpt2-large
+处理后的权重（fold_ln、center_writing_weights 等，与 load_model_safely 一致）按层导出为单独的文件：
+- shared.pt：嵌入、位置嵌入、最终 LayerNorm 与反嵌入，常驻内存
+- block_{l}.pt：第 l 层，用时以 mmap 方式载入，用完即释放
+模型骨架在 meta 设备上构造，不分配各层权重；峰值内存 ≈ 常驻部分 + 一层权重 + 一块样本的 patch 行残差流
+
+patch 按层推进：同一层上一块样本的所有 patch 行依次通过后才换下一层，每层对每块样本只载入一次；
+patch 行的残差流要保留到最后一层（每个样本 (1 + n_layers × n_heads) × pos × d_model），样本按内存预算分块
+patch (layer, head) 的行在第 layer 层之前与该样本的基线行完全相同，因此到第 layer 层才从基线行复制出来
+
+用法：
+    python ioi_streaming.py export --model gpt2-large --out weights_gpt2-large
+    python ioi_modules.py --task patch --input saved_data.pt --output results.pt --stream-weights weights_gpt2-large --batch-size 64
+"""
+import os
+import json
+import time
+import argparse
+from contextlib import contextmanager
+from typing import Dict, List
+
+import torch
+
+MANIFEST = "manifest.json"
+MB = 1024 * 1024
+
+
+def export_weights(model, out_dir: str) -> Dict:
+    """把已处理的模型权重按层写入 out_dir；返回写入 manifest 的内容"""
+    os.makedirs(out_dir, exist_ok=True)
+    state = model.state_dict()
+    torch.save({k: v for k, v in state.items() if not k.startswith("blocks.")}, os.path.join(out_dir, "shared.pt"))
+    layer_mb = []
+    for layer in range(model.cfg.n_layers):
+        prefix = f"blocks.{layer}."
+        path = os.path.join(out_dir, f"block_{layer}.pt")
+        torch.save({k[len(prefix):]: v.contiguous() for k, v in state.items() if k.startswith(prefix)}, path)
+        layer_mb.append(round(os.path.getsize(path) / MB, 2))
+    manifest = {"model_name": model.cfg.model_name, "n_layers": model.cfg.n_layers, "d_model": model.cfg.d_model,
+                "shared_mb": round(os.path.getsize(os.path.join(out_dir, "shared.pt")) / MB, 2), "layer_mb": layer_mb}
+    with open(os.path.join(out_dir, MANIFEST), "w", encoding="utf-8") as f:
+        json.dump(manifest, f, indent=2)
+    return manifest
+
+
+def has_export(weights_dir: str) -> bool:
+    return os.path.exists(os.path.join(weights_dir, MANIFEST))
+
+
+class LayerStream:
+    """
+    model 是只含常驻权重的 HookedTransformer 骨架（各层在 meta 设备上）；layer(l) 期间第 l 层换入
+    loads / load_s 统计换入次数与耗时
+    """
+
+    def __init__(self, weights_dir: str, device: str = "cpu"):
+        from transformer_lens import HookedTransformer
+        from transformer_lens.loading_from_pretrained import get_pretrained_model_config
+        with open(os.path.join(weights_dir, MANIFEST), "r", encoding="utf-8") as f:
+            self.manifest = json.load(f)
+        self.weights_dir, self.device = weights_dir, device
+        # fold_ln=True 时配置使用 LNPre，与导出的已处理权重一致
+        cfg = get_pretrained_model_config(self.manifest["model_name"], fold_ln=True, device=device)
+        with torch.device("meta"):
+            self.model = HookedTransformer(cfg, move_to_device=False)
+        shared = torch.load(os.path.join(weights_dir, "shared.pt"), map_location="cpu")
+        self.model.load_state_dict(shared, strict=False, assign=True)
+        for name in ("embed", "pos_embed", "ln_final", "unembed"):
+            getattr(self.model, name).to(device)
+        self.model.eval()
+        self.loads, self.load_s = 0, 0.0
+        # 样本分块数与各块 patch 行残差流的最大估计（MB）
+        self.chunks, self.active_mb = 0, 0.0
+
+    @contextmanager
+    def layer(self, layer: int):
+        t0 = time.time()
+        block = self.model.blocks[layer]
+        state = torch.load(os.path.join(self.weights_dir, f"block_{layer}.pt"), map_location="cpu", mmap=True)
+        block.load_state_dict(state, assign=True)
+        block.to(self.device)
+        del state
+        self.loads += 1
+        self.load_s += time.time() - t0
+        try:
+            yield block
+        finally:
+            # 换回 meta，释放这一层的权重（mmap 页随引用一并释放）
+            block.to_empty(device="meta")
+
+    def embed(self, tokens):
+        return self.model.embed(tokens) + self.model.pos_embed(tokens)
+
+    def report(self) -> Dict:
+        return {"weights_dir": self.weights_dir, "model_name": self.manifest["model_name"], "layer_loads": self.loads,
+                "layer_load_s": round(self.load_s, 3), "shared_mb": self.manifest["shared_mb"],
+                "max_layer_mb": max(self.manifest["layer_mb"]), "sample_chunks": self.chunks,
+                "active_rows_mb": round(self.active_mb, 2),
+                "expected_peak_mb": round(self.manifest["shared_mb"] + max(self.manifest["layer_mb"]) + self.active_mb, 2)}
+
+
+def _run_block(block, x, patch_mask, replacement):
+    """patch_mask: [rows, n_heads]，为 True 的头的 z 换成 replacement [rows, pos, n_heads, d_head]"""
+    def hook(z, hook):
+        return torch.where(patch_mask[:, None, :, None], replacement.to(z.dtype), z)
+    if patch_mask.any():
+        block.attn.hook_z.add_hook(hook)
+    try:
+        return block(x)
+    finally:
+        block.attn.hook_z.remove_hooks()
+
+
+def active_rows_mb(cfg, pos: int) -> float:
+    """一个样本逐层推进到最后一层时保留的残差流：基线行 + n_layers × n_heads 个 patch 行，[pos, d_model] float32"""
+    return (1 + cfg.n_layers * cfg.n_heads) * pos * cfg.d_model * 4 / MB
+
+
+def sample_chunks(items: List, cfg, rows_mb: float) -> List[List[int]]:
+    """按输入顺序把样本分块，每块的 active_rows_mb 之和不超过 rows_mb（单个样本超出时独占一块）"""
+    chunks, current, used = [], [], 0.0
+    for k, item in enumerate(items):
+        need = active_rows_mb(cfg, item[0].shape[-1])
+        if current and used + need > rows_mb:
+            chunks.append(current)
+            current, used = [], 0.0
+        current.append(k)
+        used += need
+    if current:
+        chunks.append(current)
+    return chunks
+
+
+def stream_head_patches(stream: LayerStream, items: List, batch_size: int, logit_diff, rows_mb: float = 1024) -> torch.Tensor:
+    """
+    items: [(tokens [1, pos], replacement_z [n_layers, pos, n_heads, d_head], ans_a, ans_b)]，逐头 patch 每个样本
+    batch_size 为每次送入一层的行数；返回 [len(items), n_layers, n_heads] 的 patched logits diff
+    logit_diff(model, resid, ans_a, ans_b) 同 ioi_modules.answer_logit_diff
+    patch 行的残差流一直保留到最后一层，样本按 rows_mb 分块（sample_chunks），每块各自逐层推进一遍，
+    峰值内存 ≈ 常驻部分 + 一层权重 + rows_mb；块数越多，每层换入的次数越多
+    """
+    result = torch.zeros(len(items), stream.model.cfg.n_layers, stream.model.cfg.n_heads)
+    for chunk in sample_chunks(items, stream.model.cfg, rows_mb):
+        stream.chunks += 1
+        stream.active_mb = max(stream.active_mb, sum(active_rows_mb(stream.model.cfg, items[k][0].shape[-1]) for k in chunk))
+        result[chunk] = _stream_chunk(stream, [items[k] for k in chunk], batch_size, logit_diff)
+    return result
+
+
+def _stream_chunk(stream: LayerStream, items: List, batch_size: int, logit_diff) -> torch.Tensor:
+    """
+    一块样本逐层推进一遍（每层载入一次）
+    每组（同一长度）的残差流一次分配好：前 n 行为基线行，之后第 l 段的 n × n_heads 行是在第 l 层 patch 的行
+    （样本为主序、头为次序），推进到第 l 层时才从基线行复制出来；各行原地更新，不产生整块的副本
+    """
+    model, device = stream.model, stream.device
+    n_layers, n_heads = model.cfg.n_layers, model.cfg.n_heads
+    groups = {}
+    for k, item in enumerate(items):
+        groups.setdefault(item[0].shape[-1], []).append(k)
+    states = []
+    for ks in groups.values():
+        n = len(ks)
+        tokens = torch.cat([items[k][0].reshape(1, -1) for k in ks]).to(device)
+        base = stream.embed(tokens)
+        resid = torch.empty(n * (1 + n_layers * n_heads), *base.shape[1:], dtype=base.dtype, device=device)
+        resid[:n] = base
+        del base
+        # 每行的 (样本, patch 层, 头)；基线行的层记为 -1
+        row = torch.arange(n * n_layers * n_heads, device=device)
+        states.append({"ks": ks, "resid": resid,
+                       "sample": torch.cat([torch.arange(n, device=device), row % (n * n_heads) // n_heads]),
+                       "layer": torch.cat([torch.full((n,), -1, device=device), row // (n * n_heads)]),
+                       "head": torch.cat([torch.zeros(n, dtype=torch.long, device=device), row % n_heads])})
+    for layer in range(n_layers):
+        with stream.layer(layer) as block:
+            for st in states:
+                n, resid = len(st["ks"]), st["resid"]
+                start, live = n + n * n_heads * layer, n + n * n_heads * (layer + 1)
+                # patch 第 layer 层的行此前与基线相同，此时才复制出来
+                resid[start:live] = resid[:n].repeat_interleave(n_heads, dim=0)
+                replacement = torch.stack([items[k][1][layer] for k in st["ks"]]).to(device)
+                for i in range(0, live, batch_size):
+                    rows = slice(i, min(i + batch_size, live))
+                    patch_mask = torch.zeros(rows.stop - rows.start, n_heads, dtype=torch.bool, device=device)
+                    hit = (st["layer"][rows] == layer).nonzero()[:, 0]
+                    patch_mask[hit, st["head"][rows][hit]] = True
+                    resid[rows] = _run_block(block, resid[rows], patch_mask, replacement[st["sample"][rows]])
+    result = torch.zeros(len(items), n_layers, n_heads)
+    for st in states:
+        n = len(st["ks"])
+        ans_a = torch.stack([items[k][2].reshape(-1)[0] for k in st["ks"]]).to(device)
+        ans_b = torch.stack([items[k][3].reshape(-1)[0] for k in st["ks"]]).to(device)
+        sample = st["sample"][n:]
+        diffs = torch.cat([logit_diff(model, st["resid"][n + i:n + i + batch_size], ans_a[sample[i:i + batch_size]],
+                                      ans_b[sample[i:i + batch_size]])
+                           for i in range(0, len(sample), batch_size)]).float().cpu()
+        ks = torch.tensor(st["ks"])[sample.cpu()]
+        result[ks, st["layer"][n:].cpu(), st["head"][n:].cpu()] = diffs
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="按层导出处理后的权重，供流式执行")
+    sub = parser.add_subparsers(dest="command", required=True)
+    p_export = sub.add_parser("export", help="加载模型（一次性占用完整内存）并按层导出")
+    p_export.add_argument("--model", default="gpt2-small", help="如 gpt2-medium、gpt2-large")
+    p_export.add_argument("--out", required=True)
+    p_info = sub.add_parser("info", help="显示导出的模型与每层大小")
+    p_info.add_argument("--dir", required=True)
+    args = parser.parse_args()
+    if args.command == "info":
+        with open(os.path.join(args.dir, MANIFEST), "r", encoding="utf-8") as f:
+            print(json.dumps(json.load(f), indent=2))
+        return
+    from ioi_modules import load_model_safely
+    manifest = export_weights(load_model_safely(device="cpu", model_name=args.model), args.out)
+    print(f"[OK] {manifest['model_name']}：{manifest['n_layers']} 层，每层 {max(manifest['layer_mb'])}MB，"
+          f"常驻部分 {manifest['shared_mb']}MB -> {args.out}")
+
+
+if __name__ == "__main__":
+    main()
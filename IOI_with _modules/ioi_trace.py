@@ -0,0 +1,152 @@
+"""
+IOI 项目的分层追踪（span）工具
+记录编排器、传输以及 ioi_modules.py 各环节内部的嵌套耗时，
+远端 span 可合并到本地 trace，并导出为 Chrome trace-event JSON（chrome://tracing 或 Perfetto 打开）
+只依赖标准库，可与 ioi_modules.py 一同上传到远端
+"""
+import os
+import json
+import time
+import threading
+from contextlib import contextmanager
+from typing import Dict, List, Optional
+
+
+def now_us() -> int:
+    """当前墙上时间（微秒），跨进程/跨机器合并时以此为时间轴"""
+    return time.time_ns() // 1000
+
+
+class Tracer:
+    """收集 Chrome trace-event 格式的 complete event（ph = "X"）"""
+
+    def __init__(self, process_name: str = "ioi", enabled: bool = True):
+        self.enabled = enabled
+        self.process_name = process_name
+        self.pid = os.getpid()
+        self.events: List[dict] = []
+        self._process_names: Dict[int, str] = {self.pid: process_name}
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def span(self, name: str, cat: str = "ioi", **args):
+        """记录一个嵌套 span；未启用时为空操作"""
+        if not self.enabled:
+            yield
+            return
+        start = now_us()
+        try:
+            yield
+        finally:
+            self.add_complete(name, start, now_us() - start, cat=cat, args=args)
+
+    def add_complete(self, name: str, start_us: int, dur_us: int, cat: str = "ioi",
+                     args: Optional[dict] = None, pid: Optional[int] = None, tid: Optional[int] = None):
+        if not self.enabled:
+            return
+        event = {
+            "name": name, "cat": cat, "ph": "X",
+            "ts": int(start_us), "dur": max(int(dur_us), 0),
+            "pid": self.pid if pid is None else pid,
+            "tid": threading.get_ident() if tid is None else tid,
+        }
+        if args:
+            event["args"] = {k: _jsonable(v) for k, v in args.items()}
+        with self._lock:
+            self.events.append(event)
+
+    def merge(self, events: List[dict], process_name: Optional[str] = None, offset_us: int = 0) -> int:
+        """
+        合并其他进程（本地子进程或远端）的事件
+        每次合并分配一个新的 pid，使其在时间轴上显示为独立进程行；返回该 pid
+        """
+        if not self.enabled or not events:
+            return -1
+        with self._lock:
+            new_pid = max(self._process_names) + 1
+            self._process_names[new_pid] = process_name or f"merged-{new_pid}"
+            for e in events:
+                if e.get("ph") == "M":
+                    continue
+                e = dict(e)
+                e["pid"] = new_pid
+                if "ts" in e:
+                    e["ts"] = int(e["ts"] + offset_us)
+                self.events.append(e)
+        return new_pid
+
+    def to_chrome(self) -> dict:
+        meta = [{"name": "process_name", "ph": "M", "pid": pid, "tid": 0, "args": {"name": name}}
+                for pid, name in sorted(self._process_names.items())]
+        return {"traceEvents": meta + sorted(self.events, key=lambda e: e.get("ts", 0)),
+                "displayTimeUnit": "ms"}
+
+    def export_chrome(self, path: str):
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(self.to_chrome(), f, ensure_ascii=False)
+
+    def summary(self) -> Dict[str, dict]:
+        """按 span 名称聚合：次数与总耗时（秒）"""
+        agg: Dict[str, dict] = {}
+        for e in self.events:
+            if e.get("ph") != "X":
+                continue
+            s = agg.setdefault(e["name"], {"count": 0, "total_s": 0.0})
+            s["count"] += 1
+            s["total_s"] += e["dur"] / 1e6
+        return agg
+
+
+def _jsonable(v):
+    if isinstance(v, (str, int, float, bool)) or v is None:
+        return v
+    return str(v)
+
+
+def load_chrome(path: str) -> List[dict]:
+    """读取 Chrome trace 文件中的事件（兼容对象格式与数组格式）"""
+    with open(path, "r", encoding="utf-8") as f:
+        data = json.load(f)
+    return data.get("traceEvents", []) if isinstance(data, dict) else data
+
+
+def events_bounds(events: List[dict]):
+    """返回 (最早开始, 最晚结束)，单位微秒；无事件时返回 None"""
+    xs = [e for e in events if e.get("ph") == "X"]
+    if not xs:
+        return None
+    return min(e["ts"] for e in xs), max(e["ts"] + e["dur"] for e in xs)
+
+
+def align_offset(events: List[dict], window_start_us: int, window_end_us: int) -> int:
+    """
+    远端时钟与本地不同步：把远端事件的结束对齐到本地执行窗口的结束，
+    这样窗口开头的空隙就是 SSH 通道建立 + 解释器启动的开销
+    """
+    bounds = events_bounds(events)
+    if bounds is None:
+        return 0
+    start, end = bounds
+    offset = window_end_us - end
+    # 远端耗时若长于窗口（计时误差），退化为与窗口起点对齐
+    if start + offset < window_start_us:
+        offset = window_start_us - start
+    return offset
+
+
+# 进程级全局 tracer，默认关闭（span 为空操作）
+_TRACER = Tracer(enabled=False)
+
+
+def get_tracer() -> Tracer:
+    return _TRACER
+
+
+def enable_tracing(process_name: str) -> Tracer:
+    global _TRACER
+    _TRACER = Tracer(process_name=process_name, enabled=True)
+    return _TRACER
+
+
+def span(name: str, cat: str = "ioi", **args):
+    return _TRACER.span(name, cat=cat, **args)
@@ -0,0 +1,238 @@
+"""
+FreeFormIOIGenerator 的异步并发生成流水线
+- 并发上限（asyncio.Semaphore）+ 令牌桶限速
+- 可重试错误（429 / 5xx / 连接超时 / 响应无法解析）按指数退避 + 抖动重试，429 优先遵循 Retry-After
+- 每个批次解析、校验后立即追加写入 JSONL，中途中断不丢已完成的批次
+- 指定去重索引时，新批次先与索引（含之前所有批次）比对，重复与近似重复的样本不写入
+
+用法：
+    python async_generator.py --num-batches 10 --batch-size 8 --concurrency 8 --rate 5
+    python async_generator.py --mock --num-batches 200 --concurrency 32 --error-rate 0.1   # 离线压测
+"""
+import os
+import json
+import time
+import random
+import asyncio
+import argparse
+from typing import Dict, List, Optional
+
+import openai
+
+from data_generator import FreeFormIOIGenerator
+
+RETRYABLE_ERRORS = (openai.RateLimitError, openai.APIConnectionError, openai.APITimeoutError,
+                    openai.InternalServerError)
+
+
+class TokenBucket:
+    """令牌桶：平均每秒 rate 个请求，最多突发 capacity 个"""
+
+    def __init__(self, rate: float, capacity: Optional[float] = None):
+        self.rate = rate
+        self.capacity = capacity or max(1.0, rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    async def acquire(self):
+        if self.rate <= 0:
+            return
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class AsyncIOIGenerator(FreeFormIOIGenerator):
+    """并发版本的 FreeFormIOIGenerator，提示词、解析与校验逻辑沿用父类"""
+
+    def __init__(self, api_key: str, base_url: str = "https://api.deepseek.com/v1", model: str = "deepseek-chat",
+                 concurrency: int = 8, rate: float = 5.0, burst: Optional[float] = None, max_retries: int = 5,
+                 backoff_base: float = 1.0, backoff_max: float = 30.0, timeout: float = 120.0,
+                 dedup_index=None):
+        self.api_key = api_key
+        self.model = model
+        # 重试由本类统一处理，关闭客户端自带的重试
+        self.client = openai.AsyncOpenAI(api_key=api_key, base_url=base_url, max_retries=0, timeout=timeout)
+        self.concurrency = concurrency
+        self.bucket = TokenBucket(rate, burst)
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.dedup_index = dedup_index
+        self.stats = {"requests": 0, "retries": 0, "failed_batches": 0, "parse_errors": 0,
+                      "valid_items": 0, "invalid_items": 0, "duplicate_items": 0, "errors": {}}
+        self.latencies: List[float] = []
+
+    def _backoff(self, attempt: int, error: Exception) -> float:
+        """指数退避 + 全抖动；429 带 Retry-After 时取两者较大值"""
+        delay = random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+        response = getattr(error, "response", None)
+        retry_after = response.headers.get("retry-after") if response is not None else None
+        if retry_after:
+            try:
+                delay = max(delay, float(retry_after))
+            except ValueError:
+                pass
+        return delay
+
+    async def _request_batch(self, batch: int, batch_size: int) -> List[Dict]:
+        prompt = self._create_generation_prompt(batch_size)
+        for attempt in range(self.max_retries + 1):
+            await self.bucket.acquire()
+            self.stats["requests"] += 1
+            t0 = time.monotonic()
+            try:
+                response = await self.client.chat.completions.create(
+                    model=self.model,
+                    messages=[
+                        {"role": "system", "content": "你是一个语言学实验数据生成专家。请严格按JSON格式输出。"},
+                        {"role": "user", "content": prompt}
+                    ],
+                    temperature=0.8,
+                    max_tokens=4000
+                )
+                self.latencies.append(time.monotonic() - t0)
+                batch_data = self._parse_response(response.choices[0].message.content or "")
+                if batch_data:
+                    return batch_data
+                # 模型没有按格式输出，同样重试
+                self.stats["parse_errors"] += 1
+                error = None
+            except RETRYABLE_ERRORS as e:
+                name = type(e).__name__
+                self.stats["errors"][name] = self.stats["errors"].get(name, 0) + 1
+                error = e
+            except openai.APIError as e:
+                name = type(e).__name__
+                self.stats["errors"][name] = self.stats["errors"].get(name, 0) + 1
+                print(f"批次 {batch+1} 不可重试的错误: {e}")
+                break
+            if attempt < self.max_retries:
+                self.stats["retries"] += 1
+                await asyncio.sleep(self._backoff(attempt, error))
+        self.stats["failed_batches"] += 1
+        print(f"批次 {batch+1} 生成失败（已重试 {self.max_retries} 次）")
+        return []
+
+    async def generate_async(self, num_batches: int = 10, batch_size: int = 10,
+                             output_file: Optional[str] = None, invalid_file: Optional[str] = None) -> List[Dict]:
+        """并发生成 num_batches 个批次；指定 output_file 时每个批次校验后立即追加写入（JSONL）"""
+        semaphore = asyncio.Semaphore(self.concurrency)
+        out = open(output_file, 'a', encoding='utf-8') if output_file else None
+        bad = open(invalid_file, 'a', encoding='utf-8') if invalid_file else None
+        all_valid: List[Dict] = []
+        done = 0
+
+        async def worker(batch: int):
+            nonlocal done
+            async with semaphore:
+                raw = await self._request_batch(batch, batch_size)
+            valid, invalid = self.validate_and_clean(raw)
+            if self.dedup_index is not None and valid:
+                valid, duplicates = self.dedup_index.filter_batch(valid)
+                self.stats["duplicate_items"] += len(duplicates)
+            self.stats["valid_items"] += len(valid)
+            self.stats["invalid_items"] += len(invalid)
+            all_valid.extend(valid)
+            # 单线程事件循环内写文件不会交错
+            if out is not None and valid:
+                out.write("".join(json.dumps(item, ensure_ascii=False) + "\n" for item in valid))
+                out.flush()
+            if bad is not None and invalid:
+                bad.write("".join(json.dumps(item, ensure_ascii=False) + "\n" for item in invalid))
+                bad.flush()
+            done += 1
+            print(f"批次 {batch+1} 完成（{done}/{num_batches}），有效 {len(valid)} 条")
+
+        t0 = time.monotonic()
+        try:
+            await asyncio.gather(*(worker(b) for b in range(num_batches)))
+        finally:
+            if out is not None:
+                out.close()
+            if bad is not None:
+                bad.close()
+            await self.client.close()
+        self.stats["elapsed_s"] = time.monotonic() - t0
+        self.stats["items_per_s"] = self.stats["valid_items"] / self.stats["elapsed_s"] if self.stats["elapsed_s"] > 0 else None
+        if self.latencies:
+            lat = sorted(self.latencies)
+            self.stats["latency_p50_s"] = lat[len(lat) // 2]
+            self.stats["latency_p95_s"] = lat[min(len(lat) - 1, int(len(lat) * 0.95))]
+        return all_valid
+
+    def generate_free_form_data(self, num_batches: int = 10, batch_size: int = 10) -> List[Dict]:
+        """与父类同名接口的同步入口"""
+        return asyncio.run(self.generate_async(num_batches, batch_size))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="并发生成自由形式 IOI 数据")
+    parser.add_argument("--api-key", default=os.environ.get("DEEPSEEK_API_KEY"))
+    parser.add_argument("--base-url", default="https://api.deepseek.com/v1")
+    parser.add_argument("--model", default="deepseek-chat")
+    parser.add_argument("--num-batches", type=int, default=10)
+    parser.add_argument("--batch-size", type=int, default=8)
+    parser.add_argument("--concurrency", type=int, default=8, help="同时进行的请求数上限")
+    parser.add_argument("--rate", type=float, default=5.0, help="平均每秒请求数（<=0 不限速）")
+    parser.add_argument("--burst", type=float, default=None, help="令牌桶容量，默认等于 rate")
+    parser.add_argument("--max-retries", type=int, default=5)
+    parser.add_argument("--backoff-base", type=float, default=1.0)
+    parser.add_argument("--timeout", type=float, default=120.0)
+    parser.add_argument("--output", default="free_form_ioi_dataset.jsonl")
+    parser.add_argument("--invalid-output", default=None)
+    parser.add_argument("--stats-output", default=None)
+    parser.add_argument("--dedup-db", default=None, help="去重索引（SQLite），跨运行持久化")
+    parser.add_argument("--mock", action="store_true", help="启动本地模拟服务代替真实 API")
+    parser.add_argument("--latency", type=float, default=0.2, help="模拟服务延迟（--mock）")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="模拟服务 5xx 比例（--mock）")
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0, help="模拟服务 429 比例（--mock）")
+    parser.add_argument("--malformed-rate", type=float, default=0.0, help="模拟服务非 JSON 比例（--mock）")
+    args = parser.parse_args()
+
+    base_url, api_key, server = args.base_url, args.api_key, None
+    if args.mock:
+        from mock_server import start_mock_server
+        server, mock_state, base_url = start_mock_server(latency=args.latency, error_rate=args.error_rate,
+                                                         rate_limit_rate=args.rate_limit_rate,
+                                                         malformed_rate=args.malformed_rate)
+        api_key = api_key or "mock"
+        print(f"使用模拟服务: {base_url}")
+    if not api_key:
+        parser.error("需要 --api-key 或环境变量 DEEPSEEK_API_KEY")
+
+    dedup = None
+    if args.dedup_db:
+        from dedup_index import DedupIndex
+        dedup = DedupIndex(args.dedup_db)
+    generator = AsyncIOIGenerator(api_key, base_url=base_url, model=args.model, concurrency=args.concurrency,
+                                  rate=args.rate, burst=args.burst, max_retries=args.max_retries,
+                                  backoff_base=args.backoff_base, timeout=args.timeout, dedup_index=dedup)
+    try:
+        dataset = asyncio.run(generator.generate_async(args.num_batches, args.batch_size, args.output, args.invalid_output))
+    finally:
+        if dedup is not None:
+            dedup.close()
+    if server is not None:
+        generator.stats["mock"] = mock_state.counts
+        server.shutdown()
+    stats = generator.stats
+    print(f"生成完成！共 {len(dataset)} 条有效数据 -> {args.output}")
+    print(f"请求 {stats['requests']} 次，重试 {stats['retries']} 次，失败批次 {stats['failed_batches']}，"
+          f"重复 {stats['duplicate_items']} 条，用时 {stats['elapsed_s']:.2f}s，{stats['items_per_s'] or 0:.1f} 条/s")
+    if stats["errors"]:
+        print(f"错误分布: {stats['errors']}")
+    if args.stats_output:
+        with open(args.stats_output, 'w', encoding='utf-8') as f:
+            json.dump(stats, f, indent=2, ensure_ascii=False)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,228 @@
+"""
+自由形式 IOI 数据的持久化去重索引（SQLite）
+- 精确重复：规范化后的 (normal, corrupted) 的哈希，唯一索引
+- 近似重复：规范化 token 的词与相邻词对作为 shingle，MinHash 签名按 LSH 分段写入带索引的桶表，
+  查询只访问与新样本同桶的候选（B 树索引，次线性），再用签名估计的 Jaccard 相似度确认
+
+用法：
+    python dedup_index.py add --db ioi_dedup.db --input free_form_ioi_dataset.jsonl --output unique.jsonl
+    python dedup_index.py stats --db ioi_dedup.db
+"""
+import re
+import json
+import struct
+import sqlite3
+import hashlib
+import argparse
+from typing import Dict, Iterable, List, Optional, Tuple
+
+MERSENNE_61 = (1 << 61) - 1
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+CREATE TABLE IF NOT EXISTS items (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    exact_hash TEXT NOT NULL UNIQUE,
+    normal TEXT,
+    corrupted TEXT,
+    signature BLOB NOT NULL
+);
+CREATE TABLE IF NOT EXISTS lsh_buckets (
+    band INTEGER NOT NULL,
+    bucket INTEGER NOT NULL,
+    item_id INTEGER NOT NULL REFERENCES items(id)
+);
+CREATE INDEX IF NOT EXISTS idx_lsh ON lsh_buckets(band, bucket);
+"""
+
+
+def normalize_tokens(text: str) -> List[str]:
+    """小写、去标点后按空白切分"""
+    return re.findall(r"[a-z0-9']+", text.lower())
+
+
+def shingles(item: Dict) -> set:
+    """句子对的 shingle：两句各自的词与相邻词对（带句子前缀，避免 normal/corrupted 混淆）"""
+    out = set()
+    for key in ("normal", "corrupted"):
+        tokens = normalize_tokens(item.get(key, ""))
+        out.update(f"{key[0]}:{t}" for t in tokens)
+        out.update(f"{key[0]}:{a} {b}" for a, b in zip(tokens, tokens[1:]))
+    return out
+
+
+def exact_hash(item: Dict) -> str:
+    text = " ".join(normalize_tokens(item.get("normal", ""))) + "\t" + " ".join(normalize_tokens(item.get("corrupted", "")))
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+
+def _hash64(s: str) -> int:
+    return int.from_bytes(hashlib.blake2b(s.encode("utf-8"), digest_size=8).digest(), "little")
+
+
+def lsh_params(num_perm: int, threshold: float) -> Tuple[int, int]:
+    """选择 bands × rows = num_perm，使 S 曲线的拐点 (1/b)^(1/r) 最接近阈值"""
+    candidates = [(b, num_perm // b) for b in range(1, num_perm + 1) if num_perm % b == 0]
+    return min(candidates, key=lambda br: abs((1 / br[0]) ** (1 / br[1]) - threshold))
+
+
+class MinHasher:
+    """num_perm 个 (a*x + b) mod (2^61-1) 哈希函数的 MinHash，由 seed 确定，保证跨进程可复现"""
+
+    def __init__(self, num_perm: int = 64, seed: int = 1):
+        self.num_perm = num_perm
+        params = []
+        for i in range(num_perm):
+            h = hashlib.blake2b(f"{seed}:{i}".encode(), digest_size=16).digest()
+            a = int.from_bytes(h[:8], "little") % (MERSENNE_61 - 1) + 1
+            b = int.from_bytes(h[8:], "little") % MERSENNE_61
+            params.append((a, b))
+        self.params = params
+
+    def signature(self, features: Iterable[str]) -> List[int]:
+        hashes = [_hash64(f) for f in features] or [0]
+        return [min([(a * x + b) % MERSENNE_61 for x in hashes]) for a, b in self.params]
+
+
+def estimate_jaccard(sig1: List[int], sig2: List[int]) -> float:
+    return sum(1 for x, y in zip(sig1, sig2) if x == y) / len(sig1)
+
+
+class DedupIndex:
+    """
+    持久化去重索引；check() 只读，add() 写入，filter_batch() 对一个批次逐条检查并加入（批内重复也会被识别）
+    索引的 num_perm / bands / 阈值在首次创建时写入 meta 表，之后以库中的参数为准
+    """
+
+    def __init__(self, db_path: str = "ioi_dedup.db", threshold: float = 0.8, num_perm: int = 64, seed: int = 1):
+        self.conn = sqlite3.connect(db_path)
+        self.conn.executescript(SCHEMA)
+        meta = dict(self.conn.execute("SELECT key, value FROM meta"))
+        if meta:
+            threshold, num_perm, seed = float(meta["threshold"]), int(meta["num_perm"]), int(meta["seed"])
+        else:
+            self.conn.executemany("INSERT INTO meta VALUES (?, ?)",
+                                  [("threshold", str(threshold)), ("num_perm", str(num_perm)), ("seed", str(seed))])
+            self.conn.commit()
+        self.threshold = threshold
+        self.hasher = MinHasher(num_perm, seed)
+        self.bands, self.rows = lsh_params(num_perm, threshold)
+        self._sig_struct = struct.Struct(f"<{num_perm}Q")
+
+    def _band_keys(self, sig: List[int]) -> List[int]:
+        # 桶号取 64 位哈希并转成 SQLite 的有符号整数
+        keys = []
+        for band in range(self.bands):
+            chunk = sig[band * self.rows:(band + 1) * self.rows]
+            h = _hash64(",".join(map(str, chunk)))
+            keys.append(h - (1 << 64) if h >= (1 << 63) else h)
+        return keys
+
+    def check(self, item: Dict) -> Tuple[str, Optional[int], float]:
+        """返回 (状态, 命中的已有样本 id, 相似度)；状态为 new / exact / near"""
+        return self._check(item, exact_hash(item), self.hasher.signature(shingles(item)))[:3]
+
+    def _check(self, item: Dict, ehash: str, sig: List[int]):
+        row = self.conn.execute("SELECT id FROM items WHERE exact_hash = ?", (ehash,)).fetchone()
+        if row:
+            return "exact", row[0], 1.0, sig
+        best_id, best_sim = None, 0.0
+        seen = set()
+        for band, key in enumerate(self._band_keys(sig)):
+            for (item_id,) in self.conn.execute("SELECT item_id FROM lsh_buckets WHERE band = ? AND bucket = ?", (band, key)):
+                if item_id in seen:
+                    continue
+                seen.add(item_id)
+                blob = self.conn.execute("SELECT signature FROM items WHERE id = ?", (item_id,)).fetchone()[0]
+                sim = estimate_jaccard(sig, self._sig_struct.unpack(blob))
+                if sim > best_sim:
+                    best_id, best_sim = item_id, sim
+        if best_id is not None and best_sim >= self.threshold:
+            return "near", best_id, best_sim, sig
+        return "new", None, best_sim, sig
+
+    def add(self, item: Dict, ehash: Optional[str] = None, sig: Optional[List[int]] = None) -> int:
+        ehash = ehash or exact_hash(item)
+        sig = sig or self.hasher.signature(shingles(item))
+        cur = self.conn.execute("INSERT INTO items (exact_hash, normal, corrupted, signature) VALUES (?, ?, ?, ?)",
+                                (ehash, item.get("normal"), item.get("corrupted"), self._sig_struct.pack(*sig)))
+        item_id = cur.lastrowid
+        self.conn.executemany("INSERT INTO lsh_buckets VALUES (?, ?, ?)",
+                              [(band, key, item_id) for band, key in enumerate(self._band_keys(sig))])
+        return item_id
+
+    def filter_batch(self, items: List[Dict]) -> Tuple[List[Dict], List[Dict]]:
+        """逐条检查并把新样本加入索引；返回 (新样本, 重复样本)，重复样本附带 duplicate_of / similarity"""
+        unique, duplicates = [], []
+        for item in items:
+            ehash = exact_hash(item)
+            status, match_id, sim, sig = self._check(item, ehash, self.hasher.signature(shingles(item)))
+            if status == "new":
+                self.add(item, ehash, sig)
+                unique.append(item)
+            else:
+                duplicates.append({**item, "duplicate": status, "duplicate_of": match_id, "similarity": round(sim, 3)})
+        self.conn.commit()
+        return unique, duplicates
+
+    def stats(self) -> Dict:
+        n_items = self.conn.execute("SELECT COUNT(*) FROM items").fetchone()[0]
+        n_buckets = self.conn.execute("SELECT COUNT(DISTINCT band || ':' || bucket) FROM lsh_buckets").fetchone()[0]
+        return {"items": n_items, "buckets": n_buckets, "threshold": self.threshold,
+                "num_perm": self.hasher.num_perm, "bands": self.bands, "rows": self.rows}
+
+    def close(self):
+        self.conn.commit()
+        self.conn.close()
+
+
+def read_items(path: str) -> List[Dict]:
+    with open(path, 'r', encoding='utf-8') as f:
+        if path.endswith(".jsonl"):
+            return [json.loads(line) for line in f if line.strip()]
+        return json.load(f)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="自由形式 IOI 数据的去重索引")
+    sub = parser.add_subparsers(dest="command", required=True)
+    p_add = sub.add_parser("add", help="检查数据并把新样本加入索引")
+    p_add.add_argument("--input", required=True, help="JSON 列表或 JSONL")
+    p_add.add_argument("--output", default=None, help="新样本输出（JSONL）")
+    p_add.add_argument("--duplicates", default=None, help="重复样本输出（JSONL）")
+    p_add.add_argument("--batch-size", type=int, default=1000)
+    p_stats = sub.add_parser("stats", help="索引统计")
+    for p in (p_add, p_stats):
+        p.add_argument("--db", default="ioi_dedup.db")
+        p.add_argument("--threshold", type=float, default=0.8, help="近似重复的 Jaccard 阈值（仅新建索引时生效）")
+        p.add_argument("--num-perm", type=int, default=64, help="MinHash 签名长度（仅新建索引时生效）")
+    args = parser.parse_args()
+
+    index = DedupIndex(args.db, args.threshold, args.num_perm)
+    try:
+        if args.command == "stats":
+            print(json.dumps(index.stats(), indent=2, ensure_ascii=False))
+            return
+        items = read_items(args.input)
+        out = open(args.output, 'w', encoding='utf-8') if args.output else None
+        dup = open(args.duplicates, 'w', encoding='utf-8') if args.duplicates else None
+        n_unique = n_exact = n_near = 0
+        for start in range(0, len(items), args.batch_size):
+            unique, duplicates = index.filter_batch(items[start:start + args.batch_size])
+            n_unique += len(unique)
+            n_exact += sum(1 for d in duplicates if d["duplicate"] == "exact")
+            n_near += sum(1 for d in duplicates if d["duplicate"] == "near")
+            if out is not None:
+                out.write("".join(json.dumps(x, ensure_ascii=False) + "\n" for x in unique))
+            if dup is not None:
+                dup.write("".join(json.dumps(x, ensure_ascii=False) + "\n" for x in duplicates))
+        for f in (out, dup):
+            if f is not None:
+                f.close()
+        print(f"去重完成: 新样本 {n_unique}，精确重复 {n_exact}，近似重复 {n_near}（索引共 {index.stats()['items']} 条）")
+    finally:
+        index.close()
+
+
+if __name__ == "__main__":
+    main()
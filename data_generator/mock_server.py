@@ -0,0 +1,150 @@
+"""
+本地模拟的 chat-completion 服务（OpenAI 兼容接口），用于离线测试生成流水线的吞吐与失败处理
+可配置响应延迟、5xx 错误率、429 限流率与返回非 JSON 内容的比例
+
+用法：
+    python mock_server.py --port 8000 --latency 0.5 --error-rate 0.1 --rate-limit-rate 0.05
+    python async_generator.py --base-url http://127.0.0.1:8000/v1 --api-key mock --num-batches 50 --concurrency 16
+"""
+import re
+import json
+import time
+import random
+import argparse
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Tuple
+
+NAMES = ["Mary", "John", "Alice", "Bob", "Sarah", "David", "Emma", "James", "Olivia", "Michael"]
+PLACES = ["the store", "the library", "the park", "the beach", "the office", "the party"]
+OBJECTS = ["a book", "the keys", "a gift", "the tickets", "a letter", "the notes"]
+
+
+def fake_items(n: int, rng: random.Random) -> List[Dict]:
+    """生成 n 条符合 _create_generation_prompt 格式要求的句子对"""
+    items = []
+    for _ in range(n):
+        a, b = rng.sample(NAMES, 2)
+        place, obj = rng.choice(PLACES), rng.choice(OBJECTS)
+        items.append({
+            "normal": f"After {a} and {b} went to {place}, {a} gave {obj} to",
+            "corrupted": f"After {a} and {b} went to {place}, {b} gave {obj} to",
+            "normal_target": b,
+            "corrupted_target": a,
+        })
+    return items
+
+
+class MockState:
+    def __init__(self, latency: float = 0.2, jitter: float = 0.1, error_rate: float = 0.0,
+                 rate_limit_rate: float = 0.0, malformed_rate: float = 0.0, seed: int = 0):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.rate_limit_rate = rate_limit_rate
+        self.malformed_rate = malformed_rate
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+        self.counts = {"requests": 0, "ok": 0, "error": 0, "rate_limited": 0, "malformed": 0}
+
+    def draw(self) -> Tuple[str, float]:
+        """决定本次请求的结果与延迟（加锁保证可复现的随机序列）"""
+        with self.lock:
+            self.counts["requests"] += 1
+            r = self.rng.random()
+            delay = max(0.0, self.latency + self.rng.uniform(-self.jitter, self.jitter))
+            if r < self.error_rate:
+                outcome = "error"
+            elif r < self.error_rate + self.rate_limit_rate:
+                outcome = "rate_limited"
+            elif r < self.error_rate + self.rate_limit_rate + self.malformed_rate:
+                outcome = "malformed"
+            else:
+                outcome = "ok"
+            self.counts[outcome] += 1
+            return outcome, delay
+
+
+def make_handler(state: MockState):
+    class Handler(BaseHTTPRequestHandler):
+        def log_message(self, format, *args):
+            pass
+
+        def _send(self, status: int, body: Dict, headers: Dict = None):
+            data = json.dumps(body, ensure_ascii=False).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            for k, v in (headers or {}).items():
+                self.send_header(k, v)
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_POST(self):
+            if not self.path.rstrip("/").endswith("/chat/completions"):
+                self._send(404, {"error": {"message": "not found"}})
+                return
+            request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+            outcome, delay = state.draw()
+            time.sleep(delay)
+            if outcome == "error":
+                self._send(500, {"error": {"message": "mock internal error", "type": "server_error"}})
+                return
+            if outcome == "rate_limited":
+                self._send(429, {"error": {"message": "mock rate limit", "type": "rate_limit"}}, {"Retry-After": "0.5"})
+                return
+            prompt = request.get("messages", [{}])[-1].get("content", "")
+            m = re.search(r"生成 (\d+) 个", prompt)
+            n = int(m.group(1)) if m else 8
+            with state.lock:
+                seed = state.rng.random()
+            if outcome == "malformed":
+                content = "抱歉，我无法按要求输出 JSON。"
+            else:
+                content = json.dumps(fake_items(n, random.Random(seed)), ensure_ascii=False, indent=2)
+            self._send(200, {
+                "id": f"mock-{state.counts['requests']}",
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": request.get("model", "mock"),
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}],
+                "usage": {"prompt_tokens": len(prompt), "completion_tokens": len(content), "total_tokens": len(prompt) + len(content)},
+            })
+
+    return Handler
+
+
+def start_mock_server(host: str = "127.0.0.1", port: int = 0, **options) -> Tuple[ThreadingHTTPServer, MockState, str]:
+    """在后台线程启动模拟服务，返回 (server, state, base_url)；port=0 时自动选择空闲端口"""
+    state = MockState(**options)
+    server = ThreadingHTTPServer((host, port), make_handler(state))
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, state, f"http://{host}:{server.server_address[1]}/v1"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="本地模拟 chat-completion 服务")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--latency", type=float, default=0.2, help="平均响应延迟（秒）")
+    parser.add_argument("--jitter", type=float, default=0.1)
+    parser.add_argument("--error-rate", type=float, default=0.0, help="返回 500 的比例")
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0, help="返回 429 的比例")
+    parser.add_argument("--malformed-rate", type=float, default=0.0, help="返回非 JSON 内容的比例")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    server, state, url = start_mock_server(args.host, args.port, latency=args.latency, jitter=args.jitter,
+                                           error_rate=args.error_rate, rate_limit_rate=args.rate_limit_rate,
+                                           malformed_rate=args.malformed_rate, seed=args.seed)
+    print(f"模拟服务已启动: {url}（Ctrl+C 退出）")
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        server.shutdown()
+        print(f"请求统计: {state.counts}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,6 +1,16 @@
+import os
+import sys
 import json
 import re
-from typing import List, Dict, Tuple
+import heapq
+import hashlib
+import argparse
+from multiprocessing import Pool
+from typing import Iterator, List, Dict, Optional, Tuple
+
+# 分块读取与有界并行与 IOI_with _modules/ioi_stream_pre.py 共用
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "IOI_with _modules"))
+from ioi_blocks import bounded_imap, iter_record_blocks, iter_text_blocks
 
 class IOIDataValidator:
     """IOI数据格式验证器"""
@@ -172,28 +182,180 @@ class IOIDataValidator:
             "corrupted": total_corrupted_length / len(valid_data)
         }
         analysis["target_variety"] = list(analysis["target_variety"])
+        analysis["sentence_patterns"] = list(analysis["sentence_patterns"])
         
         return analysis
 
-def main():
-    # 加载生成的数据
+class DistinctSketch:
+    """KMV（k 个最小哈希值）基数估计：不同值少于 k 个时精确，否则相对误差约 1/sqrt(k)，内存固定"""
+
+    def __init__(self, k: int = 1024):
+        self.k = k
+        self.heap: List[int] = []   # 取负的最大堆，堆顶是当前第 k 小的哈希
+        self.members = set()
+
+    @staticmethod
+    def _hash(value: str) -> int:
+        return int.from_bytes(hashlib.blake2b(value.encode("utf-8"), digest_size=8).digest(), "little")
+
+    def add(self, value: str):
+        self._add_hash(self._hash(value))
+
+    def _add_hash(self, h: int):
+        if h in self.members:
+            return
+        if len(self.heap) < self.k:
+            heapq.heappush(self.heap, -h)
+            self.members.add(h)
+        elif h < -self.heap[0]:
+            self.members.discard(-heapq.heappushpop(self.heap, -h))
+            self.members.add(h)
+
+    def merge(self, other: "DistinctSketch"):
+        for h in other.members:
+            self._add_hash(h)
+
+    def estimate(self) -> float:
+        if len(self.heap) < self.k:
+            return float(len(self.heap))
+        return (self.k - 1) / (-self.heap[0] / 2 ** 64)
+
+
+class ValidationStats:
+    """可合并的增量统计：与 generate_validation_report 的报告字段一致，内存不随数据量增长"""
+
+    def __init__(self, target_sample: int = 20):
+        self.valid = 0
+        self.invalid = 0
+        self.error_counts: Dict[str, int] = {}
+        self.normal_words = 0
+        self.corrupted_words = 0
+        self.targets = DistinctSketch()
+        self.target_sample_size = target_sample
+        self.target_sample: List[str] = []
+
+    def update(self, item: Dict, is_valid: bool, errors: List[str]):
+        if not is_valid:
+            self.invalid += 1
+            for error in errors:
+                error_type = error.split(":")[0] if ":" in error else error
+                self.error_counts[error_type] = self.error_counts.get(error_type, 0) + 1
+            return
+        self.valid += 1
+        self.normal_words += len(item['normal'].split())
+        self.corrupted_words += len(item['corrupted'].split())
+        for target in (item['normal_target'], item['corrupted_target']):
+            self.targets.add(target)
+            if len(self.target_sample) < self.target_sample_size and target not in self.target_sample:
+                self.target_sample.append(target)
+
+    def merge(self, other: "ValidationStats"):
+        self.valid += other.valid
+        self.invalid += other.invalid
+        for k, v in other.error_counts.items():
+            self.error_counts[k] = self.error_counts.get(k, 0) + v
+        self.normal_words += other.normal_words
+        self.corrupted_words += other.corrupted_words
+        self.targets.merge(other.targets)
+        for target in other.target_sample:
+            if len(self.target_sample) < self.target_sample_size and target not in self.target_sample:
+                self.target_sample.append(target)
+
+    def report(self) -> Dict:
+        total = self.valid + self.invalid
+        analysis = {}
+        if self.valid:
+            analysis = {
+                "avg_sentence_length": {
+                    "normal": self.normal_words / self.valid,
+                    "corrupted": self.corrupted_words / self.valid
+                },
+                "target_variety": self.target_sample,
+                "target_variety_count": round(self.targets.estimate()),
+                "target_variety_exact": len(self.targets.heap) < self.targets.k,
+            }
+        return {
+            "total_samples": total,
+            "valid_samples": self.valid,
+            "invalid_samples": self.invalid,
+            "valid_ratio": self.valid / total if total > 0 else 0,
+            "error_breakdown": self.error_counts,
+            "sample_analysis": analysis
+        }
+
+
+_VALIDATOR: Optional[IOIDataValidator] = None
+
+
+def _validate_block(block: Tuple[int, str]) -> Tuple[str, str, ValidationStats, List[Tuple[int, List[str]]]]:
+    """校验一块 JSONL 文本，返回 (有效行, 无效行, 统计, 前几个错误样本)"""
+    global _VALIDATOR
+    if _VALIDATOR is None:
+        _VALIDATOR = IOIDataValidator()
+    first_line, text = block
+    valid, invalid, examples = [], [], []
+    stats = ValidationStats()
+    for offset, line in enumerate(text.split("\n")):
+        if not line.strip():
+            continue
+        try:
+            item = json.loads(line)
+            if not isinstance(item, dict):
+                raise ValueError("not an object")
+            is_valid, errors = _VALIDATOR.validate_single_item(item)
+        except (ValueError, AttributeError) as e:
+            item, is_valid, errors = {"raw": line}, False, [f"无法解析: {e}"]
+        stats.update(item, is_valid, errors)
+        if is_valid:
+            valid.append(line)
+        else:
+            invalid.append(json.dumps({**item, "validation_errors": errors}, ensure_ascii=False))
+            if len(examples) < 5:
+                examples.append((first_line + offset, errors))
+    return ("".join(x + "\n" for x in valid), "".join(x + "\n" for x in invalid), stats, examples)
+
+
+def iter_blocks(path: str, block_bytes: int = 4 << 20) -> Iterator[Tuple[int, str]]:
+    """按约 block_bytes 读取整行文本块，返回 (块首行号, 文本)；.json 列表逐条转成 JSONL 行"""
+    if not path.endswith(".jsonl"):
+        with open(path, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+        return iter_record_blocks(data, block_bytes)
+    return iter_text_blocks([path], block_bytes)
+
+
+def validate_stream(input_file: str, valid_file: str, invalid_file: Optional[str] = None,
+                    workers: int = 1, block_mb: float = 4) -> Dict:
+    """
+    单遍流式验证：按块分发给进程池，有效/无效记录按输入顺序边验证边写出（JSONL），统计随块合并
+    在途的块最多 2 × workers 个，峰值内存约为 2 × workers × block_mb
+    返回与 generate_validation_report 相同结构的报告
+    """
+    stats = ValidationStats()
+    shown = 0
+    print("开始数据格式验证（流式）...")
+    pool = Pool(workers) if workers > 1 else None
     try:
-        with open('free_form_ioi_dataset.json', 'r', encoding='utf-8') as f:
-            dataset = json.load(f)
-    except FileNotFoundError:
-        print("数据文件不存在，请先运行数据生成脚本")
-        return
-    
-    print(f"加载了 {len(dataset)} 条数据")
-    
-    # 验证数据
-    validator = IOIDataValidator()
-    valid_data, invalid_data = validator.validate_dataset(dataset)
-    
-    # 生成报告
-    report = validator.generate_validation_report(valid_data, invalid_data)
-    
-    # 打印报告
+        with open(valid_file, 'w', encoding='utf-8') as out, \
+                open(invalid_file or os.devnull, 'w', encoding='utf-8') as bad:
+            blocks = iter_blocks(input_file, int(block_mb * (1 << 20)))
+            results = bounded_imap(pool, _validate_block, blocks, 2 * workers) if pool is not None else map(_validate_block, blocks)
+            for valid, invalid, block_stats, examples in results:
+                out.write(valid)
+                bad.write(invalid)
+                stats.merge(block_stats)
+                for line_no, errors in examples:
+                    if shown < 5:  # 只显示前5个错误样本
+                        print(f"无效样本 {line_no}: {errors}")
+                        shown += 1
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    return stats.report()
+
+
+def print_report(report: Dict):
     print("\n" + "="*50)
     print("数据验证报告")
     print("="*50)
@@ -212,7 +374,58 @@ def main():
         print(f"\n样本分析:")
         print(f"  平均句子长度 - 正常: {analysis['avg_sentence_length']['normal']:.1f} 词")
         print(f"  平均句子长度 - 损坏: {analysis['avg_sentence_length']['corrupted']:.1f} 词")
-        print(f"  唯一目标词数量: {len(analysis['target_variety'])}")
+        count = analysis.get('target_variety_count', len(analysis['target_variety']))
+        approx = "" if analysis.get('target_variety_exact', True) else "（估计值）"
+        print(f"  唯一目标词数量: {count}{approx}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="IOI 数据格式验证")
+    parser.add_argument("--input", default="free_form_ioi_dataset.json")
+    parser.add_argument("--stream", action="store_true", help="流式验证（.jsonl 输入时自动启用）")
+    parser.add_argument("--valid-output", default=None, help="流式模式下有效数据输出（JSONL）")
+    parser.add_argument("--invalid-output", default=None, help="流式模式下无效数据输出（JSONL）")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--report-output", default=None)
+    args = parser.parse_args()
+    if args.stream or args.input.endswith(".jsonl"):
+        if not os.path.exists(args.input):
+            print("数据文件不存在，请先运行数据生成脚本")
+            return
+        valid_file = args.valid_output or "validated_ioi_dataset.jsonl"
+        invalid_file = args.invalid_output or "invalid_ioi_data.jsonl"
+        report = validate_stream(args.input, valid_file, invalid_file, args.workers)
+        print_report(report)
+        print(f"\n✅ 有效数据已保存到: {valid_file}")
+        if report['invalid_samples']:
+            print(f"❌ 无效数据已保存到: {invalid_file}")
+        if args.report_output:
+            with open(args.report_output, 'w', encoding='utf-8') as f:
+                json.dump(report, f, indent=2, ensure_ascii=False)
+        return
+
+    # 加载生成的数据
+    try:
+        with open(args.input, 'r', encoding='utf-8') as f:
+            dataset = json.load(f)
+    except FileNotFoundError:
+        print("数据文件不存在，请先运行数据生成脚本")
+        return
+    
+    print(f"加载了 {len(dataset)} 条数据")
+    
+    # 验证数据
+    validator = IOIDataValidator()
+    valid_data, invalid_data = validator.validate_dataset(dataset)
+    
+    # 生成报告
+    report = validator.generate_validation_report(valid_data, invalid_data)
+    
+    # 打印报告
+    print_report(report)
+    if args.report_output:
+        with open(args.report_output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2, ensure_ascii=False)
     
     # 保存验证后的数据
     if valid_data: